@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
+
+import os
+import argparse
+import os.path
+import random
+import timeit
+import gc
+import tracemalloc
+
+import sqlalchemy
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../lib")
+import SpectrumLibrary as SpectrumLibraryModule
+import LibrarySpectrum as LibrarySpectrumModule
+import SpectrumLibraryBinary as SpectrumLibraryBinaryModule
+import SpectrumLibrarySearch as SpectrumLibrarySearchModule
+import SpectrumLibraryFragmentIndex as SpectrumLibraryFragmentIndexModule
+from SpectrumLibrary import SpectrumLibrary
+from LibrarySpectrum import LibrarySpectrum, parse_comment
+from SpectrumLibraryBinary import BinarySpectrumLibrary
+from SpectrumLibraryFragmentIndex import SpectrumLibraryFragmentIndex
+from SpectrumLibraryCache import SpectrumLibraryCache
+from SpectrumLibraryIndex import SpectrumLibraryIndex
+
+
+#### Write a synthetic NIST-style MSP library for benchmarking
+def write_synthetic_library(filename, n_spectra, seed=1):
+    random.seed(seed)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    with open(filename, 'w') as outfile:
+        for i_spectrum in range(n_spectra):
+            peptide = "".join(random.choice(residues) for i in range(random.randint(6,20))) + "K"
+            charge = random.randint(1,4)
+            precursor_mz = 300 + random.random() * 1500
+            n_peaks = random.randint(5,60)
+            mods = "0" if i_spectrum % 3 else "1(2,C,Carbamidomethyl)"
+            lines = [ f"Name: {peptide}/{charge}\n", f"MW: {precursor_mz*charge:.4f}\n",
+                f'Comment: Spec=Consensus Pep=Tryptic Fullname=R.{peptide}.A/{charge} Mods={mods} Parent={precursor_mz:.4f} ' +
+                f'Inst=it Mz_diff=0.5ppm Mz_exact={precursor_mz:.4f} Protein="sp|P{i_spectrum:06d}|PROT_HUMAN some protein" ' +
+                f'Organism="human" Sample="1/human_sample,2,2" Nreps=2/3 Naa={len(peptide)} HCD=30.0 eV RT=45.2 Unassign_all=0.1\n',
+                f"Num peaks: {n_peaks}\n" ]
+            for mz in sorted(random.uniform(100, 2000) for i in range(n_peaks)):
+                lines.append(f'{mz:.4f}\t{random.uniform(1,10000):.1f}\t"b{random.randint(1,9)}/0.{random.randint(0,9)}"\n')
+            lines.append("\n")
+            outfile.writelines(lines)
+
+
+#### Time the creation of an index for the library, and compare the bulk load with one ORM object per spectrum
+def benchmark_index(library_file, workers=1):
+    SpectrumLibraryModule.debug = False
+    spectrum_library = SpectrumLibrary()
+    spectrum_library.filename = library_file
+    t0 = timeit.default_timer()
+    n_spectra = spectrum_library.create_index()
+    t1 = timeit.default_timer()
+    print(f"index: indexed {n_spectra} spectra in {t1-t0:.3f} s ({n_spectra/(t1-t0):.0f} spectra/s)")
+
+    #### Compare against the parallel scan with an increasing number of workers
+    n_workers = 2
+    while n_workers <= workers:
+        parallel_library = SpectrumLibrary()
+        parallel_library.filename = library_file
+        t2 = timeit.default_timer()
+        parallel_library.create_index(workers=n_workers)
+        t3 = timeit.default_timer()
+        print(f"index: indexed {n_spectra} spectra with {n_workers} workers in {t3-t2:.3f} s ({(t1-t0)/(t3-t2):.2f}x serial)")
+        n_workers *= 2
+
+    #### Extract the records to re-insert them both ways into a scratch index
+    records = spectrum_library.index.session.execute(
+        sqlalchemy.text("SELECT number, offset, name, peptide_sequence FROM spectrum_library_index_record ORDER BY number")).fetchall()
+    scratch_index = SpectrumLibraryIndex(library_filename=library_file + '.benchmark')
+    timings = {}
+    for mode in [ 'orm', 'bulk' ]:
+        scratch_index.create_index()
+        t0 = timeit.default_timer()
+        if mode == 'bulk':
+            scratch_index.begin_bulk_load()
+        for record in records:
+            scratch_index.add_spectrum(number=record[0], offset=record[1], name=record[2], peptide_sequence=record[3])
+        if mode == 'bulk':
+            scratch_index.end_bulk_load()
+        else:
+            scratch_index.commit()
+        timings[mode] = timeit.default_timer() - t0
+        print(f"index: inserted {len(records)} records with {mode} add_spectrum() in {timings[mode]:.3f} s")
+    scratch_index.disconnect()
+    os.remove(library_file + '.benchmark.splindex')
+    print(f"index: bulk load speedup {timings['orm']/timings['bulk']:.1f}x")
+    return(t1-t0)
+
+
+#### Time random access to spectra through the index
+def benchmark_fetch(library_file, n_fetches=10000):
+    SpectrumLibraryModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    n_spectra = spectrum_library.index.n_spectra
+    random.seed(2)
+    index_numbers = [ random.randrange(n_spectra) for i in range(n_fetches) ]
+    t0 = timeit.default_timer()
+    for index_number in index_numbers:
+        spectrum_buffer = spectrum_library.get_spectrum(spectrum_index_number=index_number)
+    t1 = timeit.default_timer()
+    print(f"fetch: read {n_fetches} random spectra in {t1-t0:.3f} s ({(t1-t0)/n_fetches*1e6:.1f} us per spectrum)")
+
+    #### Repeat with the offset table loaded
+    t0 = timeit.default_timer()
+    spectrum_library.index.load_offset_table()
+    t1 = timeit.default_timer()
+    for index_number in index_numbers:
+        spectrum_buffer = spectrum_library.get_spectrum(spectrum_index_number=index_number)
+    t2 = timeit.default_timer()
+    print(f"fetch: loaded offset table in {t1-t0:.3f} s")
+    print(f"fetch: read {n_fetches} random spectra with the offset table in {t2-t1:.3f} s ({(t2-t1)/n_fetches*1e6:.1f} us per spectrum)")
+    spectrum_library.close()
+    return(t1-t0)
+
+
+#### Time precursor m/z window queries, one at a time in SQL and batched in numpy
+def benchmark_precursor(library_file, n_queries=10000, tolerance=20):
+    SpectrumLibraryModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    random.seed(3)
+    precursor_mzs = [ random.uniform(300, 1800) for i in range(n_queries) ]
+    charges = [ random.randint(1,4) for i in range(n_queries) ]
+
+    n_single_queries = min(n_queries, 1000)
+    t0 = timeit.default_timer()
+    for i_query in range(n_single_queries):
+        spectrum_library.index.find_offsets(precursor_mz=precursor_mzs[i_query], tolerance=tolerance, charge=charges[i_query])
+    t1 = timeit.default_timer()
+    print(f"precursor: {n_single_queries} single find_offsets() queries in {t1-t0:.3f} s ({n_single_queries/(t1-t0):.0f} queries/s)")
+
+    t0 = timeit.default_timer()
+    spectrum_library.index.get_precursor_table()
+    t1 = timeit.default_timer()
+    results = spectrum_library.index.find_offsets_batch(precursor_mzs, tolerance=tolerance, charges=charges)
+    t2 = timeit.default_timer()
+    n_matches = sum([ len(result) for result in results ])
+    print(f"precursor: loaded precursor table in {t1-t0:.3f} s")
+    print(f"precursor: {n_queries} batched queries with {n_matches} matches in {t2-t1:.3f} s ({n_queries/(t2-t1):.0f} queries/s)")
+    spectrum_library.close()
+    return(t2-t1)
+
+
+#### Time a sequential pass over the whole library compared with fetching each spectrum through the index
+def benchmark_iterate(library_file, n_fetches=10000):
+    SpectrumLibraryModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    n_fetches = min(n_fetches, spectrum_library.index.n_spectra)
+
+    t0 = timeit.default_timer()
+    for index_number in range(n_fetches):
+        spectrum_buffer = spectrum_library.get_spectrum(spectrum_index_number=index_number)
+    t1 = timeit.default_timer()
+    print(f"iterate: get_spectrum() for the first {n_fetches} spectra in {t1-t0:.3f} s ({n_fetches/(t1-t0):.0f} spectra/s)")
+
+    n_spectra = 0
+    t0 = timeit.default_timer()
+    for index_number, spectrum_buffer in spectrum_library.iter_spectra(parse=False):
+        n_spectra += 1
+    t1 = timeit.default_timer()
+    print(f"iterate: iter_spectra() over all {n_spectra} raw entries in {t1-t0:.3f} s ({n_spectra/(t1-t0):.0f} spectra/s)")
+
+    n_spectra = 0
+    t0 = timeit.default_timer()
+    for index_number, spectrum in spectrum_library.iter_spectra(stop=n_fetches):
+        n_spectra += 1
+    t1 = timeit.default_timer()
+    print(f"iterate: iter_spectra() parsing the first {n_spectra} spectra in {t1-t0:.3f} s ({n_spectra/(t1-t0):.0f} spectra/s)")
+    spectrum_library.close()
+    return(t1-t0)
+
+
+#### Time converting the whole library to another format, serially and with an increasing number of worker processes
+def benchmark_convert(library_file, workers=1, format='json'):
+    SpectrumLibraryModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    output_file = library_file + '.benchmark.' + format
+    t0 = timeit.default_timer()
+    n_spectra = spectrum_library.convert(output_filename=output_file, format=format)
+    t1 = timeit.default_timer()
+    print(f"convert: converted {n_spectra} spectra to {format} in {t1-t0:.3f} s ({n_spectra/(t1-t0):.0f} spectra/s)")
+
+    n_workers = 2
+    while n_workers <= workers:
+        t2 = timeit.default_timer()
+        spectrum_library.convert(output_filename=output_file, format=format, workers=n_workers)
+        t3 = timeit.default_timer()
+        print(f"convert: converted {n_spectra} spectra with {n_workers} workers in {t3-t2:.3f} s ({(t1-t0)/(t3-t2):.2f}x serial)")
+        n_workers *= 2
+    os.remove(output_file)
+    spectrum_library.close()
+    return(t1-t0)
+
+
+#### Time the conversion of foreign attributes into standard ones, separately from the rest of parsing
+def benchmark_attributes(library_file, n_spectra=10000, n_repeats=5):
+    SpectrumLibraryModule.debug = False
+    LibrarySpectrumModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    foreign_attributes_list = [ spectrum.foreign_attributes for index_number, spectrum in
+        spectrum_library.iter_spectra(stop=n_spectra, lazy_attributes=True) ]
+    spectrum_library.close()
+
+    best_time = None
+    for i_repeat in range(n_repeats):
+        t0 = timeit.default_timer()
+        for foreign_attributes in foreign_attributes_list:
+            spectrum = LibrarySpectrum()
+            spectrum.foreign_attributes = foreign_attributes
+            spectrum.convert_foreign_attributes()
+        t1 = timeit.default_timer()
+        if best_time is None or t1-t0 < best_time:
+            best_time = t1-t0
+    n_spectra = len(foreign_attributes_list)
+    print(f"attributes: converted attributes of {n_spectra} spectra in {best_time:.3f} s ({best_time/n_spectra*1e6:.1f} us per spectrum)")
+    return(best_time)
+
+
+#### Time the tokenizing of the Comment lines of the library into foreign attributes
+def benchmark_comments(library_file, n_comments=100000, n_repeats=5):
+    comments = []
+    with open(library_file) as infile:
+        for line in infile:
+            if line.startswith("Comment:"):
+                comments.append(line[8:].strip())
+                if len(comments) >= n_comments:
+                    break
+    if len(comments) == 0:
+        print("comments: no Comment lines found in the library")
+        return(None)
+
+    best_time = None
+    for i_repeat in range(n_repeats):
+        t0 = timeit.default_timer()
+        for comment in comments:
+            parse_comment(comment)
+        t1 = timeit.default_timer()
+        if best_time is None or t1-t0 < best_time:
+            best_time = t1-t0
+    n_characters = sum([ len(comment) for comment in comments ])
+    print(f"comments: tokenized {len(comments)} Comment lines ({n_characters/len(comments):.0f} characters on average) in {best_time:.3f} s " +
+        f"({best_time/len(comments)*1e6:.1f} us per line)")
+    return(best_time)
+
+
+#### Measure the memory needed to hold parsed spectra in memory
+def benchmark_memory(library_file, n_spectra=10000):
+    SpectrumLibraryModule.debug = False
+    LibrarySpectrumModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    buffers = [ spectrum_buffer for index_number, spectrum_buffer in spectrum_library.iter_spectra(stop=n_spectra, parse=False) ]
+    spectrum_library.close()
+
+    gc.collect()
+    tracemalloc.start()
+    spectra = [ LibrarySpectrum().parse(spectrum_buffer, spectrum_index=index_number) for index_number, spectrum_buffer in enumerate(buffers) ]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    size_per_spectrum = size / len(spectra)
+    print(f"memory: {len(spectra)} parsed spectra use {size/1e6:.1f} MB ({size_per_spectrum:.0f} bytes per spectrum, " +
+        f"{size_per_spectrum*500000/1e9:.2f} GB per 500k spectra)")
+    return(size_per_spectrum)
+
+
+#### Time building, saving, loading and filtering the columnar table of the library
+def benchmark_table(library_file):
+    SpectrumLibraryModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    t0 = timeit.default_timer()
+    table = spectrum_library.create_table()
+    t1 = timeit.default_timer()
+    print(f"table: built a table of {len(table)} spectra and {len(table.mzs)} peaks in {t1-t0:.3f} s ({len(table)/(t1-t0):.0f} spectra/s)")
+
+    t0 = timeit.default_timer()
+    table = spectrum_library.load_table(create=False)
+    t1 = timeit.default_timer()
+    print(f"table: loaded the saved table in {t1-t0:.3f} s")
+
+    t0 = timeit.default_timer()
+    selected = table.select(charge=2, min_precursor_mz=500, max_precursor_mz=700)
+    t1 = timeit.default_timer()
+    print(f"table: selected {len(selected)} spectra with their peaks in {(t1-t0)*1000:.1f} ms")
+    spectrum_library.close()
+    return(t1-t0)
+
+
+#### Time converting the library to the binary format and compare fetching spectra from it with parsing the MSP text
+def benchmark_binary(library_file, n_fetches=10000):
+    SpectrumLibraryModule.debug = False
+    LibrarySpectrumModule.debug = False
+    SpectrumLibraryBinaryModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    binary_file = library_file + '.benchmark.splbin'
+    t0 = timeit.default_timer()
+    n_spectra = spectrum_library.write(filename=binary_file, format='binary')
+    t1 = timeit.default_timer()
+    print(f"binary: wrote {n_spectra} spectra in {t1-t0:.3f} s ({os.path.getsize(binary_file)/1e6:.1f} MB)")
+
+    t0 = timeit.default_timer()
+    binary_library = BinarySpectrumLibrary(binary_file)
+    t1 = timeit.default_timer()
+    print(f"binary: opened binary library in {(t1-t0)*1000:.2f} ms")
+
+    random.seed(4)
+    index_numbers = [ random.randrange(n_spectra) for i in range(n_fetches) ]
+    spectrum_library.index.load_offset_table()
+    t0 = timeit.default_timer()
+    for index_number in index_numbers:
+        spectrum = LibrarySpectrum().parse(spectrum_library.get_spectrum(spectrum_index_number=index_number), spectrum_index=index_number)
+    t1 = timeit.default_timer()
+    print(f"binary: fetched and parsed {n_fetches} random MSP spectra in {t1-t0:.3f} s ({(t1-t0)/n_fetches*1e6:.1f} us per spectrum)")
+
+    t2 = timeit.default_timer()
+    for index_number in index_numbers:
+        spectrum = binary_library.get_spectrum(index_number)
+    t3 = timeit.default_timer()
+    print(f"binary: fetched {n_fetches} random binary spectra in {t3-t2:.3f} s ({(t3-t2)/n_fetches*1e6:.1f} us per spectrum, " +
+        f"{(t1-t0)/(t3-t2):.1f}x faster)")
+
+    t2 = timeit.default_timer()
+    for index_number in index_numbers:
+        mzs, intensities = binary_library.get_peaks(index_number)
+    t3 = timeit.default_timer()
+    print(f"binary: fetched {n_fetches} random binary peak arrays in {t3-t2:.3f} s ({(t3-t2)/n_fetches*1e6:.1f} us per spectrum)")
+    binary_library.close()
+    spectrum_library.close()
+    os.remove(binary_file)
+    return(t3-t2)
+
+
+#### Time writing already parsed spectra to a library file in each format, so that parsing is not included
+def benchmark_write(library_file, n_spectra=10000):
+    SpectrumLibraryModule.debug = False
+    LibrarySpectrumModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectra = list(spectrum_library.iter_spectra(stop=n_spectra))
+    output_file = library_file + '.benchmark.out'
+    for format in [ 'text', 'tsv', 'csv', 'msp', 'jsonl', 'json' ]:
+        t0 = timeit.default_timer()
+        spectrum_library.write(filename=output_file, format=format, spectra=iter(spectra))
+        t1 = timeit.default_timer()
+        size = os.path.getsize(output_file)
+        print(f"write: wrote {len(spectra)} spectra as {format} in {t1-t0:.3f} s ({len(spectra)/(t1-t0):.0f} spectra/s, " +
+            f"{size/1e6/(t1-t0):.1f} MB/s)")
+    os.remove(output_file)
+    spectrum_library.close()
+    return(t1-t0)
+
+
+#### Compare the size and speed of indented JSON with compact JSON from the standard encoder and the fast encoder
+def benchmark_json(library_file, n_spectra=10000):
+    SpectrumLibraryModule.debug = False
+    LibrarySpectrumModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectra = [ spectrum for index_number, spectrum in spectrum_library.iter_spectra(stop=n_spectra) ]
+    spectrum_library.close()
+
+    timings = {}
+    for mode in [ 'indented', 'compact', 'compact_fast' ]:
+        LibrarySpectrumModule.use_fast_json = ( mode == 'compact_fast' )
+        if mode == 'compact_fast' and LibrarySpectrumModule.orjson is None:
+            print("json: the fast encoder orjson is not installed")
+            continue
+        t0 = timeit.default_timer()
+        size = 0
+        for spectrum in spectra:
+            size += len(spectrum.write(format='json', compact=( mode != 'indented' )))
+        timings[mode] = timeit.default_timer() - t0
+        print(f"json: wrote {len(spectra)} spectra as {mode} JSON in {timings[mode]:.3f} s ({len(spectra)/timings[mode]:.0f} spectra/s, " +
+            f"{size/len(spectra)/1000:.1f} kB per spectrum)")
+    LibrarySpectrumModule.use_fast_json = True
+    return(timings)
+
+
+#### Time similarity searches of jittered copies of library spectra and check how often the original is the top hit
+def benchmark_search(library_file, n_queries=2000, seed=1):
+    SpectrumLibraryModule.debug = False
+    SpectrumLibrarySearchModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    table = spectrum_library.load_table()
+
+    random.seed(seed)
+    rows = [ row for row in random.sample(range(len(table)), min(n_queries, len(table))) if table.precursor_mz[row] == table.precursor_mz[row] ]
+    queries = []
+    for row in rows:
+        mzs, intensities = table.get_peaks(row)
+        mzs = [ mz + random.uniform(-0.01, 0.01) for mz in mzs ]
+        queries.append( (mzs, intensities, float(table.precursor_mz[row]), int(table.charge[row]) or None) )
+
+    t0 = timeit.default_timer()
+    spectrum_library.search_spectra(queries[:1])
+    t1 = timeit.default_timer()
+    print(f"search: binned the library for searching in {t1-t0:.3f} s")
+
+    timings = {}
+    for method in [ 'candidates', 'matrix' ]:
+        if method == 'matrix' and SpectrumLibrarySearchModule.scipy is None:
+            print("search: SciPy is not installed, so sparse matrix scoring is not available")
+            continue
+        t0 = timeit.default_timer()
+        hits = spectrum_library.search_spectra(queries, top_n=10, method=method)
+        timings[method] = timeit.default_timer() - t0
+        n_correct = sum( 1 for row, query_hits in zip(rows, hits) if len(query_hits) > 0 and query_hits[0][0] == int(table.number[row]) )
+        print(f"search: searched {len(queries)} queries by {method} in {timings[method]:.3f} s ({len(queries)/timings[method]:.0f} queries/s), " +
+            f"top hit is the original spectrum for {n_correct/max(len(queries),1)*100:.1f}%")
+    spectrum_library.close()
+    return(timings)
+
+
+#### Time the fragment ion prefilter and open searches of library spectra with part of their fragments shifted by a modification
+def benchmark_fragments(library_file, n_queries=1000, seed=1):
+    SpectrumLibraryModule.debug = False
+    SpectrumLibrarySearchModule.debug = False
+    SpectrumLibraryFragmentIndexModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    table = spectrum_library.load_table()
+
+    t0 = timeit.default_timer()
+    fragment_index = SpectrumLibraryFragmentIndex(spectrum_library=spectrum_library, use_saved_index=False)
+    t1 = timeit.default_timer()
+    print(f"fragments: built a fragment index of {len(fragment_index.numbers)} entries in {t1-t0:.3f} s")
+    fragment_index.save(library_file + '.splindex' + SpectrumLibraryFragmentIndexModule.fragment_index_suffix)
+    t0 = timeit.default_timer()
+    fragment_index = SpectrumLibraryFragmentIndex(spectrum_library=spectrum_library)
+    t1 = timeit.default_timer()
+    print(f"fragments: loaded the saved fragment index in {t1-t0:.3f} s")
+
+    random.seed(seed)
+    rows = random.sample(range(len(table)), min(n_queries, len(table)))
+    queries = []
+    for row in rows:
+        mzs, intensities = table.get_peaks(row)
+        shift = random.uniform(10, 200)
+        mzs = [ mz + shift if random.random() < 0.5 else mz for mz in mzs ]
+        queries.append( (mzs, intensities) )
+
+    t0 = timeit.default_timer()
+    n_candidates = 0
+    n_found = 0
+    for row, (mzs, intensities) in zip(rows, queries):
+        candidates = fragment_index.find_candidates(mzs, intensities=intensities, max_candidates=1000)
+        n_candidates += len(candidates)
+        n_found += int(table.number[row]) in candidates
+    t1 = timeit.default_timer()
+    print(f"fragments: prefiltered {len(queries)} queries in {(t1-t0)/len(queries)*1000:.2f} ms per query, {n_candidates/len(queries):.0f} " +
+        f"candidates per query, original spectrum among the candidates for {n_found/len(queries)*100:.1f}%")
+
+    spectrum_library.search_open(queries[:1])
+    t0 = timeit.default_timer()
+    hits = spectrum_library.search_open(queries)
+    t1 = timeit.default_timer()
+    n_correct = sum( 1 for row, query_hits in zip(rows, hits) if len(query_hits) > 0 and query_hits[0][0] == int(table.number[row]) )
+    print(f"fragments: open searched {len(queries)} queries in {t1-t0:.3f} s ({len(queries)/(t1-t0):.0f} queries/s), " +
+        f"top hit is the original spectrum for {n_correct/len(queries)*100:.1f}%")
+    spectrum_library.close()
+    return(t1-t0)
+
+
+#### Time fetching parsed spectra with a skewed popularity, as from a viewer or USI resolver, without and with the cache
+def benchmark_cache(library_file, n_fetches=20000, n_popular=1000):
+    SpectrumLibraryModule.debug = False
+    LibrarySpectrumModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    n_spectra = spectrum_library.index.n_spectra
+    random.seed(3)
+    popular_numbers = random.sample(range(n_spectra), n_popular)
+    index_numbers = [ popular_numbers[min(int(random.paretovariate(1.0)) - 1, n_popular - 1)] if random.random() < 0.9
+        else random.randrange(n_spectra) for i in range(n_fetches) ]
+
+    timings = {}
+    for mode in [ 'uncached', 'cached' ]:
+        spectrum_library.spectrum_cache = SpectrumLibraryCache() if mode == 'cached' else None
+        t0 = timeit.default_timer()
+        for index_number in index_numbers:
+            spectrum = spectrum_library.get_spectrum(spectrum_index_number=index_number, parse=True)
+        timings[mode] = timeit.default_timer() - t0
+        print(f"cache: fetched {n_fetches} parsed spectra {mode} in {timings[mode]:.3f} s ({timings[mode]/n_fetches*1e6:.1f} us per spectrum)")
+    statistics = spectrum_library.spectrum_cache.get_statistics()
+    print(f"cache: {statistics['hits']} hits, {statistics['misses']} misses ({statistics['hit_rate']*100:.1f}% hit rate), " +
+        f"{statistics['n_entries']} cached spectra using about {statistics['n_bytes']/1e6:.1f} MB")
+
+    t0 = timeit.default_timer()
+    for index_number in popular_numbers[:10] * 1000:
+        spectrum = spectrum_library.get_spectrum(spectrum_index_number=index_number, parse=True)
+    t1 = timeit.default_timer()
+    print(f"cache: fetched a cached spectrum in {(t1-t0)/10000*1e6:.2f} us")
+    spectrum_library.close()
+    return(timings)
+
+
+#### Time fetching a batch of random spectra with get_spectra() against calling get_spectrum() for each
+def benchmark_batch(library_file, n_fetches=10000):
+    SpectrumLibraryModule.debug = False
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    n_spectra = spectrum_library.index.n_spectra
+    random.seed(4)
+    index_numbers = [ random.randrange(n_spectra) for i in range(n_fetches) ]
+
+    t0 = timeit.default_timer()
+    spectrum_buffers = [ spectrum_library.get_spectrum(spectrum_index_number=index_number) for index_number in index_numbers ]
+    t1 = timeit.default_timer()
+    print(f"batch: read {n_fetches} random spectra with get_spectrum() in {t1-t0:.3f} s ({(t1-t0)/n_fetches*1e6:.1f} us per spectrum)")
+
+    t0 = timeit.default_timer()
+    batch_buffers = spectrum_library.get_spectra(index_numbers)
+    t1 = timeit.default_timer()
+    print(f"batch: read {n_fetches} random spectra with get_spectra() in {t1-t0:.3f} s ({(t1-t0)/n_fetches*1e6:.1f} us per spectrum)")
+    if batch_buffers != spectrum_buffers:
+        print("ERROR: get_spectra() returned different entries than get_spectrum()")
+
+    spectrum_library.spectrum_cache = None
+    t0 = timeit.default_timer()
+    spectra = spectrum_library.get_spectra(index_numbers, parse=True)
+    t1 = timeit.default_timer()
+    print(f"batch: read and parsed {n_fetches} random spectra with get_spectra() in {t1-t0:.3f} s ({(t1-t0)/n_fetches*1e6:.1f} us per spectrum)")
+    spectrum_library.close()
+    return(t1-t0)
+
+
+def main():
+
+    argparser = argparse.ArgumentParser(description='Benchmarks for reading, indexing and accessing spectral libraries')
+
+    argparser.add_argument('--library_file', action='store', help="Name of the library file to benchmark against")
+    argparser.add_argument('--n_spectra', action='store', type=int, default=100000,
+        help="If --library_file does not exist, first write a synthetic library with this many spectra")
+    argparser.add_argument('--test', action='store', default='index', help="Benchmark to run (one of 'index', 'fetch', 'precursor', 'iterate', 'convert', 'attributes', 'comments', 'memory', 'table', 'binary', 'write', 'json', 'search', 'fragments', 'cache', 'batch')")
+    argparser.add_argument('--workers', action='store', type=int, default=1,
+        help="Maximum number of worker processes for the parallel benchmarks (doubling from 2)")
+
+    argparser.add_argument('--version', action='version', version='%(prog)s 0.5')
+    params = argparser.parse_args()
+
+    #### Ensure that library_file was passed
+    if params.library_file is None or params.library_file == "":
+        print("ERROR: Parameter --library_file must be provided. See --help for more information")
+        return()
+
+    if not os.path.isfile(params.library_file):
+        eprint(f"INFO: Writing synthetic library with {params.n_spectra} spectra to '{params.library_file}'")
+        write_synthetic_library(params.library_file, params.n_spectra)
+
+    if params.test == 'index':
+        benchmark_index(params.library_file, workers=params.workers)
+    elif params.test == 'fetch':
+        benchmark_fetch(params.library_file)
+    elif params.test == 'precursor':
+        benchmark_precursor(params.library_file)
+    elif params.test == 'iterate':
+        benchmark_iterate(params.library_file)
+    elif params.test == 'convert':
+        benchmark_convert(params.library_file, workers=params.workers)
+    elif params.test == 'attributes':
+        benchmark_attributes(params.library_file)
+    elif params.test == 'comments':
+        benchmark_comments(params.library_file)
+    elif params.test == 'memory':
+        benchmark_memory(params.library_file)
+    elif params.test == 'table':
+        benchmark_table(params.library_file)
+    elif params.test == 'binary':
+        benchmark_binary(params.library_file)
+    elif params.test == 'write':
+        benchmark_write(params.library_file)
+    elif params.test == 'json':
+        benchmark_json(params.library_file)
+    elif params.test == 'search':
+        benchmark_search(params.library_file)
+    elif params.test == 'fragments':
+        benchmark_fragments(params.library_file)
+    elif params.test == 'cache':
+        benchmark_cache(params.library_file)
+    elif params.test == 'batch':
+        benchmark_batch(params.library_file)
+    else:
+        print(f"ERROR: Unrecognized test '{params.test}'. See --help for more information")
+
+if __name__ == "__main__": main()
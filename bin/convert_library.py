@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
+
+import os
+import argparse
+import os.path
+import timeit
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../lib")
+from SpectrumLibrary import SpectrumLibrary
+
+def main():
+
+    argparser = argparse.ArgumentParser(description='Converts all spectra of an MSP spectral library file to another format')
+
+    argparser.add_argument('--library_file', action='store', help='Name of the library to convert')
+    argparser.add_argument('--output_file', action='store', help='Name of the file to write')
+    argparser.add_argument('--output_format', action='store', default='text', help="Format to write (one of 'text', 'tsv', 'csv', 'json', 'jsonl', 'msp', 'binary')")
+    argparser.add_argument('--workers', action='store', type=int, default=1, help='Number of processes to use (default 1)')
+    argparser.add_argument('--batch_size', action='store', type=int, default=1000, help='Number of spectra sent to a process at a time')
+
+    argparser.add_argument('--version', action='version', version='%(prog)s 0.5')
+    params = argparser.parse_args()
+
+    #### Ensure that library_file and output_file were passed
+    if params.library_file is None or params.library_file == "":
+        print("ERROR: Parameter --library_file must be provided. See --help for more information")
+        return()
+    if params.output_file is None or params.output_file == "":
+        print("ERROR: Parameter --output_file must be provided. See --help for more information")
+        return()
+
+    if not os.path.isfile(params.library_file):
+        eprint(f"ERROR: File '{params.library_file}' not found or not a file")
+        return()
+
+    spectrum_library = SpectrumLibrary()
+    spectrum_library.filename = params.library_file
+
+    t0 = timeit.default_timer()
+    if params.output_format == 'binary':
+        n_spectra = spectrum_library.write(filename=params.output_file, format='binary')
+    else:
+        n_spectra = spectrum_library.convert(output_filename=params.output_file, format=params.output_format, workers=params.workers,
+            batch_size=params.batch_size)
+    t1 = timeit.default_timer()
+    print(f"INFO: Converted {n_spectra} spectra")
+    print('INFO: Elapsed time: ' + str(t1-t0))
+
+if __name__ == "__main__": main()
@@ -17,6 +17,9 @@ def main():
     argparser.add_argument('--library_file', action='store',
         help='Name of the library to index')
 
+    argparser.add_argument('--workers', action='store', type=int, default=1,
+        help='Number of processes to use to scan the library (default 1)')
+
     argparser.add_argument('--version', action='version', version='%(prog)s 0.5')
     params = argparser.parse_args()
 
@@ -33,7 +36,7 @@ def main():
     spectrum_library.filename = params.library_file
 
     t0 = timeit.default_timer()
-    spectrum_library.create_index()
+    spectrum_library.create_index(workers=params.workers)
     t1 = timeit.default_timer()
     print()
     print('INFO: Elapsed time: ' + str(t1-t0))
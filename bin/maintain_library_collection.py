@@ -230,9 +230,22 @@ def main():
             if filename in local_file_dict:
                 print(f"  - Processing {filename}")
 
-                #### Check to see if there is an index file yet
+                #### Check to see if there is an index file yet, and whether the library has changed since it was indexed
                 if os.path.exists(f"{collection_dir}/{filename}.splindex"):
-                    print("  - Index already exists")
+                    spectrum_library = SpectrumLibrary(filename=f"{collection_dir}/{filename}")
+                    library_state = spectrum_library.index.library_state
+                    if library_state == 'current':
+                        print("  - Index already exists and is up to date")
+                    else:
+                        if library_state == 'appended':
+                            print("  - Library has been appended to. Indexing the new entries")
+                        else:
+                            print(f"  - Index is out of date (library state is '{library_state}'). Re-creating the index")
+                        t0 = timeit.default_timer()
+                        spectrum_library.update_index()
+                        t1 = timeit.default_timer()
+                        print(f"\n  - Elapsed time: {t1-t0}")
+                    spectrum_library.close()
                 else:
                     print("  - Need to create an index")
                     spectrum_library = SpectrumLibrary()
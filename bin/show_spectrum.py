@@ -25,6 +25,7 @@ def main():
 
     argparser.add_argument('--library_file', action='store', help="Name of the library file to access")
     argparser.add_argument('--index_number', action='store', help="Index number of the spectrum to display")
+    argparser.add_argument('--spectrum_name', action='store', help="Name of the spectrum to display (e.g. PEPTIDE/2) instead of --index_number")
     argparser.add_argument('--usi', action='store', help="Universal Spectrum Identifier of the spectrum to display")
     argparser.add_argument('--output_format', action='store', default='text', help="Format use when writing the spectrum (one of 'text', 'json', 'msp')")
 
@@ -43,8 +44,8 @@ def main():
             print("ERROR: Parameter --usi or --library_file must be provided. See --help for more information")
             return()
 
-        if params.index_number is None or params.index_number == "":
-            print("ERROR: Parameter --usi or index_number must be provided. See --help for more information")
+        if ( params.index_number is None or params.index_number == "" ) and ( params.spectrum_name is None or params.spectrum_name == "" ):
+            print("ERROR: Parameter --usi, --index_number or --spectrum_name must be provided. See --help for more information")
             return()
 
     #### If there was a USI, then parse it
@@ -72,7 +73,13 @@ def main():
     spectrum_library = SpectrumLibrary()
     spectrum_library.filename = library_file
 
-    spectrum_buffer = spectrum_library.get_spectrum(spectrum_index_number=index_number)
+    if index_number is None or index_number == "":
+        spectrum_buffer = spectrum_library.get_spectrum(spectrum_name=params.spectrum_name)
+    else:
+        spectrum_buffer = spectrum_library.get_spectrum(spectrum_index_number=index_number)
+    if not spectrum_buffer:
+        print("ERROR: Unable to find the requested spectrum in the library")
+        return()
     spectrum = LibrarySpectrum()
     spectrum.parse(spectrum_buffer, spectrum_index=index_number)
     buffer = spectrum.write(format=params.output_format)
@@ -6,12 +6,357 @@ def eprint(*args, **kwargs):
 
 import re
 import json
+import array
+
+import numpy as np
+
+#### Use the faster orjson encoder for compact JSON if it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 debug = True
 
+#### Set to False to always encode compact JSON with the standard json module
+use_fast_json = True
+
+
+#### Encode an object as compact JSON on one line, without sorting the keys
+def encode_compact_json(data):
+    if orjson is not None and use_fast_json:
+        return(orjson.dumps(data).decode('utf-8'))
+    return(json.dumps(data, separators=(',',':'), ensure_ascii=False))
+
+#### Rules for converting foreign attributes into standard ones, built once when the module is loaded.
+#### A mapping in other_terms is either the CV term that replaces the key, a [ key, value ] pair to
+#### add when the attribute has no value, or a dict of allowed values to lists of [ key, value ] pairs
+leader_terms = {
+    "Name": "MS:1008013|spectrum name",
+}
+other_terms = {
+    "MW": "MS:1008010|molecular mass",
+    "ExactMass": "MS:1008010|molecular mass",
+    "Charge": "MS:1000041|charge state",
+    "Parent": "MS:1000744|selected ion m/z",
+    "ObservedPrecursorMZ": "MS:1000744|selected ion m/z",
+    "Single": [ "MS:1008015|spectrum aggregation type", "MS:1008016|singleton spectrum" ],
+    "Consensus": [ "MS:1008015|spectrum aggregation type", "MS:1008017|consensus spectrum" ],
+    "PrecursorMonoisoMZ": "MS:1008032|theoretical monoisotopic m/z",
+    "Mz_exact": "MS:1008032|theoretical monoisotopic m/z",
+    "Mz_av": "MS:1008033|theoretical average m/z",
+    "Inst": { "it": [ [ "MS:1000044|dissociation method", "MS:1002472|trap-type collision-induced dissociation" ] ],
+              "hcd": [ [ "MS:1000044|dissociation method", "MS:1000422|beam-type collision-induced dissociation" ] ],
+              "QExactive": [ [ "MS:1000031|instrument model", "MS:1001911|Q Exactive" ] ] },
+    "Pep": { "Tryptic": [ [ "MS:1008030|number of enzymatic termini", 2 ], [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
+             "N-Semitryptic": [ [ "MS:1008030|number of enzymatic termini", 1 ], [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
+             "C-Semitryptic": [ [ "MS:1008030|number of enzymatic termini", 1 ], [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
+             "Tryptic/miss_good_confirmed": [ [ "MS:1008030|number of enzymatic termini", 2 ],
+                [ "MS:1008034|number of missed cleavages", "0" ],
+                [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
+             "Tryptic/miss_bad_confirmed": [ [ "MS:1008030|number of enzymatic termini", 2 ],
+                [ "MS:1008034|number of missed cleavages", ">0" ],
+                [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
+            },
+    "Spec": { "Consensus": [ [ "MS:1008015|spectrum aggregation type", "MS:1008017|consensus spectrum" ] ] },
+    "Scan": "MS:1008035|scan number",
+    "Origfile": "MS:1009008|source file",
+    "Sample": "MS:1000002|sample name",
+    "Filter": "MS:1000512|filter string",
+    "FTResolution": "MS:1000028|detector resolution",
+    "Protein": "MS:1000885|protein accession",
+    "ms1PrecursorAb": "MS:1009010|previous MS1 scan precursor intensity",
+    "Precursor1MaxAb": "MS:1009011|precursor apex intensity",
+    "Purity": "MS:1009013|isolation window precursor purity",
+    "Unassigned": "MS:1008027|top 20 peak unassigned intensity fraction",
+    "Unassign_all": "MS:1008025|total unassigned intensity fraction",
+    "Protein": "MS:1000885|protein accession",
+    "Mods": "MS:1001471|peptide modification details",
+    "BasePeak": "MS:1000505|base peak intensity",
+    "Naa": "MS:1008027|number of residues",
+    "Num peaks": "MS:1008040|number of peaks",
+}
+
+species_map = {
+    "human": [ [ "MS:1001467|taxonomy: NCBI TaxID", "NCBITaxon:9606|Homo sapiens" ],
+        ["MS:1001469|taxonomy: scientific name", "Homo sapiens" ],
+        ["MS:1001468|taxonomy: common name", "human" ] ],
+    "zebrafish": [ [ "MS:1001467|taxonomy: NCBI TaxID", "NCBITaxon:7955|Danio rerio" ],
+        ["MS:1001469|taxonomy: scientific name", "Danio rerio" ],
+        ["MS:1001468|taxonomy: common name", "zebra fish" ] ],
+    "chicken": [ [ "MS:1001467|taxonomy: NCBI TaxID", "NCBITaxon:9031|Gallus gallus" ],
+        ["MS:1001469|taxonomy: scientific name", "Gallus gallus" ],
+        ["MS:1001468|taxonomy: common name", "chicken" ] ],
+    }
+
+#### Split the Comment line of an MSP entry into key=value items in a single pass over its space-separated
+#### tokens, storing each value (or None for an item without an =) under its key in foreign_attributes.
+#### Tokens are only re-joined while inside a quoted value, so that spaces within quotes are preserved
+def parse_comment(comment, foreign_attributes=None):
+    if foreign_attributes is None:
+        foreign_attributes = {}
+    quoted_tokens = None
+    for item in comment.split(" "):
+
+        #### If inside a quoted value, collect tokens until one closes the quotes
+        if quoted_tokens is not None:
+            quoted_tokens.append(item)
+            if item.count('"') % 2 == 0:
+                continue
+            item = " ".join(quoted_tokens)
+            quoted_tokens = None
+
+        #### Or if this token opens a quoted value, start collecting
+        elif '"' in item and item.count('"') % 2 == 1:
+            quoted_tokens = [ item ]
+            continue
+
+        #### Skip empty items from repeated spaces
+        elif item == "":
+            continue
+
+        key, separator, value = item.partition("=")
+        if separator:
+            foreign_attributes[key] = value
+        else:
+            foreign_attributes[item] = None
+
+    #### If a quote was never closed, keep the rest of the line as one item
+    if quoted_tokens is not None:
+        item = " ".join(quoted_tokens)
+        key, separator, value = item.partition("=")
+        if separator:
+            foreign_attributes[key] = value
+        else:
+            foreign_attributes[item] = None
+
+    return(foreign_attributes)
+
+
+#### Precompiled patterns for the values of the attributes that need special logic
+collision_energy_ev_regex = re.compile(r"([\d\.]+)\s*ev", flags=re.IGNORECASE)
+collision_energy_percent_regex = re.compile(r"([\d\.]+)\s*%")
+number_regex = re.compile(r"([\d\.]+)")
+retention_time_regex = re.compile(r"([\d\.]+)\s*(\D*)")
+mz_diff_ppm_regex = re.compile(r"([\-\+e\d\.]+)\s*ppm", flags=re.IGNORECASE)
+mz_diff_regex = re.compile(r"([\-\+e\d\.]+)\s*")
+fullname_regex = re.compile(r"([A-Z\-\*])\.([A-Z]+)\.([A-Z\-\*])/*([\d]*)")
+replicates_regex = re.compile(r"(\d+)/(\d+)")
+integer_regex = re.compile(r"(\d+)")
+name_charge_regex = re.compile(r"(.+)/(\d+)")
+
+
+#### Converters for the attributes that need special logic. Each is called with the spectrum, the
+#### attribute name and its value, and returns False if the attribute could not be interpreted
+
+#### Expand the HCD attribute
+def convert_hcd_attribute(spectrum, attribute, value):
+    spectrum.add_attribute("MS:1000044|dissociation method", "MS:1000422|beam-type collision-induced dissociation")
+    if value is None:
+        spectrum.add_attribute("ERROR", f"Attribute {attribute} must have a value")
+        return(False)
+    found_match = 0
+    match = collision_energy_ev_regex.match(value)
+    if match is not None:
+        found_match = 1
+        group_identifier = spectrum.get_next_group_identifier()
+        spectrum.add_attribute("MS:1000045|collision energy", match.group(1), group_identifier)
+        spectrum.add_attribute("UO:0000000|unit", "UO:0000266|electronvolt", group_identifier)
+    match = collision_energy_percent_regex.match(value)
+    if match is not None:
+        found_match = 1
+        group_identifier = spectrum.get_next_group_identifier()
+        spectrum.add_attribute("MS:1000045|collision energy", match.group(1), group_identifier)
+        spectrum.add_attribute("UO:0000000|unit", "UO:0000187|percent", group_identifier)
+    if found_match == 0:
+        spectrum.add_attribute("ERROR", f"Unable to parse {value} in {attribute}")
+        return(False)
+    return(True)
+
+
+#### Expand the Collision_energy attribute
+def convert_collision_energy_attribute(spectrum, attribute, value):
+    match = number_regex.match(value)
+    if match is None:
+        spectrum.add_attribute("ERROR", f"Unable to parse {value} in {attribute}")
+        return(False)
+    group_identifier = spectrum.get_next_group_identifier()
+    spectrum.add_attribute("MS:1000045|collision energy", match.group(1), group_identifier)
+    spectrum.add_attribute("UO:0000000|unit", "UO:0000266|electronvolt", group_identifier)
+    return(True)
+
+
+#### Expand the RT attribute
+def convert_retention_time_attribute(spectrum, attribute, value):
+    match = retention_time_regex.match(value)
+    if match is None:
+        spectrum.add_attribute("ERROR", f"Unable to parse {value} in {attribute}")
+        return(False)
+    if match.group(2):
+        spectrum.add_attribute("ERROR", f"Need more RT parsing code to handle this value")
+        return(False)
+    group_identifier = spectrum.get_next_group_identifier()
+    spectrum.add_attribute("MS:1000894|retention time", match.group(1), group_identifier)
+    #### If the value is greater than 250, assume it must be seconds
+    if float(match.group(1)) > 250:
+        spectrum.add_attribute("UO:0000000|unit", "UO:0000010|second", group_identifier)
+    #### Although normally assume minutes
+    else:
+        spectrum.add_attribute("UO:0000000|unit", "UO:0000031|minute", group_identifier)
+    return(True)
+
+
+#### Expand the ms2IsolationWidth attribute
+def convert_isolation_width_attribute(spectrum, attribute, value):
+    group_identifier = spectrum.get_next_group_identifier()
+    spectrum.add_attribute("MS:1000828|isolation window lower offset", str(float(value)/2), group_identifier)
+    spectrum.add_attribute("UO:0000000|unit", "MS:1000040|m/z", group_identifier)
+    group_identifier = spectrum.get_next_group_identifier()
+    spectrum.add_attribute("MS:1000829|isolation window upper offset", str(float(value)/2), group_identifier)
+    spectrum.add_attribute("UO:0000000|unit", "MS:1000040|m/z", group_identifier)
+    return(True)
+
+
+#### Expand the Mz_diff attribute
+def convert_mz_diff_attribute(spectrum, attribute, value):
+    match = mz_diff_ppm_regex.match(value)
+    if match is not None:
+        group_identifier = spectrum.get_next_group_identifier()
+        spectrum.add_attribute("MS:1001975|delta m/z", match.group(1), group_identifier)
+        spectrum.add_attribute("UO:0000000|unit", "UO:0000169|parts per million", group_identifier)
+        return(True)
+    match = mz_diff_regex.match(value)
+    if match is not None:
+        group_identifier = spectrum.get_next_group_identifier()
+        spectrum.add_attribute("MS:1001975|delta m/z", match.group(1), group_identifier)
+        spectrum.add_attribute("UO:0000000|unit", "MS:1000040|m/z", group_identifier)
+        return(True)
+    spectrum.add_attribute("ERROR", f"Unable to parse {value} in {attribute}")
+    return(False)
+
+
+#### Expand the Dev_ppm attribute
+def convert_dev_ppm_attribute(spectrum, attribute, value):
+    group_identifier = spectrum.get_next_group_identifier()
+    spectrum.add_attribute("MS:1001975|delta m/z", value, group_identifier)
+    spectrum.add_attribute("UO:0000000|unit", "UO:0000169|parts per million", group_identifier)
+    return(True)
+
+
+#### Expand the Fullname attribute
+def convert_fullname_attribute(spectrum, attribute, value):
+    match = fullname_regex.match(value)
+    if match is None:
+        spectrum.add_attribute("ERROR", f"Unable to parse {value} in {attribute} at E2355")
+        return(False)
+    spectrum.add_attribute("MS:1000888|unmodified peptide sequence", match.group(2))
+    spectrum.add_attribute("MS:1001112|n-terminal flanking residue", match.group(1))
+    spectrum.add_attribute("MS:1001113|c-terminal flanking residue", match.group(3))
+    if match.group(4):
+        spectrum.add_attribute("MS:1000041|charge state", match.group(4))
+    return(True)
+
+
+#### Expand the Nrep attribute
+def convert_replicates_attribute(spectrum, attribute, value):
+    match = replicates_regex.match(value)
+    if match is not None:
+        spectrum.add_attribute("MS:1009020|number of replicate spectra used", match.group(1))
+        spectrum.add_attribute("MS:1009021|number of replicate spectra available", match.group(2))
+        return(True)
+    match = integer_regex.match(value)
+    if match is not None:
+        spectrum.add_attribute("MS:1008020|number of replicate spectra used", match.group(1))
+        spectrum.add_attribute("MS:1008019|number of replicate spectra available", match.group(1))
+        return(True)
+    spectrum.add_attribute("ERROR", f"Unable to parse {value} in {attribute} at E2455")
+    return(False)
+
+
+#### Expand the Organism attribute
+def convert_organism_attribute(spectrum, attribute, value):
+    items = species_map.get(value.strip('"'))
+    if items is None:
+        spectrum.add_attribute("ERROR", f"Unable to parse {value} in {attribute} at E2355")
+        return(False)
+    group_identifier = spectrum.get_next_group_identifier()
+    for item in items:
+        spectrum.add_attribute(item[0],item[1],group_identifier)
+    return(True)
+
+
+#### Dispatch table of the attributes that need special logic to their converters
+special_attribute_converters = {
+    "HCD": convert_hcd_attribute,
+    "Collision_energy": convert_collision_energy_attribute,
+    "RT": convert_retention_time_attribute,
+    "ms2IsolationWidth": convert_isolation_width_attribute,
+    "Mz_diff": convert_mz_diff_attribute,
+    "Dev_ppm": convert_dev_ppm_attribute,
+    "Fullname": convert_fullname_attribute,
+    "Nrep": convert_replicates_attribute,
+    "Nreps": convert_replicates_attribute,
+    "Organism": convert_organism_attribute,
+}
+
+#### Converters that handle a missing value themselves
+special_attributes_without_values = { "HCD" }
+
+#### Attributes that hold the precursor m/z and charge of a spectrum, in order of preference
+precursor_mz_keys = [ "MS:1000744|selected ion m/z", "MS:1008032|theoretical monoisotopic m/z" ]
+charge_keys = [ "MS:1000041|charge state" ]
+
+#### MSP keys for each CV term that is a plain substitution of a key in other_terms, in order of preference,
+#### used when writing MSP. Later keys are used when the same term occurs more than once
+msp_keys = {}
+for msp_key, mapping in other_terms.items():
+    if type(mapping) is str and msp_key not in msp_keys.get(mapping, []):
+        msp_keys.setdefault(mapping, []).append(msp_key)
+
+#### Reverse rules for the attributes that came from an option of a key in other_terms or from the Organism,
+#### as [ MSP key, MSP value or None, list of [ key, value ] items ], with the rules of the most items first.
+#### Rules of a single item match an attribute outside of a group, others match the items of one group
+msp_option_rules = []
+for msp_key, mapping in other_terms.items():
+    if type(mapping) is list:
+        msp_option_rules.append( [ msp_key, None, [ mapping ] ] )
+    elif type(mapping) is dict:
+        for msp_value, items in mapping.items():
+            msp_option_rules.append( [ msp_key, msp_value, items ] )
+for msp_value, items in species_map.items():
+    msp_option_rules.append( [ "Organism", msp_value, items ] )
+msp_option_rules.sort(key=lambda rule: -len(rule[2]))
+msp_option_items = {}
+for rule in msp_option_rules:
+    if len(rule[2]) == 1:
+        msp_option_items.setdefault( (rule[2][0][0], str(rule[2][0][1])), [] ).append(rule)
+
+#### Attributes that are not written to the Comment line because they are written elsewhere or recreated when reading
+msp_skipped_keys = { "MS:1008013|spectrum name", "MS:1008014|spectrum index", "MS:1008040|number of peaks", "ERROR" }
+
+
+#### Attribute keys are interned: each distinct key is stored once here and spectra refer to it by a small integer code
+attribute_keys = []
+attribute_key_codes = {}
+
+
+#### Get the code of an attribute key, assigning the next one if the key has not been seen before
+def get_attribute_key_code(key):
+    code = attribute_key_codes.get(key)
+    if code is None:
+        code = len(attribute_keys)
+        attribute_keys.append(key)
+        attribute_key_codes[key] = code
+    return(code)
+
+
 #A class that holds data for each spectrum that is read from the SpectralLibrary class
 class LibrarySpectrum:
 
+    #### Fixed set of instance variables so that large numbers of spectra can be held in memory compactly
+    __slots__ = [ 'attribute_codes', 'attribute_values', 'attribute_groups', 'conversion_pending', 'mzs', 'intensities',
+        'interpretation_buffer', 'interpretation_offsets', 'group_counter', 'foreign_attributes' ]
+
     #### Constructor
     def __init__(self):
         """
@@ -22,17 +367,122 @@ class LibrarySpectrum:
 
         """
 
-        self.attributes = []
-        self.attribute_dict = {}
-        self.group_dict = {}
+        #### The standard attributes are stored as flat parallel arrays of interned key codes, values and
+        #### group numbers (0 for none), and exposed through the attributes, attribute_dict and group_dict properties
+        self.attribute_codes = array.array('I')
+        self.attribute_values = []
+        self.attribute_groups = array.array('I')
+
+        #### If set, the foreign attributes have not yet been converted into standard ones
+        self.conversion_pending = False
 
-        self.peak_list = []
+        #### Peaks are stored as parallel arrays, with all interpretations concatenated into one string
+        self.mzs = np.zeros(0, dtype=np.float64)
+        self.intensities = np.zeros(0, dtype=np.float32)
+        self.interpretation_buffer = ""
+        self.interpretation_offsets = np.zeros(1, dtype=np.int32)
         self.group_counter = 1
 
         #### When ingesting a foreign format, temporarily store those foreign attributes here
         self.foreign_attributes = {}
 
 
+    #### Convert any pending foreign attributes before the standard attributes are used
+    def convert_pending_attributes(self):
+        if self.conversion_pending:
+            self.convert_foreign_attributes()
+
+
+    #### The list of [ key, value, group ] standard attributes. This is built on each access,
+    #### so use add_attribute() rather than modifying the returned list
+    @property
+    def attributes(self):
+        if self.conversion_pending:
+            self.convert_pending_attributes()
+        attributes = []
+        for code, value, group in zip(self.attribute_codes, self.attribute_values, self.attribute_groups):
+            if group:
+                attributes.append( [ attribute_keys[code], value, str(group) ] )
+            else:
+                attributes.append( [ attribute_keys[code], value ] )
+        return(attributes)
+
+    @attributes.setter
+    def attributes(self, attributes):
+        self.clear_attributes()
+        for attribute in attributes:
+            self.add_attribute(*attribute)
+
+
+    #### Lookup of attribute key to the indexes and groups of its entries in the attributes list
+    @property
+    def attribute_dict(self):
+        if self.conversion_pending:
+            self.convert_pending_attributes()
+        attribute_dict = {}
+        for index, (code, group) in enumerate(zip(self.attribute_codes, self.attribute_groups)):
+            key = attribute_keys[code]
+            lookup = attribute_dict.get(key)
+            if lookup is None:
+                lookup = { "indexes": [], "groups": [] }
+                attribute_dict[key] = lookup
+            lookup["indexes"].append(index)
+            if group:
+                lookup["groups"].append(str(group))
+        return(attribute_dict)
+
+
+    #### Lookup of group identifier to the indexes of its entries in the attributes list
+    @property
+    def group_dict(self):
+        if self.conversion_pending:
+            self.convert_pending_attributes()
+        group_dict = {}
+        for index, group in enumerate(self.attribute_groups):
+            if group:
+                group_dict.setdefault(str(group), []).append(index)
+        return(group_dict)
+
+
+    #### Get the list of values of all attributes with the specified key
+    def get_attribute_values(self, key):
+        if self.conversion_pending:
+            self.convert_pending_attributes()
+        code = attribute_key_codes.get(key)
+        if code is None:
+            return([])
+        return( [ value for attribute_code, value in zip(self.attribute_codes, self.attribute_values) if attribute_code == code ] )
+
+
+    #### Return the first value of any of the keys that can be interpreted with the converter, or the default
+    def get_first_attribute_value(self, keys, converter=str, default=None):
+        for key in keys:
+            for value in self.get_attribute_values(key):
+                try:
+                    return(converter(value))
+                except (TypeError, ValueError):
+                    continue
+        return(default)
+
+
+    #### Return the precursor m/z of the spectrum, or None if it is not known
+    def get_precursor_mz(self):
+        return(self.get_first_attribute_value(precursor_mz_keys, float))
+
+
+    #### Return the precursor charge of the spectrum, or None if it is not known
+    def get_charge(self):
+        return(self.get_first_attribute_value(charge_keys, int))
+
+
+    #### Remove all standard attributes
+    def clear_attributes(self):
+        self.attribute_codes = array.array('I')
+        self.attribute_values = []
+        self.attribute_groups = array.array('I')
+        self.group_counter = 1
+
+
     #### Get the next group identifier
     def get_next_group_identifier(self):
         next = self.group_counter
@@ -40,49 +490,88 @@ class LibrarySpectrum:
         return(str(next))
 
 
-    #### Add an attribute to the list and update the lookup tables
+    #### Set the peaks from lists of m/z values, intensities and interpretations (numbers or strings)
+    def set_peaks(self, mzs, intensities, interpretations=None):
+        self.mzs = np.array(mzs, dtype=np.float64)
+        self.intensities = np.array(intensities, dtype=np.float32)
+        if interpretations is None:
+            interpretations = [ "" ] * len(self.mzs)
+        self.interpretation_buffer = "".join(interpretations)
+        offsets = np.zeros(len(interpretations) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum([ len(interpretation) for interpretation in interpretations ])
+        self.interpretation_offsets = offsets
+
+
+    #### Get the interpretation string of one peak
+    def get_interpretation(self, index):
+        return(self.interpretation_buffer[self.interpretation_offsets[index]:self.interpretation_offsets[index+1]])
+
+
+    #### Get the interpretation strings of all peaks as a list
+    def get_interpretations(self):
+        offsets = self.interpretation_offsets.tolist()
+        buffer = self.interpretation_buffer
+        return( [ buffer[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1) ] )
+
+
+    #### Get the m/z values and intensities of all peaks as lists of strings for text output
+    def get_peak_strings(self):
+        mzs = [ repr(mz) for mz in self.mzs.tolist() ]
+        intensities = [ f"{intensity:.7g}" for intensity in self.intensities.tolist() ]
+        return(mzs, intensities)
+
+
+    #### Number of peaks in the spectrum
+    @property
+    def n_peaks(self):
+        return(len(self.mzs))
+
+
+    #### The peaks as a list of [ mz, intensity, interpretation ] strings, as they were stored before the peak arrays
+    @property
+    def peak_list(self):
+        mzs, intensities = self.get_peak_strings()
+        return( [ list(peak) for peak in zip(mzs, intensities, self.get_interpretations()) ] )
+
+
+    #### Estimate the memory used by the spectrum in bytes, e.g. for limiting the size of a cache
+    def get_memory_size(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.attribute_codes) + sys.getsizeof(self.attribute_groups)
+        size += sys.getsizeof(self.attribute_values) + sum( [ sys.getsizeof(value) for value in self.attribute_values ] )
+        size += self.mzs.nbytes + self.intensities.nbytes + self.interpretation_offsets.nbytes + sys.getsizeof(self.interpretation_buffer)
+        if self.foreign_attributes:
+            size += sys.getsizeof(self.foreign_attributes) + sum( [ sys.getsizeof(key) + sys.getsizeof(value)
+                for key, value in self.foreign_attributes.items() ] )
+        return(size)
+
+
+    #### Add an attribute to the flat attribute arrays
     def add_attribute(self, key, value, group_identifier=None):
-        items = [ key, value ]
-        if group_identifier is not None:
-            items.append(group_identifier)
-        self.attributes.append(items)
-        index = len(self.attributes)-1
-
-        #### If there is already one of these, add it to the lists in attribute_dict
-        if key in self.attribute_dict:
-            self.attribute_dict[key]["indexes"].append(index)
-            if group_identifier is not None:
-                self.attribute_dict[key]["groups"].append(group_identifier)
-
-        #### Otherwise, create the entry in attribute_dict
+        code = attribute_key_codes.get(key)
+        if code is None:
+            code = get_attribute_key_code(key)
+        self.attribute_codes.append(code)
+        self.attribute_values.append(value)
+        if group_identifier is None:
+            self.attribute_groups.append(0)
         else:
-            if group_identifier is not None:
-                self.attribute_dict[key] = { "indexes": [ index ], "groups": [ group_identifier ] }
-            else:
-                self.attribute_dict[key] = { "indexes": [ index ], "groups": [ ] }
-
-        #### If there is a group_identifier, then update the group_dict
-        if group_identifier is not None:
-            #### If this group already has one or more entries, add to it
-            if group_identifier in self.group_dict:
-                self.group_dict[group_identifier].append(index)
-            #### Else create and entry for the group_identifier
-            else:
-                self.group_dict[group_identifier] = [ index ]
-
+            self.attribute_groups.append(int(group_identifier))
         return()
 
 
     #### Parse a list buffer of lines from a MSP-style spectrum entry, creating
-    #### a dict of attributes and a list of peaks
-    def parse(self, buffer, spectrum_index=None):
+    #### a dict of attributes and a list of peaks. If lazy is set, the foreign attributes
+    #### are only converted into standard ones when the attributes are first accessed
+    def parse(self, buffer, spectrum_index=None, lazy=False):
 
         #### Start in the header section of the entry
         in_header = True
         
         #### Reset all spectrum properties in case there is already data here
         self.foreign_attributes = {}
-        self.peak_list = []
+        mzs = []
+        intensities = []
+        interpretations = []
 
         #### Loop through each line in the buffered list
         for line in buffer:
@@ -120,64 +609,38 @@ class LibrarySpectrum:
                     #### Remove it from attributes
                     del(self.foreign_attributes[key])
 
-                    #### Split on all spaces
-                    comment_items = re.split(" ", value)
-
-                    #### Any spaces within quotes are then de-split
-                    fixed_comment_items = []
-                    quote_counter = 0
-                    new_item = ""
-                    for item in comment_items:
-                        if new_item > "":
-                            new_item = new_item + " "
-                        new_item = new_item + item
-                        n_quotes = new_item.count('"')
-                        if n_quotes/2 == int(n_quotes/2):
-                            fixed_comment_items.append(new_item)
-                            new_item = ""
-
-                    #### Try to split each item on the first = character and store in attributes
-                    for item in fixed_comment_items:
-                        #### If there is an = then split on the first one and store key and value
-                        if item.count("=") > 0:
-                            comment_key, comment_value = item.split("=", 1)
-                            self.foreign_attributes[comment_key] = comment_value
-                            #print(f"{comment_key}={comment_value}")
-                        #### Otherwise just store the key with a null value
-                        else:
-                            self.foreign_attributes[item] = None
-                            #print(f"{item}")
-
-            #### Else in the peaks section. Parse the peaks.
+                    #### Tokenize the key=value items into the foreign attributes
+                    parse_comment(value, self.foreign_attributes)
+
+            #### Else in the peaks section. Collect the m/z, intensity and interpretation of each peak
             else:
-                #### Split into the expected three values
-                values = re.split(r'\s+',line)
-                interpretations = ""
-                if len(values) == 1:
-                    mz = values
-                    intensity = "1"
-                if len(values) == 2:
-                    mz, intensity = values
-                elif len(values) == 3:
-                    mz, intensity, interpretations = values
-                elif len(values) > 3:
-                    mz = values[0]
-                    intensity = values[1]
-                    interpretations = values[2]
+                #### Split off the m/z and intensity, leaving the rest of the line as the interpretation
+                values = line.split(None, 2)
+                n_values = len(values)
+                if n_values == 0:
+                    continue
+                mzs.append(values[0])
+                if n_values > 1:
+                    intensities.append(values[1])
                 else:
-                    mz = "1"
-                    intensity = "1"
+                    intensities.append("1")
 
                 # Strip any double quotes in the interpretation string
-                interpretations = interpretations.strip('"')
+                if n_values > 2:
+                    interpretations.append(values[2].strip('"'))
+                else:
+                    interpretations.append("")
 
-                #### Add to the peak list
-                self.peak_list.append( [ mz, intensity, interpretations ] )
+        #### Convert the peaks to arrays in one step
+        self.set_peaks(mzs, intensities, interpretations)
 
-        #### Now convert the foreign attributes to standard ones
+        #### Now convert the foreign attributes to standard ones, or defer that until they are needed
         if spectrum_index is not None:
             self.add_attribute("MS:1008014|spectrum index", spectrum_index)
-        self.convert_foreign_attributes()
+        if lazy:
+            self.conversion_pending = True
+        else:
+            self.convert_foreign_attributes()
 
         return(self)
 
@@ -197,338 +660,149 @@ class LibrarySpectrum:
             Description of return value
         """
 
-        #### Define the translation from keys to CV terms
-        leader_terms = {
-            "Name": "MS:1008013|spectrum name",
-        }
-        other_terms = {
-            "MW": "MS:1008010|molecular mass",
-            "ExactMass": "MS:1008010|molecular mass",
-            "Charge": "MS:1000041|charge state",
-            "Parent": "MS:1000744|selected ion m/z",
-            "ObservedPrecursorMZ": "MS:1000744|selected ion m/z",
-            "Single": [ "MS:1008015|spectrum aggregation type", "MS:1008016|singleton spectrum" ],
-            "Consensus": [ "MS:1008015|spectrum aggregation type", "MS:1008017|consensus spectrum" ],
-            "PrecursorMonoisoMZ": "MS:1008032|theoretical monoisotopic m/z",
-            "Mz_exact": "MS:1008032|theoretical monoisotopic m/z",
-            "Mz_av": "MS:1008033|theoretical average m/z",
-            "Inst": { "it": [ [ "MS:1000044|dissociation method", "MS:1002472|trap-type collision-induced dissociation" ] ],
-                      "hcd": [ [ "MS:1000044|dissociation method", "MS:1000422|beam-type collision-induced dissociation" ] ],
-                      "QExactive": [ [ "MS:1000031|instrument model", "MS:1001911|Q Exactive" ] ] },
-            "Pep": { "Tryptic": [ [ "MS:1008030|number of enzymatic termini", 2 ], [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
-                     "N-Semitryptic": [ [ "MS:1008030|number of enzymatic termini", 1 ], [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
-                     "C-Semitryptic": [ [ "MS:1008030|number of enzymatic termini", 1 ], [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
-                     "Tryptic/miss_good_confirmed": [ [ "MS:1008030|number of enzymatic termini", 2 ],
-                        [ "MS:1008034|number of missed cleavages", "0" ],
-                        [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
-                     "Tryptic/miss_bad_confirmed": [ [ "MS:1008030|number of enzymatic termini", 2 ],
-                        [ "MS:1008034|number of missed cleavages", ">0" ],
-                        [ "MS:1001045|cleavage agent name", "MS:1001251|Trypsin" ] ],
-                    },
-            "Spec": { "Consensus": [ [ "MS:1008015|spectrum aggregation type", "MS:1008017|consensus spectrum" ] ] },
-            "Scan": "MS:1008035|scan number",
-            "Origfile": "MS:1009008|source file",
-            "Sample": "MS:1000002|sample name",
-            "Filter": "MS:1000512|filter string",
-            "FTResolution": "MS:1000028|detector resolution",
-            "Protein": "MS:1000885|protein accession",
-            "ms1PrecursorAb": "MS:1009010|previous MS1 scan precursor intensity",
-            "Precursor1MaxAb": "MS:1009011|precursor apex intensity",
-            "Purity": "MS:1009013|isolation window precursor purity",
-            "Unassigned": "MS:1008027|top 20 peak unassigned intensity fraction",
-            "Unassign_all": "MS:1008025|total unassigned intensity fraction",
-            "Protein": "MS:1000885|protein accession",
-            "Mods": "MS:1001471|peptide modification details",
-            "BasePeak": "MS:1000505|base peak intensity",
-            "Naa": "MS:1008027|number of residues",
-            "Num peaks": "MS:1008040|number of peaks",
-        }
+        #### The conversion is no longer pending once it has started
+        self.conversion_pending = False
+
+        #### Nothing to do if the foreign attributes were already converted
+        if self.foreign_attributes is None:
+            return()
 
         #### Add special terms that we want to start off with
+        foreign_attributes = self.foreign_attributes
         for term in leader_terms:
-            if term in self.foreign_attributes:
-                self.add_attribute(leader_terms[term], self.foreign_attributes[term])
+            if term in foreign_attributes:
+                self.add_attribute(leader_terms[term], foreign_attributes[term])
             else:
                 self.add_attribute("ERROR", f"Required term {leader_terms[term]} is missing")
 
         #### Translate the rest of the known attributes and collect unknown ones
         unknown_terms = []
-        for attribute in self.foreign_attributes:
+        for attribute, value in foreign_attributes.items():
 
             #### Skip a leader term that we already processed
             if attribute in leader_terms: continue
 
             #### If this is in the list of generic terms, process it
-            if attribute in other_terms:
+            mapping = other_terms.get(attribute)
+            if mapping is not None:
 
                 #### If the original attribute has no value, if mapping permits this, go ahead
-                if self.foreign_attributes[attribute] is None:
-                    if type(other_terms[attribute]) is list:
-                        self.add_attribute(other_terms[attribute][0],other_terms[attribute][1])
+                if value is None:
+                    if type(mapping) is list:
+                        self.add_attribute(mapping[0],mapping[1])
                     else:
                         self.add_attribute("ERROR", f"Term {attribute} found without a value")
                         unknown_terms.append(attribute)
 
                 #### If the term mapping value is an ordinary string, then just substitute the key
-                elif type(other_terms[attribute]) is str:
-                    self.add_attribute(other_terms[attribute], self.foreign_attributes[attribute])
-                        
-                #### Otherwise assume it is a dict of possible allowed values
-                else:
-                    #### If the value of the original attribute is in the list of allowed values
-                    if self.foreign_attributes[attribute] in other_terms[attribute]:
-                        #### If the mapping is a plain string, add it
-                        if type(other_terms[attribute][self.foreign_attributes[attribute]]) is str:
-                            self.add_attribute(other_terms[attribute][self.foreign_attributes[attribute]].split("="))
-                        #### Or if it is a list, then there are multiple terms to add within a group
-                        elif type(other_terms[attribute][self.foreign_attributes[attribute]]) is list:
-                            if len(other_terms[attribute][self.foreign_attributes[attribute]]) == 1:
-                                for item in other_terms[attribute][self.foreign_attributes[attribute]]:
-                                    self.add_attribute(item[0],item[1])
-                            else:
-                                group_identifier = self.get_next_group_identifier()
-                                for item in other_terms[attribute][self.foreign_attributes[attribute]]:
-                                    self.add_attribute(item[0],item[1],group_identifier)
-                        else:
-                            self.add_attribute("ERROR", f"Internal error. Unexpected datatype in other_terms for {attribute}")
-                            unknown_terms.append(attribute)
-                    else:
-                        self.add_attribute("ERROR", f"{self.foreign_attributes[attribute]} is not a defined option for {attribute}")
-                        unknown_terms.append(attribute)
-
-            #### Handle special logic cases
-
-            #### Expand the HCD attribute
-            elif attribute == "HCD":
-                self.add_attribute("MS:1000044|dissociation method", "MS:1000422|beam-type collision-induced dissociation")
-                found_match = 0
-                if self.foreign_attributes[attribute] is not None:
-                    match = re.match("([\d\.]+)\s*ev", self.foreign_attributes[attribute], flags=re.IGNORECASE)
-                    if match is not None:
-                        found_match = 1
-                        group_identifier = self.get_next_group_identifier()
-                        self.add_attribute("MS:1000045|collision energy", match.group(1), group_identifier)
-                        self.add_attribute("UO:0000000|unit", "UO:0000266|electronvolt", group_identifier)
-                    match = re.match("([\d\.]+)\s*%", self.foreign_attributes[attribute])
-                    if match is not None:
-                        found_match = 1
-                        group_identifier = self.get_next_group_identifier()
-                        self.add_attribute("MS:1000045|collision energy", match.group(1), group_identifier)
-                        self.add_attribute("UO:0000000|unit", "UO:0000187|percent", group_identifier)
-                    if found_match == 0:
-                        self.add_attribute("ERROR", f"Unable to parse self.foreign_attributes[attribute] in attribute")
-                        unknown_terms.append(attribute)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
-
-            #### Expand the Collision_energy attribute
-            elif attribute == "Collision_energy":
-                if self.foreign_attributes[attribute] is not None:
-                    match = re.match("([\d\.]+)", self.foreign_attributes[attribute])
-                    if match is not None:
-                        group_identifier = self.get_next_group_identifier()
-                        self.add_attribute("MS:1000045|collision energy", match.group(1), group_identifier)
-                        self.add_attribute("UO:0000000|unit", "UO:0000266|electronvolt", group_identifier)
-                    else:
-                        self.add_attribute("ERROR", f"Unable to parse self.foreign_attributes[attribute] in attribute")
-                        unknown_terms.append(attribute)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
-
-            #### Expand the RT attribute
-            elif attribute == "RT":
-                if self.foreign_attributes[attribute] is not None:
-                    match = re.match("([\d\.]+)\s*(\D*)", self.foreign_attributes[attribute])
-                    if match is not None:
-                        if match.group(2):
-                            self.add_attribute("ERROR", f"Need more RT parsing code to handle this value")
-                            unknown_terms.append(attribute)
-                        else:
-                            group_identifier = self.get_next_group_identifier()
-                            self.add_attribute("MS:1000894|retention time", match.group(1), group_identifier)
-                            #### If the value is greater than 250, assume it must be seconds
-                            if float(match.group(1)) > 250:
-                                self.add_attribute("UO:0000000|unit", "UO:0000010|second", group_identifier)
-                            #### Although normally assume minutes
-                            else:
-                                self.add_attribute("UO:0000000|unit", "UO:0000031|minute", group_identifier)
-                    else:
-                        self.add_attribute("ERROR", f"Unable to parse self.foreign_attributes[attribute] in attribute")
-                        unknown_terms.append(attribute)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
-
-            #### Expand the ms2IsolationWidth attribute
-            elif attribute == "ms2IsolationWidth":
-                if self.foreign_attributes[attribute] is not None:
-                    group_identifier = self.get_next_group_identifier()
-                    self.add_attribute("MS:1000828|isolation window lower offset", str(float(self.foreign_attributes[attribute])/2), group_identifier)
-                    self.add_attribute("UO:0000000|unit", "MS:1000040|m/z", group_identifier)
-                    group_identifier = self.get_next_group_identifier()
-                    self.add_attribute("MS:1000829|isolation window upper offset", str(float(self.foreign_attributes[attribute])/2), group_identifier)
-                    self.add_attribute("UO:0000000|unit", "MS:1000040|m/z", group_identifier)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
-
-            #### Expand the Mz_diff attribute
-            elif attribute == "Mz_diff":
-                if self.foreign_attributes[attribute] is not None:
-                    match = re.match("([\-\+e\d\.]+)\s*ppm", self.foreign_attributes[attribute], flags=re.IGNORECASE)
-                    if match is not None:
-                        group_identifier = self.get_next_group_identifier()
-                        self.add_attribute("MS:1001975|delta m/z", match.group(1), group_identifier)
-                        self.add_attribute("UO:0000000|unit", "UO:0000169|parts per million", group_identifier)
-                    else:
-                        match = re.match("([\-\+e\d\.]+)\s*", self.foreign_attributes[attribute])
-                        if match is not None:
-                            group_identifier = self.get_next_group_identifier()
-                            self.add_attribute("MS:1001975|delta m/z", match.group(1), group_identifier)
-                            self.add_attribute("UO:0000000|unit", "MS:1000040|m/z", group_identifier)
-                        else:
-                            self.add_attribute("ERROR", f"Unable to parse {self.foreign_attributes[attribute]} in {attribute}")
-                            unknown_terms.append(attribute)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
-
-            #### Expand the Dev_ppm attribute
-            elif attribute == "Dev_ppm":
-                if self.foreign_attributes[attribute] is not None:
-                    group_identifier = self.get_next_group_identifier()
-                    self.add_attribute("MS:1001975|delta m/z", self.foreign_attributes[attribute], group_identifier)
-                    self.add_attribute("UO:0000000|unit", "UO:0000169|parts per million", group_identifier)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
+                elif type(mapping) is str:
+                    self.add_attribute(mapping, value)
 
-            #### Expand the Fullname attribute
-            elif attribute == "Fullname":
-                if self.foreign_attributes[attribute] is not None:
-                    match = re.match("([A-Z\-\*])\.([A-Z]+)\.([A-Z\-\*])/*([\d]*)", self.foreign_attributes[attribute])
-                    if match is not None:
-                        self.add_attribute("MS:1000888|unmodified peptide sequence", match.group(2))
-                        self.add_attribute("MS:1001112|n-terminal flanking residue", match.group(1))
-                        self.add_attribute("MS:1001113|c-terminal flanking residue", match.group(3))
-                        if match.group(4):
-                            self.add_attribute("MS:1000041|charge state", match.group(4))
-                    else:
-                        self.add_attribute("ERROR", f"Unable to parse {self.foreign_attributes[attribute]} in {attribute} at E2355")
-                        unknown_terms.append(attribute)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
-
-            #### Expand the Nrep attribute
-            elif attribute == "Nrep" or attribute == "Nreps":
-                if self.foreign_attributes[attribute] is not None:
-                    match = re.match("(\d+)/(\d+)", self.foreign_attributes[attribute])
-                    if match is not None:
-                        self.add_attribute("MS:1009020|number of replicate spectra used", match.group(1))
-                        self.add_attribute("MS:1009021|number of replicate spectra available", match.group(2))
+                #### Otherwise assume it is a dict of possible allowed values
+                elif value in mapping:
+                    items = mapping[value]
+                    #### If there is only one term, add it on its own, otherwise add the terms within a group
+                    if len(items) == 1:
+                        self.add_attribute(items[0][0],items[0][1])
                     else:
-                        match = re.match("(\d+)", self.foreign_attributes[attribute])
-                        if match is not None:
-                            self.add_attribute("MS:1008020|number of replicate spectra used", match.group(1))
-                            self.add_attribute("MS:1008019|number of replicate spectra available", match.group(1))
-                        else:
-                            self.add_attribute("ERROR", f"Unable to parse {self.foreign_attributes[attribute]} in {attribute} at E2455")
-                            unknown_terms.append(attribute)
-                else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
-                    unknown_terms.append(attribute)
-
-            #### Expand the Fullname attribute
-            elif attribute == "Organism":
-                if self.foreign_attributes[attribute] is not None:
-                    value = self.foreign_attributes[attribute]
-                    value = value.strip('"')
-                    species_map = {
-                        "human": [ [ "MS:1001467|taxonomy: NCBI TaxID", "NCBITaxon:9606|Homo sapiens" ],
-                            ["MS:1001469|taxonomy: scientific name", "Homo sapiens" ],
-                            ["MS:1001468|taxonomy: common name", "human" ] ],
-                        "zebrafish": [ [ "MS:1001467|taxonomy: NCBI TaxID", "NCBITaxon:7955|Danio rerio" ],
-                            ["MS:1001469|taxonomy: scientific name", "Danio rerio" ],
-                            ["MS:1001468|taxonomy: common name", "zebra fish" ] ],
-                        "chicken": [ [ "MS:1001467|taxonomy: NCBI TaxID", "NCBITaxon:9031|Gallus gallus" ],
-                            ["MS:1001469|taxonomy: scientific name", "Gallus gallus" ],
-                            ["MS:1001468|taxonomy: common name", "chicken" ] ],
-                        }
-                    if value in species_map:
                         group_identifier = self.get_next_group_identifier()
-                        for item in species_map[value]:
+                        for item in items:
                             self.add_attribute(item[0],item[1],group_identifier)
-      
-                    else:
-                        self.add_attribute("ERROR", f"Unable to parse {self.foreign_attributes[attribute]} in {attribute} at E2355")
-                        unknown_terms.append(attribute)
                 else:
-                    self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
+                    self.add_attribute("ERROR", f"{value} is not a defined option for {attribute}")
                     unknown_terms.append(attribute)
+                continue
 
-            #### Otherwise add this term to the list of attributes that we don't know how to handle
-            else:
+            #### Handle special logic cases with the converter for this attribute
+            converter = special_attribute_converters.get(attribute)
+            if converter is None:
+                unknown_terms.append(attribute)
+            elif value is None and attribute not in special_attributes_without_values:
+                self.add_attribute("ERROR", f"Attribute {attribute} must have a value")
+                unknown_terms.append(attribute)
+            elif not converter(self, attribute, value):
                 unknown_terms.append(attribute)
-
 
         #### Perform some cleanup for poorly annotated libraries
-        if "MS:1000888|unmodified peptide sequence" not in self.attribute_dict:
-            if "MS:1008013|spectrum name" in self.attribute_dict:
-                lookup = self.attribute_dict["MS:1008013|spectrum name"]
-                name = self.attributes[ lookup["indexes"][0] ][1]
-                match = re.match("(.+)/(\d+)",name)
+        if get_attribute_key_code("MS:1000888|unmodified peptide sequence") not in self.attribute_codes:
+            names = self.get_attribute_values("MS:1008013|spectrum name")
+            if len(names) > 0:
+                match = name_charge_regex.match(names[0])
                 if match:
                     self.add_attribute("MS:1000888|unmodified peptide sequence", match.group(1))
                     self.add_attribute("MS:1000041|charge state", match.group(2))
 
         #### Handle the uninterpretable terms
         for attribute in unknown_terms:
-            if self.foreign_attributes[attribute] is None:
+            if foreign_attributes[attribute] is None:
                 self.add_attribute("MS:1009900|other attribute name", attribute)
             else:
                 group_identifier = self.get_next_group_identifier()
                 self.add_attribute("MS:1009900|other attribute name", attribute, group_identifier)
-                self.add_attribute("MS:1009902|other attribute value", self.foreign_attributes[attribute], group_identifier)
+                self.add_attribute("MS:1009902|other attribute value", foreign_attributes[attribute], group_identifier)
+
+        #### The foreign attributes are no longer needed once converted
+        self.foreign_attributes = None
 
         return()
 
 
-    def write(self, format="text"):
+    def write(self, format="text", compact=False):
         """
         write - Write out the spectrum in any of the supported formats
 
-        Extended description of function.
+        Parameters
+        ----------
+        format : string
+            One of 'text', 'tsv', 'csv', 'json', 'jsonl' or 'msp'
+        compact : bool
+            If set, write JSON on a single line without indentation or sorted keys (always so for 'jsonl')
+
+        Returns
+        -------
+        string
+            The spectrum in the requested format
+        """
+
+        return("".join(self.write_lines(format=format, compact=compact)))
+
+
+    def write_lines(self, format="text", compact=False):
+        """
+        write_lines - Write out the spectrum as a list of strings in any of the supported formats
+
+        The strings are collected in a list rather than concatenated, so that
+        they can be passed straight to a file's writelines() or joined once.
 
         Parameters
         ----------
+        format : string
+            One of 'text', 'tsv', 'csv', 'json', 'jsonl' or 'msp'
+        compact : bool
+            If set, write JSON on a single line without indentation or sorted keys (always so for 'jsonl')
 
         Returns
         -------
-        int
-            Description of return value
+        list
+            Strings that make up the spectrum in the requested format
         """
 
-        #### Set a buffer to fill with string data
-        buffer = ''
+        #### Set a list to fill with string data
+        lines = []
 
         #### Make the format string lower case to facilitate comparisons
         format = format.lower()
 
-        #### If the format is text
+        #### If the format is text, write straight from the attribute arrays
         if format == "text":
-            for attribute in self.attributes:
-                if len(attribute) == 2:
-                    buffer += f"{attribute[0]}={attribute[1]}\n"
-                elif len(attribute) == 3:
-                    buffer += f"[{attribute[2]}]{attribute[0]}={attribute[1]}\n"
+            self.convert_pending_attributes()
+            for code, value, group in zip(self.attribute_codes, self.attribute_values, self.attribute_groups):
+                if group:
+                    lines.append(f"[{group}]{attribute_keys[code]}={value}\n")
                 else:
-                    eprint(f"ERROR (LSW527): Attribute has wrong number of elements (attribute={attribute})")
-                    continue
-            for peak in self.peak_list:
-                buffer += "\t".join(peak)+"\n"
+                    lines.append(f"{attribute_keys[code]}={value}\n")
+            mzs, intensities = self.get_peak_strings()
+            lines.extend(map("{}\t{}\t{}\n".format, mzs, intensities, self.get_interpretations()))
 
         #### If the format is TSV
         elif format == "tsv" or format == "csv":
@@ -538,8 +812,8 @@ class LibrarySpectrum:
             if format == "csv": delimiter = ","
 
             #### Create the header line and columns line
-            buffer += "# Spectrum attributes\n"
-            buffer += "cv_param_group\taccession\tname\tvalue_accession\tvalue\n"
+            lines.append("# Spectrum attributes\n")
+            lines.append("cv_param_group\taccession\tname\tvalue_accession\tvalue\n")
 
             for attribute in self.attributes:
                 if attribute is None or len(attribute) < 1:
@@ -580,79 +854,271 @@ class LibrarySpectrum:
                     continue
 
                 #### Create the data line
-                buffer += delimiter.join([cv_param_group,accession,name,value_accession,value])+"\n"
+                lines.append(delimiter.join([cv_param_group,accession,name,value_accession,value])+"\n")
 
             #### Create the header line and columns line
-            buffer += "# Peak list\n"
-            buffer += "mz\tintensity\tinterpretation\n"
+            lines.append("# Peak list\n")
+            lines.append("mz\tintensity\tinterpretation\n")
 
             #### Write out the peak list
-            for peak in self.peak_list:
-                mz,intensity,interpretation = peak
-                if format == "csv" and ',' in str(interpretation):
-                    interpretation = '"' + interpretation + '"'
-                buffer += delimiter.join([mz,intensity,interpretation])+"\n"
-
-        #### If the format is JSON
-        elif format == "json":
-            mzs = []
-            intensities = []
-            interpretations = []
-            for peak in self.peak_list:
-                mzs.append(float(peak[0]))
-                intensities.append(float(peak[1]))
-                interpretations.append(peak[2])
-
-            #### Organize the attributes from the simple list into the appropriate JSON format
-            attributes = []
-            for attribute in self.attributes:
-                if attribute is None or len(attribute) < 1:
-                    eprint(f"ERROR (LSW609): Attribute is None or too small (attribute={attribute})")
-                    continue
-                if attribute[0] == 'ERROR':
-                    eprint(f"ERROR (LSW612): Error interpreting spectrum header comment item (attribute={attribute})")
-                    continue
-                reformed_attribute = {}
-                if len(attribute) == 2:
-                    key,value = attribute
-                elif len(attribute) == 3:
-                    key,value,cv_param_group = attribute
-                    reformed_attribute['cv_param_group'] = cv_param_group
-                else:
-                    eprint(f"ERROR (LSW621): Unsupported number of items in attribute={attribute}")
-                    continue
-                components = key.split('|',1)
-                if len(components) == 2:
-                    accession,name = components
-                    reformed_attribute['accession'] = accession
-                    reformed_attribute['name'] = name
-                else:
-                    eprint(f"ERROR (LSW629): Unsupported number of items in components (attribute={attribute}), (components={components})")
-                    continue
-                components = str(value).split('|',1)
-                if len(components) == 2:
-                    value_accession,value = components
-                    reformed_attribute['value_accession'] = value_accession
-                    reformed_attribute['value'] = value
-                elif len(components) == 1:
-                    reformed_attribute['value'] = value
-                else:
-                    eprint(f"ERROR (LSW639): Unsupported number of items in components (attribute={attribute}), (components={components})")
-                    continue
-                attributes.append(reformed_attribute)
+            mzs, intensities = self.get_peak_strings()
+            interpretations = self.get_interpretations()
+            if format == "csv":
+                interpretations = [ '"' + interpretation + '"' if ',' in interpretation else interpretation for interpretation in interpretations ]
+            lines.extend(map(f"{{}}{delimiter}{{}}{delimiter}{{}}\n".format, mzs, intensities, interpretations))
+
+        #### If the format is JSON, either indented or compact on a single line, which is also one line of JSON Lines
+        elif format == "json" or format == "jsonl":
+            if format == "jsonl":
+                lines.append(encode_compact_json(self.get_json_object()))
+                lines.append("\n")
+            elif compact:
+                lines.append(encode_compact_json(self.get_json_object()))
+            else:
+                lines.append(json.dumps(self.get_json_object(),sort_keys=True,indent=2))
 
-            spectrum = { "attributes": attributes, "mzs": mzs, "intensities": intensities,
-                "interpretations": interpretations }
-            buffer = json.dumps(spectrum,sort_keys=True,indent=2)
+        #### If the format is MSP
+        elif format == "msp":
+            lines = self.write_msp_lines()
 
         #### Otherwise we don't know this format
         else:
             raise ValueError(f"ERROR: Unrecogized format '{format}'")
 
-        return(buffer)
+        return(lines)
 
 
+    def get_json_object(self):
+        """
+        get_json_object - Organize the attributes and peaks of the spectrum into the dict that is written as JSON
+
+        Returns
+        -------
+        dict
+            The attributes as a list of dicts and the peaks as parallel lists
+        """
+
+        intensity_strings = self.get_peak_strings()[1]
+        mzs = self.mzs.tolist()
+        intensities = [ float(intensity) for intensity in intensity_strings ]
+        interpretations = self.get_interpretations()
+
+        #### Organize the attributes from the simple list into the appropriate JSON format
+        attributes = []
+        for attribute in self.attributes:
+            if attribute is None or len(attribute) < 1:
+                eprint(f"ERROR (LSW609): Attribute is None or too small (attribute={attribute})")
+                continue
+            if attribute[0] == 'ERROR':
+                eprint(f"ERROR (LSW612): Error interpreting spectrum header comment item (attribute={attribute})")
+                continue
+            reformed_attribute = {}
+            if len(attribute) == 2:
+                key,value = attribute
+            elif len(attribute) == 3:
+                key,value,cv_param_group = attribute
+                reformed_attribute['cv_param_group'] = cv_param_group
+            else:
+                eprint(f"ERROR (LSW621): Unsupported number of items in attribute={attribute}")
+                continue
+            components = key.split('|',1)
+            if len(components) == 2:
+                accession,name = components
+                reformed_attribute['accession'] = accession
+                reformed_attribute['name'] = name
+            else:
+                eprint(f"ERROR (LSW629): Unsupported number of items in components (attribute={attribute}), (components={components})")
+                continue
+            components = str(value).split('|',1)
+            if len(components) == 2:
+                value_accession,value = components
+                reformed_attribute['value_accession'] = value_accession
+                reformed_attribute['value'] = value
+            elif len(components) == 1:
+                reformed_attribute['value'] = value
+            else:
+                eprint(f"ERROR (LSW639): Unsupported number of items in components (attribute={attribute}), (components={components})")
+                continue
+            attributes.append(reformed_attribute)
+
+        return( { "attributes": attributes, "mzs": mzs, "intensities": intensities, "interpretations": interpretations } )
 
 
+    def write_msp_lines(self):
+        """
+        write_msp_lines - Write out the spectrum as the lines of an MSP entry
+
+        This is the reverse of convert_foreign_attributes(). The spectrum name
+        becomes the Name line, and each attribute is written back in the Comment
+        line under the MSP key it came from: the simple keys, the options of keys
+        such as Pep, Spec and Inst, and the attributes built by the special
+        converters (Fullname, Organism, RT, Nreps, Mz_diff, HCD, Collision_energy
+        and ms2IsolationWidth). Attributes that were not understood are restored
+        from their other attribute name and value groups. A key can only occur
+        once in an entry, so an attribute whose keys are all taken is dropped, as
+        are attributes that have no MSP form.
+
+        Returns
+        -------
+        list
+            Lines of the MSP entry, without the blank line that separates entries
+        """
+
+        self.convert_pending_attributes()
+
+        #### Look up the attributes by key and by group, and mark each one once it has been written
+        keys = [ attribute_keys[code] for code in self.attribute_codes ]
+        values = self.attribute_values
+        groups = self.attribute_groups
+        written = [ False ] * len(keys)
+        positions = {}
+        group_positions = {}
+        for i, key in enumerate(keys):
+            positions.setdefault(key, []).append(i)
+            if groups[i]:
+                group_positions.setdefault(groups[i], []).append(i)
+
+        #### Return the position of the first unwritten attribute outside of a group with this key (and value)
+        def find_attribute(key, value=None):
+            for i in positions.get(key, []):
+                if not written[i] and not groups[i] and (value is None or str(values[i]) == str(value)):
+                    return(i)
+            return(None)
+
+        #### Add a Comment item unless its key is taken, marking the attributes it came from as written
+        line_keys = { "Name", "Num peaks" }
+        comment_items = {}
+        def add_item(msp_key, value, item_positions):
+            if msp_key in comment_items or msp_key in line_keys:
+                return(False)
+            if value is not None:
+                value = str(value)
+                if " " in value and not value.startswith('"'):
+                    value = f'"{value}"'
+            comment_items[msp_key] = value
+            for i in item_positions:
+                written[i] = True
+            return(True)
+
+        #### The HCD converter always adds the dissociation method, so it is not written separately
+        def find_hcd_dissociation_method():
+            return(find_attribute("MS:1000044|dissociation method", "MS:1000422|beam-type collision-induced dissociation"))
+        def mark_hcd_dissociation_method():
+            i = find_hcd_dissociation_method()
+            if i is not None:
+                written[i] = True
+
+        names = self.get_attribute_values("MS:1008013|spectrum name")
+        name = str(names[0]) if len(names) > 0 else ''
+        lines = [ f"Name: {name}\n" ]
+        i = find_attribute("MS:1008010|molecular mass")
+        if i is not None:
+            lines.append(f"MW: {values[i]}\n")
+            written[i] = True
+            line_keys.add("MW")
+
+        #### Restore the uninterpreted items from their other attribute name and value
+        for i in positions.get("MS:1009900|other attribute name", []):
+            item_positions = [ i ]
+            value = None
+            if groups[i]:
+                for j in group_positions[groups[i]]:
+                    if keys[j] == "MS:1009902|other attribute value":
+                        value = values[j]
+                        item_positions.append(j)
+            if add_item(str(values[i]), value, item_positions) and values[i] == "HCD":
+                mark_hcd_dissociation_method()
+
+        #### Write the groups built by the special converters and the options of several items
+        isolation_offsets = {}
+        for group, item_positions in group_positions.items():
+            item_positions = [ i for i in item_positions if not written[i] ]
+            group_values = { keys[i]: values[i] for i in item_positions }
+            unit = group_values.get("UO:0000000|unit")
+            if "MS:1000045|collision energy" in group_values:
+                energy = group_values["MS:1000045|collision energy"]
+                if unit == "UO:0000187|percent":
+                    if add_item("HCD", f"{energy}%", item_positions):
+                        mark_hcd_dissociation_method()
+                elif unit == "UO:0000266|electronvolt":
+                    if find_hcd_dissociation_method() is not None and add_item("HCD", f"{energy}eV", item_positions):
+                        mark_hcd_dissociation_method()
+                    elif not add_item("Collision_energy", energy, item_positions) and add_item("HCD", f"{energy}eV", item_positions):
+                        mark_hcd_dissociation_method()
+            elif "MS:1000894|retention time" in group_values:
+                add_item("RT", group_values["MS:1000894|retention time"], item_positions)
+            elif "MS:1001975|delta m/z" in group_values:
+                delta = group_values["MS:1001975|delta m/z"]
+                if unit == "UO:0000169|parts per million":
+                    if not add_item("Mz_diff", f"{delta}ppm", item_positions):
+                        add_item("Dev_ppm", delta, item_positions)
+                elif unit == "MS:1000040|m/z":
+                    add_item("Mz_diff", delta, item_positions)
+            elif "MS:1000828|isolation window lower offset" in group_values:
+                isolation_offsets.setdefault("lower", (group_values["MS:1000828|isolation window lower offset"], item_positions))
+            elif "MS:1000829|isolation window upper offset" in group_values:
+                isolation_offsets.setdefault("upper", (group_values["MS:1000829|isolation window upper offset"], item_positions))
+            else:
+                for msp_key, msp_value, items in msp_option_rules:
+                    if len(items) > 1 and len(items) == len(item_positions) and all(str(group_values.get(item[0])) == str(item[1]) for item in items):
+                        add_item(msp_key, msp_value, item_positions)
+                        break
+        if len(isolation_offsets) == 2:
+            width = float(isolation_offsets["lower"][0]) + float(isolation_offsets["upper"][0])
+            add_item("ms2IsolationWidth", width, isolation_offsets["lower"][1] + isolation_offsets["upper"][1])
+
+        #### Write the peptide sequence with its flanking residues and charge as the Fullname
+        for i in positions.get("MS:1000888|unmodified peptide sequence", []):
+            if written[i] or groups[i]:
+                continue
+            n_terminus = find_attribute("MS:1001112|n-terminal flanking residue")
+            c_terminus = find_attribute("MS:1001113|c-terminal flanking residue")
+            if n_terminus is not None and c_terminus is not None:
+                item_positions = [ i, n_terminus, c_terminus ]
+                fullname = f"{values[n_terminus]}.{values[i]}.{values[c_terminus]}"
+                charge = find_attribute("MS:1000041|charge state")
+                if charge is not None:
+                    item_positions.append(charge)
+                    fullname += f"/{values[charge]}"
+                add_item("Fullname", fullname, item_positions)
+
+            #### Without flanking residues, a sequence and charge taken from the name are added again when read back
+            else:
+                match = name_charge_regex.match(name)
+                if match and match.group(1) == str(values[i]):
+                    written[i] = True
+                    charge = find_attribute("MS:1000041|charge state", match.group(2))
+                    if charge is not None:
+                        written[charge] = True
+
+        #### Write the numbers of replicates as Nreps
+        for i in positions.get("MS:1009020|number of replicate spectra used", []):
+            j = find_attribute("MS:1009021|number of replicate spectra available")
+            if not written[i] and not groups[i] and j is not None:
+                if not add_item("Nreps", f"{values[i]}/{values[j]}", [ i, j ]):
+                    add_item("Nrep", f"{values[i]}/{values[j]}", [ i, j ])
+        for i in positions.get("MS:1008020|number of replicate spectra used", []):
+            j = find_attribute("MS:1008019|number of replicate spectra available", values[i])
+            if not written[i] and not groups[i] and j is not None:
+                if not add_item("Nreps", values[i], [ i, j ]):
+                    add_item("Nrep", values[i], [ i, j ])
+
+        #### Write the remaining attributes as options of a single item or under a simple key
+        for i, key in enumerate(keys):
+            if written[i] or groups[i] or key in msp_skipped_keys:
+                continue
+            for msp_key, msp_value, items in msp_option_items.get( (key, str(values[i])), [] ):
+                if add_item(msp_key, msp_value, [ i ]):
+                    break
+            else:
+                for msp_key in msp_keys.get(key, []):
+                    if add_item(msp_key, values[i], [ i ]):
+                        break
 
+        if len(comment_items) > 0:
+            lines.append("Comment: " + " ".join(msp_key if value is None else f"{msp_key}={value}" for msp_key, value in comment_items.items()) + "\n")
 
+        lines.append(f"Num peaks: {self.n_peaks}\n")
+        mzs, intensities = self.get_peak_strings()
+        lines.extend(map('{}\t{}\t"{}"\n'.format, mzs, intensities, self.get_interpretations()))
+        return(lines)
@@ -5,13 +5,136 @@ def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
 import re
 import timeit
 import os
+import mmap
+import concurrent.futures
+import collections
+import array
+
+import numpy as np
 
 from SpectrumLibraryIndex import SpectrumLibraryIndex
 from LibrarySpectrum import LibrarySpectrum
+from SpectrumLibraryTable import SpectrumLibraryTable, table_suffix
+from SpectrumLibraryBinary import write_binary_library
+from SpectrumLibrarySearch import SpectrumLibrarySearch, default_bin_width
+from SpectrumLibraryFragmentIndex import SpectrumLibraryFragmentIndex, default_fragment_bin_width, default_fragment_top_k_peaks
+from SpectrumLibraryCache import SpectrumLibraryCache
 
 
 debug = True
 
+#### Text written after each spectrum when writing a whole library in each format
+entry_separators = { 'text': "\n", 'tsv': "\n", 'csv': "\n", 'msp': "\n", 'jsonl': "" }
+
+#### Buffer size for writing libraries
+write_buffer_size = 1024 * 1024
+
+#### If set, an index found to be out of date with its library is updated before reading, otherwise an exception is raised
+update_stale_index = True
+
+#### Libraries smaller than this many bytes are scanned in one process even if workers are requested,
+#### since starting the workers costs more than they save
+parallel_scan_min_size = 64 * 1024 * 1024
+
+#### Entries separated by fewer bytes than this are read together by get_spectra()
+max_read_gap = 65536
+
+#### Cache of parsed spectra shared by all libraries, keyed on the library filename and spectrum index number
+spectrum_cache = SpectrumLibraryCache()
+
+#### Beginning of each entry in an MSP library, matched against the raw bytes
+entry_name_regex = re.compile(rb'^Name:[ \t]+([^\n]+)', re.MULTILINE)
+
+#### Patterns for pulling the most commonly queried metadata out of the raw bytes of an entry header.
+#### They start with a literal so that the regex engine can skim for it, and the field boundary is checked afterwards
+num_peaks_regex = re.compile(rb'\nNum ?[Pp]eaks:[ \t]*(\d+)')
+precursor_mz_regex = re.compile(rb'(?:Parent|PrecursorMZ|PrecursorMonoisoMZ|Mz_exact)[=:][ \t]*([\d\.]+)')
+mods_regex = re.compile(rb'Mods=(\S+)')
+fullname_regex = re.compile(rb'Fullname=[A-Z\-\*]\.([A-Z]+)\.[A-Z\-\*]')
+charge_regex = re.compile(rb'Charge[=:][ \t]*\+?(\d+)')
+name_charge_regex = re.compile(r'^(.+?)/(\d+)')
+sequence_decoration_regex = re.compile(r'\[[^\]]*\]|\([^\)]*\)|[^A-Z]')
+
+
+#### Decode one entry of the library into a list of its non-empty lines, with trailing whitespace removed
+def decode_entry(buffer, offset, length):
+    lines = buffer[offset:offset + length].decode('utf-8', errors='replace').splitlines()
+    return( [ line.rstrip() for line in lines if len(line) > 0 and not line.isspace() ] )
+
+
+#### Find the first match of a header field regex that begins a line or follows whitespace
+def search_header_field(regex, header):
+    match = regex.search(header)
+    while match is not None and match.start() > 0 and header[match.start() - 1] not in b' \t\n':
+        match = regex.search(header, match.start() + 1)
+    return(match)
+
+
+#### Extract the peptide sequence, charge, precursor m/z, number of peaks and mods from the raw bytes of one entry
+def parse_entry_header(buffer, offset, length, name):
+
+    #### Only look at the header, which ends with the Num peaks line
+    end = offset + length
+    match = num_peaks_regex.search(buffer, offset, end)
+    if match is not None:
+        n_peaks = int(match.group(1))
+        header = buffer[offset:match.start()]
+    else:
+        n_peaks = None
+        header = buffer[offset:end]
+
+    peptide_sequence = None
+    charge = None
+    match = name_charge_regex.match(name)
+    if match is not None:
+        peptide_sequence = sequence_decoration_regex.sub('', match.group(1)) or None
+        charge = int(match.group(2))
+    match = search_header_field(fullname_regex, header)
+    if match is not None:
+        peptide_sequence = match.group(1).decode('ascii')
+    if charge is None:
+        match = search_header_field(charge_regex, header)
+        if match is not None:
+            charge = int(match.group(1))
+
+    precursor_mz = None
+    match = search_header_field(precursor_mz_regex, header)
+    if match is not None:
+        try:
+            precursor_mz = float(match.group(1))
+        except ValueError:
+            precursor_mz = None
+
+    mods = None
+    match = search_header_field(mods_regex, header)
+    if match is not None:
+        mods = match.group(1).decode('utf-8', errors='replace')
+
+    return( { 'peptide_sequence': peptide_sequence, 'charge': charge, 'precursor_mz': precursor_mz, 'n_peaks': n_peaks, 'mods': mods } )
+
+#### Extract the m/z values and intensities of the peaks from the raw bytes of one entry, appending them to the supplied arrays
+def parse_entry_peaks(buffer, offset, length, mzs, intensities):
+    end = offset + length
+    match = num_peaks_regex.search(buffer, offset, end)
+    if match is None:
+        return(0)
+    start = buffer.find(b'\n', match.end(), end)
+    if start < 0:
+        return(0)
+    n_peaks = 0
+    for line in buffer[start + 1:end].split(b'\n'):
+        values = line.split(None, 2)
+        if len(values) == 0:
+            continue
+        mzs.append(float(values[0]))
+        if len(values) > 1:
+            intensities.append(float(values[1]))
+        else:
+            intensities.append(1.0)
+        n_peaks += 1
+    return(n_peaks)
+
+
 class SpectrumLibrary:
     """
     SpectrumLibrary - Class for a spectrum library
@@ -27,9 +150,20 @@ class SpectrumLibrary:
     read - Read the entire library into memory
     write - Write the library to disk
     create_index - Create an index file for this library
+    update_index - Bring the index up to date with the library file
+    check_index - Make sure that the index matches the library file before reading at its offsets
     transform - Not quite sure what this is supposed to be
     get_spectrum - Extract a single spectrum by identifier
+    get_spectra - Extract many spectra by index number with one index query and one forward pass over the library
+    iter_spectra - Iterate over the spectra of the library in file order
+    iter_batches - Iterate over the raw entries of the library in batches
+    convert - Parse every spectrum of the library and write it out in another format
+    create_table - Build a columnar table of the whole library in one streaming pass
+    load_table - Load the columnar table of the library saved by create_table()
     find_spectra - Return a list of spectra given query constraints
+    search_spectra - Return the most similar library spectra for each of many query spectra
+    search_open - Return the most similar library spectra for each query spectrum regardless of precursor m/z
+    close - Release the memory map of the library file and close the index
 
     """
 
@@ -50,6 +184,19 @@ class SpectrumLibrary:
         self.filename = filename
         self.format = format
 
+        #### Memory map of the library file, opened on first access
+        self.buffer = None
+
+        #### Size, modification time and inode of the library file when the index was last found to match it
+        self.verified_library_stat = None
+
+        #### Cache of parsed spectra for get_spectrum(). Set to None to disable caching
+        self.spectrum_cache = spectrum_cache
+
+        #### Similarity search engine and fragment ion index, created on first search
+        self.search_engine = None
+        self.fragment_index = None
+
         #### If we already have a filename, look for or create an index
         self.index = None
         if self.filename is not None:
@@ -122,19 +269,30 @@ class SpectrumLibrary:
 
 
 
-    def read(self, create_index=None):
+    def read(self, create_index=None, workers=None, start_number=0, start_offset=0):
         """
         read - Read the entire library into memory
 
-        Extended description of function.
+        The library is scanned with scan_entries(), which finds the byte offset
+        and name of each entry without decoding the peak lines.
 
         Parameters
         ----------
+        create_index : bool
+            If set, create a new index for the library from the scan
+        workers : int
+            If greater than 1, scan the library with this many processes (at most one per CPU),
+            unless it is smaller than parallel_scan_min_size
+        start_number : int
+            Index number of the entry at start_offset. If greater than zero, the
+            existing index is kept up to this number and only the rest is re-indexed
+        start_offset : int
+            Byte offset in the library at which to start reading
 
         Returns
         -------
         int
-            Description of return value
+            Number of spectra found in the library
         """
 
         #### Check that the spectrum library filename isvalid
@@ -144,108 +302,185 @@ class SpectrumLibrary:
             eprint("ERROR: Unable to read library with no filename")
             return(False)
 
-        #### If an index hasn't been opened, open it now
+        #### If an index hasn't been opened, open it now, then start a fresh one (or continue it) in bulk loading mode
         if create_index is not None:
             if self.index is None:
                 self.index = SpectrumLibraryIndex( library_filename=self.filename )
+            if start_number == 0:
                 self.index.create_index()
+            self.index.begin_bulk_load(start_number=start_number)
 
         #### Determine the filesize
         file_size = os.path.getsize(filename)
         if debug: eprint(f"INFO: File size is {file_size}")
 
-        with open(filename, 'r') as infile:
-            state = 'header'
-            spectrum_buffer = []
-            n_spectra = 0
-            start_index = 0
-            file_offset = 0
-            #my_file_offset = 0
-            line_beginning_file_offset = 0
-            spectrum_file_offset = 0
-            spectrum_name = ''
-            windows_line_endings = 0
-            first_line = True
-            if debug: eprint("INFO: Reading..")
-            while 1:
-                line = infile.readline()
-                if len(line) == 0:
-                    break
-
-                line_beginning_file_offset = file_offset
-
-                #### Detect if there are Windows line endings
-                if first_line:
-                    counted_file_offset = len(line)
-                    tell_file_offset = infile.tell()
-                    if counted_file_offset + 1 == tell_file_offset:
-                        eprint(f"INFO: Detected Windows line endings: line length={counted_file_offset}, tell()={tell_file_offset}")
-                        windows_line_endings = 1
-                    first_line = False
-
-                #### Note that tell() is twice as slow as counting it myself
-                #file_offset = infile.tell()
-                file_offset += len(line) + windows_line_endings
-                #if debug: eprint(f"my_file_offset={my_file_offset}, tell_file_offset={file_offset}")
-
-                line = line.rstrip()
-                if state == 'header':
-                    if re.match('Name: ',line):
-                        state = 'body'
-                        spectrum_file_offset = line_beginning_file_offset
-                    else:
-                        continue
-                if state == 'body':
-                    if len(line) == 0:
-                        continue
-                    if re.match('Name: ',line):
-                        if len(spectrum_buffer) > 0:
-                            #parse(spectrum_buffer)
-                            if create_index is not None:
-                                self.index.add_spectrum( number=n_spectra + start_index, offset=spectrum_file_offset, name=spectrum_name, peptide_sequence=None )
-                            n_spectra += 1
-                            spectrum_buffer = []
-                            #### Commit every now and then
-                            if int(n_spectra/1000) == n_spectra/1000:
-                                self.index.commit()
-                                percent_done = int(file_offset/file_size*100+0.5)
-                                eprint(str(percent_done)+"%..",end='')
-
-                        spectrum_file_offset = line_beginning_file_offset
-                        spectrum_name = re.match('Name:\s+(.+)',line).group(1)
-                        #print(spectrum_name)
-                    spectrum_buffer.append(line)
-                #if n_spectra > 50:
-                #    break
-
-            #### Process the last spectrum in the buffer
-            #parse(spectrum_buffer)
+        n_spectra = 0
+        start_index = start_number
+        if debug: eprint("INFO: Reading..")
+        parse_headers = create_index is not None
+        if workers is not None:
+            workers = min(workers, os.cpu_count() or 1)
+        if workers is not None and workers > 1 and file_size - start_offset >= parallel_scan_min_size:
+            entries = self.scan_entries_parallel(workers=workers, parse_headers=parse_headers, start=start_offset)
+        else:
+            entries = self.scan_entries(start=start_offset, parse_headers=parse_headers)
+        for entry in entries:
+            spectrum_file_offset = entry[0]
             if create_index is not None:
-                self.index.add_spectrum( number=n_spectra + start_index, offset=spectrum_file_offset, name=spectrum_name, peptide_sequence=None )
-                self.index.commit()
+                spectrum_file_offset, spectrum_length, spectrum_name, metadata = entry
+                self.index.add_spectrum( number=n_spectra + start_index, offset=spectrum_file_offset, name=spectrum_name,
+                    peptide_sequence=metadata['peptide_sequence'], length=spectrum_length, charge=metadata['charge'],
+                    precursor_mz=metadata['precursor_mz'], n_peaks=metadata['n_peaks'], mods=metadata['mods'] )
             n_spectra += 1
-            if debug:
-                eprint()
-                eprint(f"INFO: Read {n_spectra} spectra from {filename}")
 
-            #### Flush the index
-            #self.index.commit()
-        return(n_spectra)
+            #### Report progress every now and then
+            if n_spectra % 100000 == 0:
+                percent_done = int(spectrum_file_offset/file_size*100+0.5)
+                eprint(str(percent_done)+"%..",end='')
+
+        #### Flush the index and drop any cached spectra, search engine and fragment index of the previous index
+        if create_index is not None:
+            self.index.end_bulk_load()
+            if self.spectrum_cache is not None:
+                self.spectrum_cache.invalidate(os.path.abspath(filename))
+            self.search_engine = None
+            self.fragment_index = None
+        if debug:
+            eprint()
+            eprint(f"INFO: Read {n_spectra} spectra from {filename}")
+        return(start_index + n_spectra)
+
+
+    def scan_entries(self, start=0, end=None, parse_headers=False):
+        """
+        scan_entries - Find the byte offset and name of every entry in the library
 
+        The whole file is memory-mapped and searched for "Name: " at the start of
+        a line as bytes, so peak lines are never decoded and the offsets are exact
+        byte positions regardless of the line endings.
 
-    def read_spectrum(self, offset=None):
+        Parameters
+        ----------
+        start : int
+            Byte offset at which to start looking for entries
+        end : int
+            Only return entries that begin before this byte offset (default: end of file)
+        parse_headers : bool
+            If set, also extract the peptide sequence, charge, precursor m/z,
+            number of peaks and mods from each entry header (see parse_entry_header())
+
+        Returns
+        -------
+        generator
+            Yields a (offset, length, name) tuple for each entry in file order,
+            with the dict of header metadata appended if parse_headers is set.
+            The length runs up to the start of the next entry or the end of the file.
         """
-        read - Read the entire library into memory
 
-        Extended description of function.
+        filename = self.filename
+        with open(filename, 'rb') as infile:
+            file_size = os.fstat(infile.fileno()).st_size
+            if file_size == 0:
+                return
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                previous_offset = None
+                previous_name = None
+                for match in entry_name_regex.finditer(buffer, start):
+                    offset = match.start()
+                    if previous_offset is not None:
+                        length = offset - previous_offset
+                        if parse_headers:
+                            yield( (previous_offset, length, previous_name, parse_entry_header(buffer, previous_offset, length, previous_name)) )
+                        else:
+                            yield( (previous_offset, length, previous_name) )
+                        previous_offset = None
+                    if end is not None and offset >= end:
+                        break
+                    previous_offset = offset
+                    previous_name = match.group(1).rstrip().decode('utf-8', errors='replace')
+
+                #### The last entry in the file runs to the end
+                if previous_offset is not None:
+                    length = file_size - previous_offset
+                    if parse_headers:
+                        yield( (previous_offset, length, previous_name, parse_entry_header(buffer, previous_offset, length, previous_name)) )
+                    else:
+                        yield( (previous_offset, length, previous_name) )
+
+
+    def scan_entries_parallel(self, workers=2, parse_headers=False, start=0):
+        """
+        scan_entries_parallel - Find the byte offset and name of every entry using several processes
+
+        The file is cut into one byte range per worker. Each range owns exactly
+        the entries whose "Name: " line begins inside it, which aligns every cut
+        to the next record boundary. The ranges are scanned concurrently and the
+        results are returned in file order, so they are identical to scan_entries().
+        Each worker sends its entries back as arrays (see scan_entries_in_range()),
+        since pickling a tuple per entry would cost more than the scan itself.
 
         Parameters
         ----------
+        workers : int
+            Number of worker processes to use
+        parse_headers : bool
+            If set, also extract the header metadata of each entry (see scan_entries())
+        start : int
+            Byte offset at which to start looking for entries
 
         Returns
         -------
-        int
-            Description of return value
+        generator
+            Yields the same tuples as scan_entries() in file order
+        """
+
+        file_size = os.path.getsize(self.filename)
+        range_size = int((file_size - start) / workers) + 1
+        ranges = [ (self.filename, start + i_range * range_size, min(start + (i_range + 1) * range_size, file_size), parse_headers)
+            for i_range in range(workers) ]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for entries in executor.map(scan_entries_in_range, ranges):
+                offsets = entries['offsets'].tolist()
+                lengths = entries['lengths'].tolist()
+                names = entries['names'].split("\n") if len(offsets) > 0 else []
+                if not parse_headers:
+                    for entry in zip(offsets, lengths, names):
+                        yield(entry)
+                    continue
+
+                #### Restore the missing header values from their placeholders
+                peptide_sequences = entries['peptide_sequences'].split("\n") if len(offsets) > 0 else []
+                mods = entries['mods'].split("\n") if len(offsets) > 0 else []
+                charges = entries['charges'].tolist()
+                precursor_mzs = entries['precursor_mzs'].tolist()
+                n_peaks = entries['n_peaks'].tolist()
+                for i in range(len(offsets)):
+                    metadata = { 'peptide_sequence': peptide_sequences[i] or None, 'charge': charges[i] if charges[i] >= 0 else None,
+                        'precursor_mz': precursor_mzs[i] if precursor_mzs[i] == precursor_mzs[i] else None,
+                        'n_peaks': n_peaks[i] if n_peaks[i] >= 0 else None, 'mods': mods[i] or None }
+                    yield( (offsets[i], lengths[i], names[i], metadata) )
+
+
+    def read_spectrum(self, offset=None, length=None):
+        """
+        read_spectrum - Read the lines of one spectrum entry at the specified offset
+
+        The library is kept memory-mapped between calls, so this is just a slice
+        of the map. If the length of the entry is not known (as with an index
+        created before lengths were stored), the end is found by searching for
+        the next entry.
+
+        Parameters
+        ----------
+        offset : int
+            Byte offset of the beginning of the entry
+        length : int
+            Length in bytes of the entry, if known
+
+        Returns
+        -------
+        list
+            List of the non-empty lines of the entry, with trailing whitespace removed
         """
 
         #### Check that an offset is supplied
@@ -260,60 +495,197 @@ class SpectrumLibrary:
             eprint("ERROR: Unable to read library with no filename")
             return(False)
 
-        with open(filename, 'r') as infile:
-            infile.seek(offset)
-            state = 'body'
-            spectrum_buffer = []
-            n_spectra = 0
-            start_index = 0
-            file_offset = 0
-            line_beginning_file_offset = 0
-            spectrum_file_offset = 0
-            spectrum_name = ''
-            for line in infile:
-                line_beginning_file_offset = file_offset
-                file_offset += len(line)
-                line = line.rstrip()
-                if state == 'body':
-                    if len(line) == 0:
-                        continue
-                    if re.match('Name: ',line):
-                        if len(spectrum_buffer) > 0:
-                            #parse(spectrum_buffer)
-                            return(spectrum_buffer)
-                        spectrum_file_offset = line_beginning_file_offset
-                        spectrum_name = re.match('Name:\s+(.+)',line).group(1)
-                        #print(spectrum_name)
-                    spectrum_buffer.append(line)
-
-            #### We will end up here if this is the last spectrum in the file
-            #parse(spectrum_buffer)
-            return(spectrum_buffer)
+        buffer = self.get_buffer()
+        if length is None:
+            match = entry_name_regex.search(buffer, offset + 1)
+            if match is not None:
+                length = match.start() - offset
+            else:
+                length = len(buffer) - offset
 
-        return(False)
+        return(decode_entry(buffer, offset, length))
+
+
+    def iter_spectra(self, start=0, stop=None, parse=True, charge=None, min_precursor_mz=None, max_precursor_mz=None, filter_function=None,
+            lazy_attributes=False):
+        """
+        iter_spectra - Iterate over the spectra of the library in file order
+
+        The library is read in a single sequential pass over the memory map and
+        only one entry is decoded at a time, so memory use does not grow with
+        the size of the library. The charge and precursor m/z filters are
+        applied to the raw entry header before any parsing.
+
+        Parameters
+        ----------
+        start : int
+            Index number of the first spectrum to return
+        stop : int
+            Stop before the spectrum with this index number (default: end of library)
+        parse : bool
+            If set, return parsed LibrarySpectrum objects, otherwise the lists of entry lines
+        charge : int
+            If supplied, only return spectra with this precursor charge
+        min_precursor_mz : float
+            If supplied, only return spectra with at least this precursor m/z
+        max_precursor_mz : float
+            If supplied, only return spectra with at most this precursor m/z
+        filter_function : function
+            If supplied, only return spectra for which this returns True when called with the spectrum
+        lazy_attributes : bool
+            If set, only convert the attributes of a parsed spectrum when they are first accessed,
+            so that workloads that only use the peaks skip the conversion
+
+        Returns
+        -------
+        generator
+            Yields a (spectrum_index_number, spectrum) tuple for each selected spectrum
+        """
+
+        filename = self.filename
+        if filename is None:
+            eprint("ERROR: Unable to read library with no filename")
+            return
+
+        #### If there is a current index, jump straight to the first requested spectrum
+        number = 0
+        start_offset = 0
+        if start > 0 and self.index is not None and self.check_index().library_state == 'current':
+            offset, length = self.index.get_location(spectrum_index_number=start)
+            if offset is not None:
+                number = start
+                start_offset = offset
+
+        parse_headers = charge is not None or min_precursor_mz is not None or max_precursor_mz is not None
+        buffer = None
+        for entry in self.scan_entries(start=start_offset, parse_headers=parse_headers):
+            if stop is not None and number >= stop:
+                break
+            spectrum_index_number = number
+            number += 1
+            if spectrum_index_number < start:
+                continue
+
+            if parse_headers:
+                metadata = entry[3]
+                if charge is not None and metadata['charge'] != charge:
+                    continue
+                precursor_mz = metadata['precursor_mz']
+                if min_precursor_mz is not None and ( precursor_mz is None or precursor_mz < min_precursor_mz ):
+                    continue
+                if max_precursor_mz is not None and ( precursor_mz is None or precursor_mz > max_precursor_mz ):
+                    continue
+
+            if buffer is None:
+                buffer = self.get_buffer()
+            spectrum = decode_entry(buffer, entry[0], entry[1])
+            if parse:
+                spectrum = LibrarySpectrum().parse(spectrum, spectrum_index=spectrum_index_number, lazy=lazy_attributes)
+            if filter_function is not None and not filter_function(spectrum):
+                continue
+            yield( (spectrum_index_number, spectrum) )
+
+
+    def get_buffer(self):
+        """
+        get_buffer - Return a persistent read-only memory map of the library file
+
+        Returns
+        -------
+        mmap
+            Memory map of the whole library file
+        """
 
+        if self.buffer is None:
+            with open(self.filename, 'rb') as infile:
+                self.buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return(self.buffer)
 
-    def write(self):
+
+    def close(self):
+        """
+        close - Release the memory map of the library file and close the index
+
+        Returns
+        -------
+        bool
+            True when done
+        """
+
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        if self.index is not None:
+            self.index.disconnect()
+            self.index = None
+        self.search_engine = None
+        self.fragment_index = None
+        return(True)
+
+
+    def write(self, filename=None, format="binary", spectra=None):
         """
         write - Write the library to disk
 
-        Extended description of function.
+        Spectra are taken one at a time from the iterator and their lines are
+        passed straight to a buffered file with writelines(), so memory use does
+        not depend on the size of the library.
 
         Parameters
         ----------
+        filename : string
+            Name of the file to write
+        format : string
+            Output format. 'binary' writes the memory-mappable columnar format read by BinarySpectrumLibrary,
+            'text', 'tsv', 'csv', 'msp' and 'jsonl' write each spectrum as with LibrarySpectrum.write()
+            and 'json' writes a JSON array of all spectra
+        spectra : iterable
+            (spectrum_index_number, LibrarySpectrum) tuples to write (default: all spectra of this library)
 
         Returns
         -------
         int
-            Description of return value
+            Number of spectra written
         """
 
-        #### Begin functionality here
+        if filename is None:
+            eprint("ERROR: Required parameter filename is not supplied")
+            return(False)
+        if spectra is None:
+            spectra = self.iter_spectra()
+
+        format = format.lower()
+        if format == "binary":
+            return(write_binary_library(filename, spectra))
+        if format not in entry_separators and format != "json":
+            raise ValueError(f"ERROR: Unrecogized format '{format}'")
+
+        n_spectra = 0
+        with open(filename, 'w', buffering=write_buffer_size) as outfile:
+
+            #### A JSON library is an array of the spectrum objects
+            if format == "json":
+                outfile.write("[\n")
+                for spectrum_index_number, spectrum in spectra:
+                    if n_spectra > 0:
+                        outfile.write(",\n")
+                    outfile.writelines(spectrum.write_lines(format="json"))
+                    n_spectra += 1
+                outfile.write("\n]\n")
 
-        return()
+            else:
+                separator = entry_separators[format]
+                for spectrum_index_number, spectrum in spectra:
+                    outfile.writelines(spectrum.write_lines(format=format))
+                    if separator:
+                        outfile.write(separator)
+                    n_spectra += 1
+
+        if debug: eprint(f"INFO: Wrote {n_spectra} spectra to {filename}")
+        return(n_spectra)
 
 
-    def create_index(self):
+    def create_index(self, workers=None):
         """
         create_index - Create an index file for this library
 
@@ -321,70 +693,650 @@ class SpectrumLibrary:
 
         Parameters
         ----------
+        workers : int
+            If greater than 1, scan the library with this many processes
 
         Returns
         -------
         int
-            Description of return value
+            Number of spectra in the index
         """
 
-        self.read(create_index=True)
-        return()
+        n_spectra = self.read(create_index=True, workers=workers)
+        return(n_spectra)
 
 
-    def get_spectrum(self,spectrum_index_number=None,spectrum_name=None):
+    def update_index(self, workers=None):
         """
-        get_spectrum - Extract a single spectrum by identifier
+        update_index - Bring the index up to date with the library file
 
-        Extended description of function.
+        If the library has not changed since it was indexed, nothing is done. If
+        entries were only appended, the last indexed entry (which may have been
+        incomplete) and everything after it are re-indexed. Otherwise the index
+        is created anew.
 
         Parameters
         ----------
+        workers : int
+            If greater than 1, scan the library with this many processes
 
         Returns
         -------
         int
-            Description of return value
+            Number of spectra in the index
         """
 
-        #### Begin functionality here
         if self.index is None:
             self.index = SpectrumLibraryIndex( library_filename=self.filename )
 
-        #### If spectrum_index_number was specified, find the spectrum by that
-        if spectrum_index_number is not None:
-            offset = self.index.get_offset(spectrum_index_number=spectrum_index_number)
+        library_state = self.index.check_library_state()
+        if debug: eprint(f"INFO: Library state relative to the index is '{library_state}'")
+        if library_state == 'current':
+            return(self.index.n_spectra)
+
+        #### Any existing map of the library file no longer covers the whole file
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+        if library_state == 'appended':
+            last_number, last_offset = self.index.get_last_record()
+            if last_number is not None:
+                return(self.read(create_index=True, workers=workers, start_number=last_number, start_offset=last_offset))
+
+        return(self.create_index(workers=workers))
+
+
+    def check_index(self):
+        """
+        check_index - Make sure that the index matches the library file before reading at its offsets
+
+        The library file is only compared with the state recorded in the index
+        when its size, modification time or inode differ from when it was last
+        verified, so this is cheap to call before every read. If the library has
+        changed, any memory map of the old file is dropped, and the index is
+        brought up to date with update_index(), or if update_stale_index is not
+        set, an exception is raised rather than reading at offsets that no
+        longer hold the indexed entries.
+
+        Returns
+        -------
+        SpectrumLibraryIndex
+            The index of the library, current with the library file
+        """
+
+        if self.index is None:
+            self.index = SpectrumLibraryIndex( library_filename=self.filename )
+        try:
+            stat = os.stat(self.filename)
+        except OSError as error:
+            raise Exception(f"ERROR: Unable to read library {self.filename}: {error}")
+        library_stat = ( stat.st_size, stat.st_mtime_ns, stat.st_ino )
+        if library_stat == self.verified_library_stat:
+            return(self.index)
+
+        #### The file changed since it was last verified (or was never verified), so a memory map of it may be out of date
+        if self.verified_library_stat is not None and self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+        library_state = self.index.check_library_state()
+        if library_state == 'appended' or library_state == 'changed':
+            if not update_stale_index:
+                self.index.library_state = library_state
+                self.index.status = 'stale'
+                raise Exception(f"ERROR: The index of {self.filename} is out of date with the library ({library_state}). Run update_index() first")
+            if debug: eprint(f"INFO: Library {self.filename} has {library_state} since it was indexed. Updating the index")
+            self.update_index()
+        else:
+            self.index.library_state = library_state
+            self.index.status = 'OK'
+
+        stat = os.stat(self.filename)
+        self.verified_library_stat = ( stat.st_size, stat.st_mtime_ns, stat.st_ino )
+        return(self.index)
+
+
+    def get_spectrum(self, spectrum_index_number=None, spectrum_name=None, parse=False):
+        """
+        get_spectrum - Extract a single spectrum by identifier
+
+        With parse set, the spectrum is returned as a LibrarySpectrum. Spectra
+        requested by index number are then kept in an LRU cache (see
+        SpectrumLibraryCache), so that repeated requests for popular spectra do
+        not read and parse the entry again. Cached spectra are shared between
+        callers and should not be modified.
+
+        Parameters
+        ----------
+        spectrum_index_number : int
+            Index number of the spectrum in the library
+        spectrum_name : string
+            Name of the spectrum, used if spectrum_index_number is not supplied
+        parse : bool
+            If set, return a parsed LibrarySpectrum instead of the lines of the entry
+
+        Returns
+        -------
+        list or LibrarySpectrum
+            The lines of the entry, or the parsed spectrum if parse is set
+        """
+
+        #### Return the parsed spectrum from the cache if it is there. The library is checked first, so that
+        #### a rewritten library re-indexes and drops its cached spectra instead of returning old ones
+        self.check_index()
+        cache = self.spectrum_cache if parse and spectrum_index_number is not None else None
+        if cache is not None:
+            library_filename = os.path.abspath(self.filename)
+            spectrum = cache.get(library_filename, int(spectrum_index_number))
+            if spectrum is not None:
+                return(spectrum)
+
+        #### If spectrum_index_number was specified, find the spectrum by that, else try the name
+        if spectrum_index_number is not None or spectrum_name is not None:
+            identifier = spectrum_index_number if spectrum_index_number is not None else spectrum_name
+            offset, length = self.index.get_location(spectrum_index_number=spectrum_index_number, spectrum_name=spectrum_name)
             if offset is not None:
-                if debug: print(f'Found offset {offset} for spectrum {spectrum_index_number}')
+                if debug: print(f'Found offset {offset} for spectrum {identifier}')
             else:
-                if debug: print(f'Unable to find offset for spectrum {spectrum_index_number}')
-            spectrum_buffer = self.read_spectrum(offset=offset)
-            return(spectrum_buffer)
+                if debug: print(f'Unable to find offset for spectrum {identifier}')
+            spectrum_buffer = self.read_spectrum(offset=offset, length=length)
+            if not parse or not spectrum_buffer:
+                return(spectrum_buffer)
+            spectrum = LibrarySpectrum()
+            spectrum.parse(spectrum_buffer, spectrum_index=spectrum_index_number)
+            if cache is not None:
+                cache.put(library_filename, int(spectrum_index_number), spectrum)
+            return(spectrum)
         return()
 
 
-    def find_spectra(self):
+    def get_spectra(self, spectrum_index_numbers=None, parse=False):
         """
-        find_spectra - Return a list of spectra given query constraints
+        get_spectra - Extract many spectra by index number with one index query and one forward pass over the library
 
-        Extended description of function.
+        The locations of all requested spectra are resolved with one batched index
+        query and sorted by file offset. Entries that are adjacent in the file
+        (or separated by less than max_read_gap bytes) are read with a single
+        read of the memory map, and the whole batch is read in one forward pass.
+        With parse set, spectra already in the cache are not read again and the
+        newly parsed spectra are added to it (see get_spectrum()).
 
         Parameters
         ----------
+        spectrum_index_numbers : list
+            Index numbers of the spectra to extract, possibly with duplicates
+        parse : bool
+            If set, return parsed LibrarySpectrum objects instead of the lines of the entries
+
+        Returns
+        -------
+        list
+            The lines of each entry, or the parsed spectrum if parse is set, in the requested order,
+            with None for any spectrum not found or any identifier that is not a valid index number
+        """
+
+        if spectrum_index_numbers is None:
+            raise ValueError("ERROR: Required parameter spectrum_index_numbers is not supplied")
+
+        #### An identifier that is not a valid index number gets None, like a spectrum that is not found
+        numbers = []
+        for number in spectrum_index_numbers:
+            try:
+                if isinstance(number, float) and not number.is_integer():
+                    raise ValueError
+                number = int(number)
+            except (TypeError, ValueError, OverflowError):
+                number = None
+            if number is not None and not 0 <= number < 2**63:
+                number = None
+            numbers.append(number)
+
+        #### Take what is already cached, and collect each distinct remaining spectrum once
+        self.check_index()
+        results = {}
+        cache = self.spectrum_cache if parse else None
+        library_filename = os.path.abspath(self.filename)
+        wanted_numbers = []
+        for number in dict.fromkeys(numbers):
+            if number is None:
+                continue
+            if cache is not None:
+                spectrum = cache.get(library_filename, number)
+                if spectrum is not None:
+                    results[number] = spectrum
+                    continue
+            wanted_numbers.append(number)
+
+        if len(wanted_numbers) > 0:
+            locations = self.index.get_locations(spectrum_index_numbers=wanted_numbers)
+            buffer = self.get_buffer()
+
+            #### Sort the entries by offset, finding the end of any entry whose length was not indexed
+            entries = []
+            for number, (offset, length) in zip(wanted_numbers, locations):
+                if offset is None:
+                    continue
+                if length is None:
+                    match = entry_name_regex.search(buffer, offset + 1)
+                    length = match.start() - offset if match is not None else len(buffer) - offset
+                entries.append( (offset, length, number) )
+            entries.sort()
+
+            #### Read each run of nearby entries at once and split it into the entries
+            i_entry = 0
+            n_reads = 0
+            while i_entry < len(entries):
+                run_start = entries[i_entry][0]
+                run_end = run_start + entries[i_entry][1]
+                j_entry = i_entry + 1
+                while j_entry < len(entries) and entries[j_entry][0] <= run_end + max_read_gap:
+                    run_end = max(run_end, entries[j_entry][0] + entries[j_entry][1])
+                    j_entry += 1
+                run = buffer[run_start:run_end]
+                n_reads += 1
+                for offset, length, number in entries[i_entry:j_entry]:
+                    lines = decode_entry(run, offset - run_start, length)
+                    if parse:
+                        spectrum = LibrarySpectrum()
+                        spectrum.parse(lines, spectrum_index=number)
+                        if cache is not None:
+                            cache.put(library_filename, number, spectrum)
+                        results[number] = spectrum
+                    else:
+                        results[number] = lines
+                i_entry = j_entry
+            if debug: eprint(f"INFO: Read {len(entries)} spectra from {self.filename} in {n_reads} reads")
+
+        return( [ results.get(number) for number in numbers ] )
+
+
+    def convert(self, output_filename=None, format="text", workers=None, batch_size=1000, max_pending_batches=None):
+        """
+        convert - Parse every spectrum of the library and write it out in another format
+
+        The raw entries are read sequentially with iter_spectra() and grouped into
+        batches. Each batch is parsed and written with LibrarySpectrum.write() in a
+        pool of worker processes, and the results are written out in the original
+        order. Only a bounded number of batches is in flight at any time, so memory
+        use stays flat regardless of the size of the library.
+        As with write(), the 'json' format writes a JSON array of all spectra.
+
+        Parameters
+        ----------
+        output_filename : string
+            Name of the file to write
+        format : string
+            Output format, any supported by LibrarySpectrum.write()
+        workers : int
+            Number of worker processes. If 1 or None, convert in this process
+        batch_size : int
+            Number of spectra to send to a worker at a time
+        max_pending_batches : int
+            Maximum number of batches queued or being converted (default: twice the number of workers)
 
         Returns
         -------
         int
-            Description of return value
+            Number of spectra converted
         """
 
-        #### Begin functionality here
+        if output_filename is None:
+            eprint("ERROR: Required parameter output_filename is not supplied")
+            return(False)
+        if max_pending_batches is None:
+            max_pending_batches = 2 * (workers or 1)
+
+        #### A JSON library is an array of the spectrum objects, so the batches are joined with commas inside brackets
+        format = format.lower()
+        is_json = format == "json"
+        n_spectra = 0
+        n_written = 0
+        with open(output_filename, 'w') as outfile:
+            if is_json:
+                outfile.write("[\n")
+
+            #### Convert in this process
+            if workers is None or workers <= 1:
+                for batch in self.iter_batches(batch_size=batch_size):
+                    if is_json and n_written > 0:
+                        outfile.write(",\n")
+                    outfile.write(convert_batch( (format, batch) ))
+                    n_written += 1
+                    n_spectra += len(batch)
+
+            #### Or fan the batches out to a process pool, collecting the results in order
+            else:
+                pending_batches = collections.deque()
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    for batch in self.iter_batches(batch_size=batch_size):
+                        if len(pending_batches) >= max_pending_batches:
+                            if is_json and n_written > 0:
+                                outfile.write(",\n")
+                            outfile.write(pending_batches.popleft().result())
+                            n_written += 1
+                        pending_batches.append(executor.submit(convert_batch, (format, batch)))
+                        n_spectra += len(batch)
+                    while len(pending_batches) > 0:
+                        if is_json and n_written > 0:
+                            outfile.write(",\n")
+                        outfile.write(pending_batches.popleft().result())
+                        n_written += 1
+
+            if is_json:
+                outfile.write("\n]\n")
+
+        if debug: eprint(f"INFO: Converted {n_spectra} spectra to {format} in {output_filename}")
+        return(n_spectra)
 
-        return()
 
+    def iter_batches(self, batch_size=1000):
+        """
+        iter_batches - Iterate over the raw entries of the library in batches
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of entries per batch
+
+        Returns
+        -------
+        generator
+            Yields lists of (spectrum_index_number, spectrum_buffer) tuples in file order
+        """
+
+        batch = []
+        for entry in self.iter_spectra(parse=False):
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield(batch)
+                batch = []
+        if len(batch) > 0:
+            yield(batch)
+
+
+    def create_table(self, with_peaks=True, save=True):
+        """
+        create_table - Build a columnar table of the whole library in one streaming pass
+
+        The header metadata of each entry is extracted from the raw bytes (see
+        parse_entry_header()) and the peaks are appended to shared m/z and intensity
+        arrays, so no LibrarySpectrum objects are created.
+
+        Parameters
+        ----------
+        with_peaks : bool
+            If set, also collect the peaks of all spectra
+        save : bool
+            If set, save the table next to the library so that load_table() can read it back
+
+        Returns
+        -------
+        SpectrumLibraryTable
+            The table of all spectra in the library
+        """
+
+        filename = self.filename
+        if filename is None:
+            eprint("ERROR: Unable to create a table for a library with no filename")
+            return(None)
+
+        t0 = timeit.default_timer()
+        columns = { 'offset': [], 'length': [], 'name': [], 'peptide_sequence': [], 'charge': [], 'precursor_mz': [], 'n_peaks': [], 'mods': [] }
+        mzs = array.array('d')
+        intensities = array.array('f')
+        peak_offsets = array.array('q', [ 0 ])
+        buffer = None
+        for offset, length, name, metadata in self.scan_entries(parse_headers=True):
+            columns['offset'].append(offset)
+            columns['length'].append(length)
+            columns['name'].append(name)
+            columns['peptide_sequence'].append(metadata['peptide_sequence'] or '')
+            columns['charge'].append(metadata['charge'] or 0)
+            columns['precursor_mz'].append(metadata['precursor_mz'] if metadata['precursor_mz'] is not None else np.nan)
+            columns['mods'].append(metadata['mods'] or '')
+            if with_peaks:
+                if buffer is None:
+                    buffer = self.get_buffer()
+                n_peaks = parse_entry_peaks(buffer, offset, length, mzs, intensities)
+                peak_offsets.append(peak_offsets[-1] + n_peaks)
+            else:
+                n_peaks = metadata['n_peaks'] or 0
+                peak_offsets.append(peak_offsets[-1])
+            columns['n_peaks'].append(n_peaks)
+        columns['number'] = np.arange(len(columns['offset']), dtype=np.int64)
+
+        table = SpectrumLibraryTable(columns=columns, mzs=np.frombuffer(mzs, dtype=np.float64),
+            intensities=np.frombuffer(intensities, dtype=np.float32), peak_offsets=np.frombuffer(peak_offsets, dtype=np.int64))
+        t1 = timeit.default_timer()
+        if debug: eprint(f"INFO: Built a table of {len(table)} spectra and {len(table.mzs)} peaks in {t1-t0:.3f} s")
+
+        if save:
+            table_filename = filename + table_suffix
+            try:
+                table.save(table_filename, library_size=os.path.getsize(filename))
+            except OSError as error:
+                eprint(f"WARNING: Unable to write table {table_filename}: {error}")
+        return(table)
+
+
+    def load_table(self, create=True):
+        """
+        load_table - Load the columnar table of the library saved by create_table()
+
+        Parameters
+        ----------
+        create : bool
+            If set, build the table if there is no saved table or it is older than the library or its index
+
+        Returns
+        -------
+        SpectrumLibraryTable
+            The table of all spectra in the library, or None if it is not available
+        """
+
+        filename = self.filename
+        table_filename = filename + table_suffix
+        table = SpectrumLibraryTable.load(table_filename, library_filename=filename)
+        if table is None and create:
+            table = self.create_table()
+        return(table)
+
+
+    def find_spectra(self, precursor_mz=None, tolerance=20, tolerance_units='ppm', charge=None, peptide_sequence=None):
+        """
+        find_spectra - Return a list of spectra given query constraints
+
+        The candidates are selected from the index with a precursor m/z range
+        and/or peptide sequence query, and only those entries are read from the library.
+
+        Parameters
+        ----------
+        precursor_mz : float
+            Precursor m/z to search for
+        tolerance : float
+            Half-width of the search window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        charge : integer
+            If supplied, only select spectra with this precursor charge
+        peptide_sequence : string
+            If supplied, only select spectra with this unmodified peptide sequence
+
+        Returns
+        -------
+        list
+            List of (spectrum_index_number, spectrum_buffer) tuples, ordered by precursor m/z
+        """
+
+        self.check_index()
+
+        spectra = []
+        records = self.index.find_offsets(precursor_mz=precursor_mz, tolerance=tolerance, tolerance_units=tolerance_units, charge=charge,
+            peptide_sequence=peptide_sequence)
+        for number, offset, length in records:
+            spectra.append( (number, self.read_spectrum(offset=offset, length=length)) )
+        return(spectra)
+
+
+    def search_spectra(self, query_spectra=None, top_n=10, tolerance=20, tolerance_units='ppm', bin_width=default_bin_width, top_k_peaks=None,
+            use_charge=True, method='auto'):
+        """
+        search_spectra - Return the most similar library spectra for each of many query spectra
+
+        The library spectra within the precursor m/z tolerance of each query are
+        scored by the cosine similarity of their binned peaks (see SpectrumLibrarySearch).
+        The binned library is built on the first search, kept for later searches
+        and saved next to the index for later sessions.
+
+        Parameters
+        ----------
+        query_spectra : list
+            LibrarySpectrum objects or (mzs, intensities, precursor_mz, charge) tuples
+        top_n : int
+            Maximum number of hits to return per query
+        tolerance : float
+            Half-width of the precursor m/z window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        bin_width : float
+            Width of the m/z bins
+        top_k_peaks : int
+            If supplied, only use this many most intense peaks of each spectrum
+        use_charge : bool
+            If set, only score library spectra with the same charge as the query when it is known
+        method : string
+            'candidates', 'matrix' or 'auto' (see SpectrumLibrarySearch.search_batch())
+
+        Returns
+        -------
+        list
+            A list of (spectrum_index_number, score) tuples, best first, for each query
+        """
+
+        if query_spectra is None:
+            raise ValueError("ERROR: Required parameter query_spectra is not supplied")
+        self.check_index()
+        if self.search_engine is None or self.search_engine.bin_width != bin_width or self.search_engine.top_k_peaks != top_k_peaks:
+            self.search_engine = SpectrumLibrarySearch(spectrum_library=self, bin_width=bin_width, top_k_peaks=top_k_peaks)
+        return(self.search_engine.search_batch(query_spectra, tolerance=tolerance, tolerance_units=tolerance_units, top_n=top_n,
+            use_charge=use_charge, method=method))
 
 
+    def search_open(self, query_spectra=None, top_n=10, fragment_tolerance=0.02, min_shared_peaks=6, max_candidates=1000,
+            bin_width=default_bin_width, fragment_bin_width=default_fragment_bin_width, fragment_top_k_peaks=default_fragment_top_k_peaks):
+        """
+        search_open - Return the most similar library spectra for each query spectrum regardless of precursor m/z
+
+        For open modification searches the precursor m/z cannot restrict the
+        candidates. Instead, the library spectra that share the most fragment
+        ions with each query are found with the fragment ion index (see
+        SpectrumLibraryFragmentIndex), and only those are scored by the cosine
+        similarity of their binned peaks. Both the index and the binned library
+        are built on the first search and saved next to the index.
 
+        Parameters
+        ----------
+        query_spectra : list
+            LibrarySpectrum objects or (mzs, intensities) tuples
+        top_n : int
+            Maximum number of hits to return per query
+        fragment_tolerance : float
+            Fragment m/z tolerance for counting shared peaks
+        min_shared_peaks : int
+            Minimum number of shared peaks for a library spectrum to be scored
+        max_candidates : int
+            Maximum number of library spectra with the most shared peaks to score per query
+        bin_width : float
+            Width of the m/z bins for scoring
+        fragment_bin_width : float
+            Width of the m/z bins of the fragment ion index
+        fragment_top_k_peaks : int
+            Number of the most intense peaks of each spectrum in the fragment ion index, or None for all peaks
+
+        Returns
+        -------
+        list
+            A list of (spectrum_index_number, score) tuples, best first, for each query
+        """
+
+        if query_spectra is None:
+            raise ValueError("ERROR: Required parameter query_spectra is not supplied")
+        self.check_index()
+        if self.fragment_index is None or self.fragment_index.bin_width != fragment_bin_width or self.fragment_index.top_k_peaks != fragment_top_k_peaks:
+            self.fragment_index = SpectrumLibraryFragmentIndex(spectrum_library=self, bin_width=fragment_bin_width, top_k_peaks=fragment_top_k_peaks)
+        if self.search_engine is None or self.search_engine.bin_width != bin_width or self.search_engine.top_k_peaks is not None:
+            self.search_engine = SpectrumLibrarySearch(spectrum_library=self, bin_width=bin_width)
+
+        hits = []
+        for query in query_spectra:
+            if isinstance(query, LibrarySpectrum):
+                mzs, intensities = query.mzs, query.intensities
+            else:
+                mzs, intensities = query[0], query[1]
+            candidates = self.fragment_index.find_candidates(mzs, intensities=intensities, tolerance=fragment_tolerance,
+                min_shared_peaks=min_shared_peaks, max_candidates=max_candidates)
+            hits.append(self.search_engine.search(mzs, intensities, top_n=top_n, candidates=candidates))
+        return(hits)
+
+
+
+
+
+
+#### Parse and write out one batch of raw entries in a worker process
+def convert_batch(format_and_batch):
+    format, batch = format_and_batch
+    format = format.lower()
+    buffers = []
+    for spectrum_index_number, spectrum_buffer in batch:
+        spectrum = LibrarySpectrum()
+        spectrum.parse(spectrum_buffer, spectrum_index=spectrum_index_number)
+
+        #### JSON objects are separated by commas within the batch, and convert() joins the batches into one array
+        if format == "json":
+            if len(buffers) > 0:
+                buffers.append(",\n")
+            buffers.extend(spectrum.write_lines(format=format))
+        else:
+            buffers.extend(spectrum.write_lines(format=format))
+            buffers.append(entry_separators.get(format, "\n"))
+    return("".join(buffers))
+
+
+#### Scan one byte range of a library in a worker process. The entries are returned as a dict of arrays and
+#### newline-joined strings, with -1, NaN or an empty string for missing header values, which is far cheaper
+#### to send back to the parent process than a list of tuples
+def scan_entries_in_range(byte_range):
+    filename, start, end, parse_headers = byte_range
+    spectrum_library = SpectrumLibrary()
+    spectrum_library.filename = filename
+    offsets = array.array('q')
+    lengths = array.array('q')
+    names = []
+    charges = array.array('q')
+    precursor_mzs = array.array('d')
+    n_peaks = array.array('q')
+    peptide_sequences = []
+    mods = []
+    for entry in spectrum_library.scan_entries(start=start, end=end, parse_headers=parse_headers):
+        offsets.append(entry[0])
+        lengths.append(entry[1])
+        names.append(entry[2])
+        if parse_headers:
+            metadata = entry[3]
+            charges.append(metadata['charge'] if metadata['charge'] is not None else -1)
+            precursor_mzs.append(metadata['precursor_mz'] if metadata['precursor_mz'] is not None else np.nan)
+            n_peaks.append(metadata['n_peaks'] if metadata['n_peaks'] is not None else -1)
+            peptide_sequences.append(metadata['peptide_sequence'] or "")
+            mods.append(metadata['mods'] or "")
+
+    entries = { 'offsets': np.frombuffer(offsets, dtype=np.int64), 'lengths': np.frombuffer(lengths, dtype=np.int64),
+        'names': "\n".join(names) }
+    if parse_headers:
+        entries.update( { 'charges': np.frombuffer(charges, dtype=np.int64), 'precursor_mzs': np.frombuffer(precursor_mzs, dtype=np.float64),
+            'n_peaks': np.frombuffer(n_peaks, dtype=np.int64), 'peptide_sequences': "\n".join(peptide_sequences), 'mods': "\n".join(mods) } )
+    return(entries)
 
 
 #### Example using this class
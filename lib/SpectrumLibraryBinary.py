@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
+
+import os
+import json
+import array
+import shutil
+import tempfile
+
+import numpy as np
+
+from LibrarySpectrum import LibrarySpectrum, attribute_keys, get_attribute_key_code
+
+debug = True
+
+#### The binary library file starts with this magic string and then the offset and length of its table of contents
+binary_magic = b'SPLBIN01'
+binary_version = 1
+header_dtype = np.dtype([ ('magic', 'S8'), ('toc_offset', '<u8'), ('toc_length', '<u8') ])
+
+#### Fixed-width record for each spectrum, pointing into the peak and attribute sections
+record_dtype = np.dtype([ ('number', '<i8'), ('precursor_mz', '<f8'), ('peak_offset', '<i8'), ('attribute_offset', '<i8'),
+    ('n_peaks', '<i4'), ('n_attributes', '<i4'), ('charge', '<i4'), ('group_counter', '<i4') ])
+
+#### Sections of the file in the order they are written, with the type of their elements
+section_dtypes = {
+    'records': record_dtype,
+    'mzs': np.dtype('<f8'),
+    'intensities': np.dtype('<f4'),
+    'interpretation_offsets': np.dtype('<i8'),
+    'interpretations': np.dtype('u1'),
+    'attribute_codes': np.dtype('<u4'),
+    'attribute_groups': np.dtype('<u4'),
+    'attribute_types': np.dtype('u1'),
+    'value_offsets': np.dtype('<i8'),
+    'values': np.dtype('u1'),
+}
+
+#### Codes for the Python types of attribute values
+value_types = { str: 0, int: 1, float: 2, type(None): 3 }
+value_decoders = [ str, int, float, lambda value: None ]
+
+def write_binary_library(filename, spectra):
+    """
+    write_binary_library - Write spectra to a binary columnar library file
+
+    Each section is streamed to its own temporary file next to the output and
+    the sections are then concatenated, so memory use does not depend on the
+    number of spectra. The layout is a header, then the sections in the order of
+    section_dtypes, each aligned to 8 bytes, and finally a JSON table of contents
+    with the section locations and the attribute key dictionary.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the file to write
+    spectra : iterable
+        (spectrum_index_number, LibrarySpectrum) tuples to write
+
+    Returns
+    -------
+    int
+        Number of spectra written
+    """
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    section_files = { name: tempfile.TemporaryFile(dir=directory) for name in section_dtypes }
+    try:
+        #### Key codes in the file are positions in its own attribute key dictionary
+        file_keys = []
+        file_key_codes = {}
+
+        n_spectra = 0
+        n_peaks = 0
+        n_attributes = 0
+        n_interpretation_bytes = 0
+        n_value_bytes = 0
+        section_files['interpretation_offsets'].write(np.zeros(1, dtype='<i8').tobytes())
+        section_files['value_offsets'].write(np.zeros(1, dtype='<i8').tobytes())
+        record = np.zeros(1, dtype=record_dtype)
+
+        for spectrum_index_number, spectrum in spectra:
+            spectrum.convert_pending_attributes()
+
+            #### Peaks
+            section_files['mzs'].write(np.asarray(spectrum.mzs, dtype='<f8').tobytes())
+            section_files['intensities'].write(np.asarray(spectrum.intensities, dtype='<f4').tobytes())
+            interpretations = [ interpretation.encode('utf-8') for interpretation in spectrum.get_interpretations() ]
+            lengths = np.fromiter( (len(interpretation) for interpretation in interpretations), dtype='<i8', count=len(interpretations) )
+            section_files['interpretation_offsets'].write( (np.cumsum(lengths) + n_interpretation_bytes).astype('<i8').tobytes() )
+            section_files['interpretations'].writelines(interpretations)
+            n_interpretation_bytes += int(lengths.sum())
+
+            #### Attributes
+            codes = array.array('I')
+            types = bytearray()
+            values = []
+            for code, value in zip(spectrum.attribute_codes, spectrum.attribute_values):
+                key = attribute_keys[code]
+                file_code = file_key_codes.get(key)
+                if file_code is None:
+                    file_code = len(file_keys)
+                    file_keys.append(key)
+                    file_key_codes[key] = file_code
+                codes.append(file_code)
+                value_type = value_types.get(type(value), 0)
+                types.append(value_type)
+                values.append(b'' if value is None else str(value).encode('utf-8'))
+            section_files['attribute_codes'].write(np.asarray(codes, dtype='<u4').tobytes())
+            section_files['attribute_groups'].write(np.asarray(spectrum.attribute_groups, dtype='<u4').tobytes())
+            section_files['attribute_types'].write(bytes(types))
+            lengths = np.fromiter( (len(value) for value in values), dtype='<i8', count=len(values) )
+            section_files['value_offsets'].write( (np.cumsum(lengths) + n_value_bytes).astype('<i8').tobytes() )
+            section_files['values'].writelines(values)
+            n_value_bytes += int(lengths.sum())
+
+            #### The fixed-width record
+            record['number'] = spectrum_index_number
+            precursor_mz = spectrum.get_precursor_mz()
+            record['precursor_mz'] = precursor_mz if precursor_mz is not None else np.nan
+            record['charge'] = spectrum.get_charge() or 0
+            record['peak_offset'] = n_peaks
+            record['n_peaks'] = spectrum.n_peaks
+            record['attribute_offset'] = n_attributes
+            record['n_attributes'] = len(values)
+            record['group_counter'] = spectrum.group_counter
+            section_files['records'].write(record.tobytes())
+
+            n_peaks += spectrum.n_peaks
+            n_attributes += len(values)
+            n_spectra += 1
+
+        #### Concatenate the sections after the header, then append the table of contents
+        with open(filename, 'wb') as outfile:
+            outfile.write(np.zeros(1, dtype=header_dtype).tobytes())
+            sections = {}
+            for name, section_file in section_files.items():
+                position = outfile.tell()
+                if position % 8:
+                    outfile.write(b'\0' * (8 - position % 8))
+                    position = outfile.tell()
+                size = section_file.tell()
+                section_file.seek(0)
+                shutil.copyfileobj(section_file, outfile, 1024 * 1024)
+                sections[name] = [ position, size // section_dtypes[name].itemsize ]
+
+            toc = json.dumps( { 'version': binary_version, 'n_spectra': n_spectra, 'n_peaks': n_peaks, 'n_attributes': n_attributes,
+                'sections': sections, 'attribute_keys': file_keys } ).encode('utf-8')
+            toc_offset = outfile.tell()
+            outfile.write(toc)
+            header = np.array( [ (binary_magic, toc_offset, len(toc)) ], dtype=header_dtype)
+            outfile.seek(0)
+            outfile.write(header.tobytes())
+
+    finally:
+        for section_file in section_files.values():
+            section_file.close()
+
+    if debug: eprint(f"INFO: Wrote {n_spectra} spectra with {n_peaks} peaks to binary library {filename}")
+    return(n_spectra)
+
+
+class BinarySpectrumLibrary:
+    """
+    BinarySpectrumLibrary - Class for reading a binary columnar library file written by write_binary_library()
+
+    The file is memory-mapped and every section is exposed as a NumPy array view
+    on the map, so opening the library only reads the header and the table of
+    contents, and fetching a spectrum only touches its own bytes.
+
+    Attributes
+    ----------
+    filename : string
+        Name of the binary library file
+    n_spectra : int
+        Number of spectra in the library
+    records : numpy.ndarray
+        Fixed-width record of each spectrum (see record_dtype)
+
+    Methods
+    -------
+    get_peaks - Return views of the m/z values and intensities of one spectrum
+    get_spectrum - Return one spectrum as a LibrarySpectrum
+    iter_spectra - Iterate over the spectra in file order
+    close - Release the memory map
+
+    """
+
+
+    #### Constructor
+    def __init__(self, filename=None):
+        """
+        __init__ - BinarySpectrumLibrary constructor
+
+        Parameters
+        ----------
+        filename : string
+            Name of the binary library file to open
+
+        """
+
+        if filename is None:
+            raise Exception('Binary library filename missing')
+        self.filename = filename
+
+        self.buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+        header = self.buffer[:header_dtype.itemsize].view(header_dtype)[0]
+        if header['magic'] != binary_magic:
+            raise ValueError(f"ERROR: File '{filename}' is not a binary spectrum library")
+        toc_offset = int(header['toc_offset'])
+        toc = json.loads(bytes(self.buffer[toc_offset:toc_offset + int(header['toc_length'])]).decode('utf-8'))
+        if toc['version'] > binary_version:
+            raise ValueError(f"ERROR: Binary library version {toc['version']} of '{filename}' is not supported")
+
+        self.n_spectra = toc['n_spectra']
+        self.sections = {}
+        for name, (offset, count) in toc['sections'].items():
+            dtype = section_dtypes[name]
+            self.sections[name] = self.buffer[offset:offset + count * dtype.itemsize].view(np.ndarray).view(dtype)
+        self.records = self.sections['records']
+        self.peak_offsets = self.records['peak_offset']
+        self.attribute_offsets = self.records['attribute_offset']
+
+        #### Map the key codes of the file to the interned key codes of this process
+        self.attribute_keys = toc['attribute_keys']
+        self.key_code_map = np.array( [ get_attribute_key_code(key) for key in self.attribute_keys ], dtype=np.uint32)
+
+
+    #### Number of spectra in the library
+    def __len__(self):
+        return(self.n_spectra)
+
+
+    def get_peaks(self, spectrum_index_number):
+        """
+        get_peaks - Return views of the m/z values and intensities of one spectrum
+
+        Parameters
+        ----------
+        spectrum_index_number : int
+            Position of the spectrum in the library
+
+        Returns
+        -------
+        tuple
+            Read-only views of the m/z and intensity arrays
+        """
+
+        record = self.records[spectrum_index_number]
+        start = int(record['peak_offset'])
+        end = start + int(record['n_peaks'])
+        return( (self.sections['mzs'][start:end], self.sections['intensities'][start:end]) )
+
+
+    def get_spectrum(self, spectrum_index_number):
+        """
+        get_spectrum - Return one spectrum as a LibrarySpectrum
+
+        The peak arrays of the returned spectrum are read-only views of the
+        memory map, and the attributes are filled in from the attribute arrays
+        without any text parsing.
+
+        Parameters
+        ----------
+        spectrum_index_number : int
+            Position of the spectrum in the library
+
+        Returns
+        -------
+        LibrarySpectrum
+            The spectrum
+        """
+
+        if spectrum_index_number < 0 or spectrum_index_number >= self.n_spectra:
+            raise ValueError(f"ERROR: Spectrum index number {spectrum_index_number} is out of range")
+        sections = self.sections
+        record = self.records[spectrum_index_number]
+        spectrum = LibrarySpectrum()
+        spectrum.foreign_attributes = None
+
+        #### Peaks
+        peak_start = int(self.peak_offsets[spectrum_index_number])
+        peak_end = peak_start + int(record['n_peaks'])
+        spectrum.mzs = sections['mzs'][peak_start:peak_end]
+        spectrum.intensities = sections['intensities'][peak_start:peak_end]
+        offsets = sections['interpretation_offsets'][peak_start:peak_end + 1]
+        byte_start = int(offsets[0])
+        byte_end = int(offsets[-1])
+        interpretation_bytes = sections['interpretations'][byte_start:byte_end].tobytes()
+        interpretation_buffer = interpretation_bytes.decode('utf-8')
+        spectrum.interpretation_buffer = interpretation_buffer
+        offsets = offsets - byte_start
+
+        #### The byte offsets are also the character offsets unless there are multi-byte characters
+        if len(interpretation_buffer) == len(interpretation_bytes):
+            spectrum.interpretation_offsets = offsets.astype(np.int32)
+        else:
+            offsets = offsets.tolist()
+            character_offsets = np.zeros(len(offsets), dtype=np.int32)
+            character_offsets[1:] = np.cumsum( [ len(interpretation_bytes[offsets[i]:offsets[i+1]].decode('utf-8'))
+                for i in range(len(offsets) - 1) ] )
+            spectrum.interpretation_offsets = character_offsets
+
+        #### Attributes
+        attribute_start = int(self.attribute_offsets[spectrum_index_number])
+        attribute_end = attribute_start + int(record['n_attributes'])
+        spectrum.attribute_codes = array.array('I', self.key_code_map[sections['attribute_codes'][attribute_start:attribute_end]].tobytes())
+        spectrum.attribute_groups = array.array('I', sections['attribute_groups'][attribute_start:attribute_end].astype(np.uint32).tobytes())
+        offsets = sections['value_offsets'][attribute_start:attribute_end + 1]
+        value_bytes = sections['values'][int(offsets[0]):int(offsets[-1])].tobytes()
+        values_text = value_bytes.decode('utf-8')
+        offsets = (offsets - offsets[0]).tolist()
+        if len(values_text) == len(value_bytes):
+            values = [ values_text[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1) ]
+        else:
+            values = [ value_bytes[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1) ]
+
+        #### Restore the values that were not strings
+        for i, value_type in enumerate(sections['attribute_types'][attribute_start:attribute_end].tobytes()):
+            if value_type:
+                values[i] = value_decoders[value_type](values[i])
+        spectrum.attribute_values = values
+        spectrum.group_counter = int(record['group_counter'])
+        return(spectrum)
+
+
+    def iter_spectra(self, start=0, stop=None):
+        """
+        iter_spectra - Iterate over the spectra in file order
+
+        Parameters
+        ----------
+        start : int
+            Index number of the first spectrum to return
+        stop : int
+            Stop before the spectrum with this index number (default: end of library)
+
+        Returns
+        -------
+        generator
+            Yields a (spectrum_index_number, LibrarySpectrum) tuple for each spectrum
+        """
+
+        if stop is None or stop > self.n_spectra:
+            stop = self.n_spectra
+        for spectrum_index_number in range(start, stop):
+            yield( (int(self.records[spectrum_index_number]['number']), self.get_spectrum(spectrum_index_number)) )
+
+
+    def close(self):
+        """
+        close - Release the memory map. Spectra already returned keep the file mapped until they are deleted
+        """
+
+        self.sections = {}
+        self.records = None
+        self.buffer = None
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
+
+import os
+import time
+import threading
+import collections
+
+debug = True
+
+#### Default limits of the number of cached spectra and their estimated total size
+default_max_entries = 10000
+default_max_bytes = 256 * 1024 * 1024
+
+#### Default number of seconds between checks whether a library or its index has changed
+default_state_check_interval = 1.0
+
+
+#### Return a tuple that changes whenever the library file or its index is replaced or modified
+def get_library_file_state(library_filename):
+    try:
+        stat = os.stat(library_filename)
+        state = [ stat.st_size, stat.st_mtime_ns, stat.st_ino ]
+    except OSError:
+        state = [ None, None, None ]
+    try:
+        stat = os.stat(library_filename + '.splindex')
+        state.extend( [ stat.st_mtime_ns, stat.st_ino ] )
+    except OSError:
+        state.extend( [ None, None ] )
+    return(tuple(state))
+
+
+class SpectrumLibraryCache:
+    """
+    SpectrumLibraryCache - Class for a bounded least-recently-used cache of parsed library spectra
+
+    Entries are keyed on the library filename and spectrum index number, so one
+    cache can be shared by several libraries. When both limits are reached, the
+    least recently used spectra are evicted first. Each library's file and
+    index are checked for changes at most every state_check_interval seconds,
+    and a change drops all cached spectra of that library. The cached spectra
+    are shared between callers and should not be modified.
+
+    Attributes
+    ----------
+    max_entries : int
+        Maximum number of cached spectra
+    max_bytes : int
+        Maximum estimated total size of the cached spectra in bytes
+    state_check_interval : float
+        Number of seconds between checks whether a library or its index has changed
+    n_bytes : int
+        Estimated total size of the cached spectra in bytes
+    hits : int
+        Number of lookups that found the spectrum in the cache
+    misses : int
+        Number of lookups that did not find the spectrum in the cache
+
+    Methods
+    -------
+    get - Return a cached spectrum, or None if it is not cached
+    put - Add a spectrum to the cache, evicting the least recently used spectra as needed
+    check_library - Drop the cached spectra of a library if its file or index has changed
+    invalidate - Drop the cached spectra of one library or all libraries
+    get_statistics - Return the counters and size of the cache
+
+    """
+
+
+    #### Constructor
+    def __init__(self, max_entries=default_max_entries, max_bytes=default_max_bytes, state_check_interval=default_state_check_interval):
+        """
+        __init__ - SpectrumLibraryCache constructor
+
+        Parameters
+        ----------
+        max_entries : int
+            Maximum number of cached spectra. 0 disables the cache
+        max_bytes : int
+            Maximum estimated total size of the cached spectra in bytes
+        state_check_interval : float
+            Number of seconds between checks whether a library or its index has changed
+
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.state_check_interval = state_check_interval
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        #### State of the file and index of each library as (state, time of the last check)
+        self.library_states = {}
+        self.lock = threading.Lock()
+
+
+    #### Number of cached spectra
+    def __len__(self):
+        return(len(self.entries))
+
+
+    def get(self, library_filename, spectrum_index_number):
+        """
+        get - Return a cached spectrum, or None if it is not cached
+
+        Parameters
+        ----------
+        library_filename : string
+            Absolute filename of the library
+        spectrum_index_number : int
+            Index number of the spectrum in the library
+
+        Returns
+        -------
+        LibrarySpectrum
+            The cached spectrum, or None
+        """
+
+        self.check_library(library_filename)
+        key = (library_filename, spectrum_index_number)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return(None)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return(entry[0])
+
+
+    def put(self, library_filename, spectrum_index_number, spectrum, size=None):
+        """
+        put - Add a spectrum to the cache, evicting the least recently used spectra as needed
+
+        Parameters
+        ----------
+        library_filename : string
+            Absolute filename of the library
+        spectrum_index_number : int
+            Index number of the spectrum in the library
+        spectrum : LibrarySpectrum
+            The parsed spectrum
+        size : int
+            Estimated size of the spectrum in bytes. If not supplied, spectrum.get_memory_size() is used
+
+        Returns
+        -------
+        bool
+            True if the spectrum was cached, False if it is larger than the whole cache
+        """
+
+        if size is None:
+            size = spectrum.get_memory_size()
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return(False)
+        key = (library_filename, spectrum_index_number)
+        with self.lock:
+            previous_entry = self.entries.pop(key, None)
+            if previous_entry is not None:
+                self.n_bytes -= previous_entry[1]
+            self.entries[key] = (spectrum, size)
+            self.n_bytes += size
+            while len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes:
+                evicted_key, (evicted_spectrum, evicted_size) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_size
+                self.evictions += 1
+        return(True)
+
+
+    def check_library(self, library_filename):
+        """
+        check_library - Drop the cached spectra of a library if its file or index has changed
+
+        The file and index are only examined if the last check of this library
+        was more than state_check_interval seconds ago.
+
+        Parameters
+        ----------
+        library_filename : string
+            Absolute filename of the library
+
+        Returns
+        -------
+        bool
+            True if the cached spectra of the library were dropped
+        """
+
+        now = time.monotonic()
+        recorded = self.library_states.get(library_filename)
+        if recorded is not None and now - recorded[1] < self.state_check_interval:
+            return(False)
+        state = get_library_file_state(library_filename)
+        self.library_states[library_filename] = (state, now)
+        if recorded is not None and recorded[0] != state:
+            if debug: eprint(f"INFO: Library {library_filename} or its index changed, dropping its cached spectra")
+            self.invalidate(library_filename)
+            return(True)
+        return(False)
+
+
+    def invalidate(self, library_filename=None):
+        """
+        invalidate - Drop the cached spectra of one library or all libraries
+
+        Parameters
+        ----------
+        library_filename : string
+            Absolute filename of the library, or None for all libraries
+
+        Returns
+        -------
+        int
+            Number of spectra dropped
+        """
+
+        with self.lock:
+            if library_filename is None:
+                keys = list(self.entries.keys())
+                self.library_states = {}
+            else:
+                keys = [ key for key in self.entries if key[0] == library_filename ]
+                self.library_states.pop(library_filename, None)
+            for key in keys:
+                spectrum, size = self.entries.pop(key)
+                self.n_bytes -= size
+            self.invalidations += len(keys)
+        return(len(keys))
+
+
+    def get_statistics(self):
+        """
+        get_statistics - Return the counters and size of the cache
+
+        Returns
+        -------
+        dict
+            Number of entries, estimated bytes, hits, misses, hit rate, evictions and invalidations
+        """
+
+        n_lookups = self.hits + self.misses
+        return( { 'n_entries': len(self.entries), 'n_bytes': self.n_bytes, 'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups > 0 else 0.0, 'evictions': self.evictions,
+            'invalidations': self.invalidations } )
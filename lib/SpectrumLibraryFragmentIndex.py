@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
+
+import os
+import timeit
+
+import numpy as np
+
+from SpectrumLibrarySearch import get_top_peaks_mask
+
+debug = True
+
+#### Suffix added to the index filename for the saved fragment ion index
+fragment_index_suffix = '.fragments.npz'
+
+#### Version of the saved fragment index layout, to ignore files written by an incompatible version
+fragment_index_version = 1
+
+#### Default width of the fragment m/z bins. Narrow bins keep the lists of spectra per bin short
+default_fragment_bin_width = 0.05
+
+#### Default number of the most intense peaks of each spectrum that are indexed
+default_fragment_top_k_peaks = 50
+
+
+class SpectrumLibraryFragmentIndex:
+    """
+    SpectrumLibraryFragmentIndex - Class for an inverted index of the fragment ions of all spectra in a library
+
+    The m/z range is divided into narrow bins, and for each bin the index holds
+    the spectrum index numbers of all library spectra with a peak in that bin.
+    The lists are concatenated into one array, and the spectra with a peak in
+    bin b are numbers[bin_offsets[b]:bin_offsets[b+1]], in ascending order.
+    Only the most intense peaks of each spectrum are indexed. The index is saved
+    next to the library index and reused until the library or index changes.
+
+    It serves as a prefilter for searches that cannot use the precursor m/z,
+    such as open modification searches: the number of fragment ions that each
+    library spectrum shares with a query is counted without looking at the
+    spectra that share none.
+
+    Attributes
+    ----------
+    bin_width : float
+        Width of the fragment m/z bins
+    top_k_peaks : int
+        Number of the most intense peaks of each spectrum that are indexed, or None for all peaks
+    bin_offsets : numpy.ndarray
+        int64 offsets of the list of each bin into numbers, plus the total length
+    numbers : numpy.ndarray
+        int32 spectrum index numbers of the lists of all bins
+
+    Methods
+    -------
+    create_index - Build the inverted index from the peaks of all library spectra
+    save - Write the index to a file next to the library index
+    load - Read the index written by save() if it is still current
+    get_query_bins - Return the bins that the peaks of a query fall into
+    get_shared_peak_counts - Return the number of query peaks shared by each library spectrum
+    find_candidates - Return the library spectra that share the most peaks with a query
+
+    """
+
+
+    #### Constructor
+    def __init__(self, spectrum_library=None, bin_width=default_fragment_bin_width, top_k_peaks=default_fragment_top_k_peaks, use_saved_index=True):
+        """
+        __init__ - SpectrumLibraryFragmentIndex constructor
+
+        Parameters
+        ----------
+        spectrum_library : SpectrumLibrary
+            The library to index
+        bin_width : float
+            Width of the fragment m/z bins
+        top_k_peaks : int
+            Number of the most intense peaks of each spectrum to index, or None for all peaks
+        use_saved_index : bool
+            If set, load the saved index if it is current, and save a newly built one
+
+        """
+
+        if spectrum_library is None:
+            raise Exception('Spectrum library missing')
+        self.spectrum_library = spectrum_library
+        self.bin_width = bin_width
+        self.top_k_peaks = top_k_peaks
+
+        filename = spectrum_library.filename + '.splindex' + fragment_index_suffix
+        if not use_saved_index or not self.load(filename):
+            self.create_index()
+            if use_saved_index:
+                try:
+                    self.save(filename)
+                except OSError as error:
+                    eprint(f"WARNING: Unable to write fragment index {filename}: {error}")
+
+
+    #### Number of bins in the index
+    @property
+    def n_bins(self):
+        return(len(self.bin_offsets) - 1)
+
+
+    #### Return the parameters that the index depends on, to check that a saved index matches
+    def get_parameters(self):
+        return( { 'version': fragment_index_version, 'bin_width': float(self.bin_width),
+            'top_k_peaks': -1 if self.top_k_peaks is None else int(self.top_k_peaks) } )
+
+
+    def create_index(self):
+        """
+        create_index - Build the inverted index from the peaks of all library spectra
+
+        The peaks are taken from the columnar table of the library (see
+        SpectrumLibrary.load_table()), which holds the parsed peak lists of all spectra.
+
+        Returns
+        -------
+        int
+            Number of entries in the index
+        """
+
+        t0 = timeit.default_timer()
+        table = self.spectrum_library.load_table()
+        peak_offsets = table.peak_offsets
+        rows = np.repeat(np.arange(len(table), dtype=np.int64), np.diff(peak_offsets))
+        mzs = table.mzs
+        if self.top_k_peaks is not None and len(mzs) > 0:
+            keep = get_top_peaks_mask(table.intensities, rows, peak_offsets, self.top_k_peaks)
+            rows = rows[keep]
+            mzs = mzs[keep]
+        bins = np.floor(mzs / self.bin_width).astype(np.int64)
+
+        #### Sort by bin and then spectrum number, listing each spectrum only once per bin
+        numbers = table.number.astype(np.int64)[rows]
+        self.n_numbers = int(table.number.max()) + 1 if len(table) > 0 else 0
+        keys = np.sort(bins * max(self.n_numbers, 1) + numbers)
+        if len(keys) > 1:
+            keys = keys[np.concatenate( ([ True ], keys[1:] != keys[:-1]) )]
+        bins = keys // max(self.n_numbers, 1)
+        self.numbers = (keys % max(self.n_numbers, 1)).astype(np.int32)
+
+        n_bins = int(bins[-1]) + 1 if len(bins) > 0 else 0
+        self.bin_offsets = np.zeros(n_bins + 1, dtype=np.int64)
+        np.cumsum(np.bincount(bins, minlength=n_bins), out=self.bin_offsets[1:])
+
+        t1 = timeit.default_timer()
+        if debug: eprint(f"INFO: Built a fragment index of {len(self.numbers)} entries in {n_bins} bins in {t1-t0:.3f} s")
+        return(len(self.numbers))
+
+
+    def save(self, filename):
+        """
+        save - Write the index to an uncompressed NumPy .npz file
+
+        Parameters
+        ----------
+        filename : string
+            Name of the file to write
+        """
+
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, bin_offsets=self.bin_offsets, numbers=self.numbers, n_numbers=np.array(self.n_numbers, dtype=np.int64),
+                library_size=np.array(os.path.getsize(self.spectrum_library.filename), dtype=np.int64),
+                **{ 'parameter_' + name: np.array(value) for name, value in self.get_parameters().items() })
+
+
+    def load(self, filename):
+        """
+        load - Read the index written by save() if it is still current
+
+        The file is only used if it is at least as new as both the library and
+        its index, was built from a library of the current size, and was built
+        with the same parameters.
+
+        Parameters
+        ----------
+        filename : string
+            Name of the file to read
+
+        Returns
+        -------
+        bool
+            True if the index was loaded
+        """
+
+        library_filename = self.spectrum_library.filename
+        if not os.path.exists(filename):
+            return(False)
+        mtime = os.path.getmtime(filename)
+        if mtime < os.path.getmtime(library_filename):
+            return(False)
+        index_filename = library_filename + '.splindex'
+        if os.path.exists(index_filename) and mtime < os.path.getmtime(index_filename):
+            return(False)
+
+        with np.load(filename, allow_pickle=False) as arrays:
+            if 'library_size' not in arrays or int(arrays['library_size']) != os.path.getsize(library_filename):
+                return(False)
+            for name, value in self.get_parameters().items():
+                if 'parameter_' + name not in arrays or arrays['parameter_' + name].item() != value:
+                    if debug: eprint(f"INFO: Fragment index {filename} was built with other parameters and is ignored")
+                    return(False)
+            self.bin_offsets = arrays['bin_offsets']
+            self.numbers = arrays['numbers']
+            self.n_numbers = int(arrays['n_numbers'])
+        return(True)
+
+
+    def get_query_bins(self, mzs, intensities=None, tolerance=0.02):
+        """
+        get_query_bins - Return the bins that the peaks of a query fall into
+
+        Parameters
+        ----------
+        mzs : array
+            m/z values of the query peaks
+        intensities : array
+            Intensities of the query peaks. If supplied, only the top_k_peaks most intense peaks are used
+        tolerance : float
+            Fragment m/z tolerance. A peak falls into every bin that its tolerance window overlaps
+
+        Returns
+        -------
+        numpy.ndarray
+            Sorted unique bins within the range of the index
+        """
+
+        mzs = np.asarray(mzs, dtype=np.float64)
+        if intensities is not None and self.top_k_peaks is not None and len(mzs) > self.top_k_peaks:
+            mzs = mzs[np.argsort(-np.asarray(intensities, dtype=np.float64), kind='stable')[:self.top_k_peaks]]
+        first_bins = np.floor( (mzs - tolerance) / self.bin_width).astype(np.int64)
+        last_bins = np.floor( (mzs + tolerance) / self.bin_width).astype(np.int64)
+        counts = last_bins - first_bins + 1
+        ends = np.cumsum(counts)
+        bins = np.repeat(first_bins - (ends - counts), counts) + np.arange(ends[-1] if len(ends) > 0 else 0, dtype=np.int64)
+        bins = np.unique(bins)
+        return(bins[ (bins >= 0) & (bins < self.n_bins) ])
+
+
+    def get_shared_peak_counts(self, mzs, intensities=None, tolerance=0.02):
+        """
+        get_shared_peak_counts - Return the number of query peaks shared by each library spectrum
+
+        A library peak is counted as shared if it is in a bin that a query peak falls into (see get_query_bins()).
+
+        Parameters
+        ----------
+        mzs : array
+            m/z values of the query peaks
+        intensities : array
+            Intensities of the query peaks. If supplied, only the top_k_peaks most intense peaks are used
+        tolerance : float
+            Fragment m/z tolerance
+
+        Returns
+        -------
+        numpy.ndarray
+            Number of shared peaks, indexed by spectrum index number
+        """
+
+        bins = self.get_query_bins(mzs, intensities=intensities, tolerance=tolerance)
+        starts = self.bin_offsets[bins]
+        counts = self.bin_offsets[bins + 1] - starts
+        ends = np.cumsum(counts)
+        positions = np.repeat(starts - (ends - counts), counts) + np.arange(ends[-1] if len(ends) > 0 else 0, dtype=np.int64)
+        return(np.bincount(self.numbers[positions], minlength=self.n_numbers))
+
+
+    def find_candidates(self, mzs, intensities=None, tolerance=0.02, min_shared_peaks=6, max_candidates=None):
+        """
+        find_candidates - Return the library spectra that share the most peaks with a query
+
+        Parameters
+        ----------
+        mzs : array
+            m/z values of the query peaks
+        intensities : array
+            Intensities of the query peaks. If supplied, only the top_k_peaks most intense peaks are used
+        tolerance : float
+            Fragment m/z tolerance
+        min_shared_peaks : int
+            Minimum number of shared peaks for a library spectrum to be a candidate
+        max_candidates : int
+            If supplied, only return this many candidates with the most shared peaks
+
+        Returns
+        -------
+        numpy.ndarray
+            Spectrum index numbers of the candidates, with the most shared peaks first
+        """
+
+        shared_peak_counts = self.get_shared_peak_counts(mzs, intensities=intensities, tolerance=tolerance)
+        candidates = np.flatnonzero(shared_peak_counts >= max(min_shared_peaks, 1))
+        if max_candidates is not None and len(candidates) > max_candidates:
+            candidates = candidates[np.argpartition(-shared_peak_counts[candidates], max_candidates)[:max_candidates]]
+        return(candidates[np.argsort(-shared_peak_counts[candidates], kind='stable')])
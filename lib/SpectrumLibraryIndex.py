@@ -5,8 +5,11 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 import os
+import hashlib
 from datetime import datetime
 
+import numpy as np
+
 from sqlalchemy import Column, ForeignKey, Integer, Float, String, DateTime, Text, PickleType, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -14,11 +17,22 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import desc
 from sqlalchemy import inspect
+from sqlalchemy import literal
+from sqlalchemy import func
 
 Base = declarative_base()
 
 debug = False
 
+#### Number of buffered records to write in each executemany() during a bulk load
+bulk_insert_batch_size = 50000
+
+#### Suffix added to the index filename for the sidecar file of the offset table
+offset_table_suffix = '.offsets.npy'
+
+#### Maximum number of identifiers to put in a single IN clause (older SQLite allows only 999 parameters)
+max_query_parameters = 900
+
 
 #### Define the database tables as classes
 class SpectrumLibraryIndexAttribute(Base):
@@ -36,6 +50,51 @@ class SpectrumLibraryIndexRecord(Base):
   offset = Column(Integer, nullable=False)
   name = Column(String(1024), nullable=False)
   peptide_sequence = Column(String(2014), nullable=True)
+  length = Column(Integer, nullable=True)
+  charge = Column(Integer, nullable=True)
+  precursor_mz = Column(Float, nullable=True)
+  n_peaks = Column(Integer, nullable=True)
+  mods = Column(String(1024), nullable=True)
+
+#### Columns of the index record table that get an SQL index once the table is loaded.
+#### A (charge, precursor_mz) index serves precursor m/z windows restricted to one charge
+indexed_columns = [ [ 'number' ], [ 'name' ], [ 'peptide_sequence' ], [ 'precursor_mz' ], [ 'charge', 'precursor_mz' ] ]
+
+
+#### Names of the index attributes that record the state of the library file when it was indexed
+library_state_attributes = [ 'library_size', 'library_mtime', 'library_checksum' ]
+
+#### Number of bytes at the beginning and at the end of the indexed region that go into the partial checksum
+library_checksum_block_size = 65536
+
+
+#### Compute a fast partial checksum of the first size bytes of a library from its first and last blocks
+def get_library_checksum(filename, size):
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as infile:
+        checksum.update(infile.read(min(size, library_checksum_block_size)))
+        if size > library_checksum_block_size:
+            infile.seek(max(size - library_checksum_block_size, library_checksum_block_size))
+            checksum.update(infile.read(size - infile.tell()))
+    return(checksum.hexdigest())
+
+
+#### Return the size, modification time and partial checksum of a library file
+def get_library_state(filename):
+    stat = os.stat(filename)
+    return( { 'library_size': stat.st_size, 'library_mtime': str(stat.st_mtime),
+        'library_checksum': get_library_checksum(filename, stat.st_size) } )
+
+
+#### Return the half-width of a search window in m/z for a tolerance in ppm or Da
+def get_tolerance_delta(mz, tolerance, tolerance_units):
+    units = tolerance_units.lower()
+    if units == 'ppm':
+        return(mz * tolerance / 1e6)
+    elif units == 'da' or units == 'th' or units == 'm/z':
+        return(float(tolerance))
+    else:
+        raise ValueError(f"ERROR: Unrecognized tolerance units '{tolerance_units}'")
 
 
 class SpectrumLibraryIndex:
@@ -50,15 +109,27 @@ class SpectrumLibraryIndex:
     Methods
     -------
     get_offset - Get the offset for a spectrum in the library based on the spectrum_index or spectrum_name
+    get_location - Get the offset and length of a spectrum in the library based on the spectrum_index
+    get_offsets - Get the offsets of many spectra with as few queries as possible
+    get_locations - Get the offsets and lengths of many spectra with as few queries as possible
+    load_offset_table - Load the offsets and lengths of all spectra into a compact array
+    get_record_columns - Return the names of the columns present in the index record table
+    find_offsets_batch - Return the spectra that match each of many precursor m/z values
+    get_precursor_table - Return arrays of the spectra sorted by precursor m/z
     find_offsets - Return an array of offsets of spectra that match the input parameters
     create_index - Create a new index for a library
     add_spectrum - Add a spectrum to the index
+    begin_bulk_load - Switch to the fast bulk ingestion mode for building a new index
+    end_bulk_load - Write out any buffered records, finish the bulk load and create the table indexes
+    create_table_indexes - Create the SQL indexes on the index record table
+    check_library_state - Compare the library file with the state recorded when it was indexed
+    get_last_record - Return the number and offset of the last spectrum in the index
 
     """
 
 
     #### Constructor
-    def __init__(self, library_filename=None, version=None, n_spectra=None, library_datetime=None, columns=None):
+    def __init__(self, library_filename=None, version=None, n_spectra=None, library_datetime=None, columns=None, load_offset_table=False):
         """
         __init__ - SpectrumLibraryIndex constructor
 
@@ -66,6 +137,8 @@ class SpectrumLibraryIndex:
         ----------
         columns : array
             Names of the columns in the data matrix
+        load_offset_table : bool
+            If set, load the offsets and lengths of all spectra into memory on open (see load_offset_table())
 
         """
 
@@ -73,10 +146,26 @@ class SpectrumLibraryIndex:
         self.version = "0.1"
         self.n_spectra = 0
         self.library_datetime = None
-        self.columns = [ 'number', 'offset', 'name', 'peptide_sequence' ]
+        self.columns = [ 'number', 'offset', 'name', 'peptide_sequence', 'length', 'charge', 'precursor_mz', 'n_peaks', 'mods' ]
         self.status = 'closed'
         self.uncommitted_transactions = 0
 
+        #### State for the bulk loading mode
+        self.bulk_mode = False
+        self.bulk_buffer = []
+        self.bulk_connection = None
+        self.bulk_transaction = None
+        self.bulk_n_records = 0
+
+        #### Names of the columns present in the index record table, checked on first use since older index files have fewer
+        self.record_columns = None
+
+        #### Arrays of the precursor m/z values of all spectra for batched range queries, loaded on first use
+        self.precursor_table = None
+
+        #### Array of the offset and length of each spectrum by index number, if loaded
+        self.offset_table = None
+
         if library_filename is None:
             raise Exception('Library filename missing')
         filename = self.library_filename + '.splindex'
@@ -84,10 +173,18 @@ class SpectrumLibraryIndex:
             raise Exception('Missing library_filename')
         if os.path.exists(filename):
             self.connect()
-            self.status = 'OK'
+            self.library_state = self.check_library_state()
+            if self.library_state == 'current' or self.library_state == 'missing':
+                self.status = 'OK'
+            else:
+                self.status = 'stale'
+                if debug: eprint(f"INFO: Index {filename} is out of date with the library ({self.library_state})")
         else:
             self.create_database()
+            self.library_state = 'unknown'
             self.status = 'OK'
+        if load_offset_table:
+            self.load_offset_table()
 
 
     #### Destructor
@@ -163,6 +260,8 @@ class SpectrumLibraryIndex:
         if os.path.exists(filename):
             if debug: eprint(f'INFO: Deleting previous index file {filename}')
             os.remove(filename)
+        if os.path.exists(filename + offset_table_suffix):
+            os.remove(filename + offset_table_suffix)
         if debug: eprint(f'INFO: Creating index file {filename}')
         engine = create_engine("sqlite:///"+filename)
         Base.metadata.create_all(engine)
@@ -171,6 +270,9 @@ class SpectrumLibraryIndex:
         session = DBSession()
         self.session = session
         self.engine = engine
+        self.record_columns = None
+        self.precursor_table = None
+        self.offset_table = None
 
         index_attribute = SpectrumLibraryIndexAttribute( name='version', value=self.version )
         session.add(index_attribute)
@@ -190,11 +292,25 @@ class SpectrumLibraryIndex:
         session = DBSession()
         self.session = session
         self.engine = engine
+        self.record_columns = None
+        self.precursor_table = None
+        self.offset_table = None
+
+        #### Older indexes never updated n_spectra, so count the records for those
+        attribute = session.query(SpectrumLibraryIndexAttribute).filter(SpectrumLibraryIndexAttribute.name=='n_spectra').first()
+        if attribute is not None and int(attribute.value) > 0:
+            self.n_spectra = int(attribute.value)
+        else:
+            self.n_spectra = session.query(func.count(SpectrumLibraryIndexRecord.id)).scalar()
 
 
     #### Destroy the database connection
     def disconnect(self):
         filename = self.library_filename + '.splindex'
+        if self.session is None:
+            return
+        if self.bulk_mode:
+            self.end_bulk_load()
         if self.uncommitted_transactions > 0:
             if debug: eprint(f'INFO: Committing open transactions')
             self.session.flush()
@@ -210,8 +326,11 @@ class SpectrumLibraryIndex:
         self.engine = None
 
 
-    #### Destroy the database connection
+    #### Commit any pending changes
     def commit(self):
+        if self.bulk_mode:
+            self.flush_bulk_buffer()
+            return
         if self.uncommitted_transactions > 0:
             #if debug: eprint(f'INFO: Committing open transactions')
             self.session.flush()
@@ -219,57 +338,381 @@ class SpectrumLibraryIndex:
             self.uncommitted_transactions = 0
 
 
-    def get_offset(self, spectrum_index_number=None, spectrum_name=None):
+    def get_offset(self, spectrum_index_number=None, spectrum_name=None, peptide_sequence=None):
         """
         get_offset - Get the offset for a spectrum in the library based on the spectrum_index or spectrum_name
 
-        Extended description of function.
+        If the name or peptide sequence matches more than one spectrum, the
+        one with the lowest index number is selected.
 
         Parameters
         ----------
-        spectrum_index : integer
+        spectrum_index_number : integer
             Index number of the spectrum to select
         spectrum_name : string
-            Name of the spectrum to select
+            Exact name of the spectrum to select (e.g. PEPTIDE/2)
+        peptide_sequence : string
+            Unmodified peptide sequence of the spectrum to select
 
         Returns
         -------
         int
-            Description of return value
+            Offset of the spectrum in the library file, or None if there is no such spectrum
         """
 
-        #### Begin functionality here
+        offset, length = self.get_location(spectrum_index_number=spectrum_index_number, spectrum_name=spectrum_name,
+            peptide_sequence=peptide_sequence)
+        return(offset)
+
+
+    def get_location(self, spectrum_index_number=None, spectrum_name=None, peptide_sequence=None):
+        """
+        get_location - Get the offset and length of a spectrum in the library based on the spectrum_index
+
+        Parameters
+        ----------
+        spectrum_index_number : integer
+            Index number of the spectrum to select
+        spectrum_name : string
+            Exact name of the spectrum to select (e.g. PEPTIDE/2)
+        peptide_sequence : string
+            Unmodified peptide sequence of the spectrum to select
+
+        Returns
+        -------
+        tuple
+            (offset, length) of the entry. The length is None for an index built
+            before lengths were recorded, and both are None if there is no such spectrum
+        """
+
+        #### If the offset table is loaded, looking up by number is just an array access
+        if spectrum_index_number is not None and self.offset_table is not None:
+            spectrum_index_number = int(spectrum_index_number)
+            if spectrum_index_number < 0 or spectrum_index_number >= len(self.offset_table):
+                return( (None, None) )
+            offset, length = self.offset_table[spectrum_index_number]
+            if offset < 0:
+                return( (None, None) )
+            return( (int(offset), int(length) if length >= 0 else None) )
+
         if spectrum_index_number is not None:
-            try:
-                records = self.session.query(SpectrumLibraryIndexRecord).filter(SpectrumLibraryIndexRecord.number==spectrum_index_number).all()
-            except:
-                session.rollback()
-                raise
-            if len(records) > 1:
-                raise Exception('Too many records')
-            return(records[0].offset)
+            criterion = SpectrumLibraryIndexRecord.number==int(spectrum_index_number)
+        elif spectrum_name is not None:
+            criterion = SpectrumLibraryIndexRecord.name==spectrum_name
+        elif peptide_sequence is not None:
+            criterion = SpectrumLibraryIndexRecord.peptide_sequence==peptide_sequence
+        else:
+            raise ValueError("ERROR: One of spectrum_index_number, spectrum_name or peptide_sequence must be supplied")
 
-        return()
+        try:
+            record = self.get_location_query().filter(criterion).order_by(SpectrumLibraryIndexRecord.number).first()
+        except:
+            self.session.rollback()
+            raise
+        if record is None:
+            return( (None, None) )
+        return( (record[1], record[2]) )
+
+
+    def get_offsets(self, spectrum_index_numbers=None, spectrum_names=None):
+        """
+        get_offsets - Get the offsets of many spectra with as few queries as possible
+
+        Parameters
+        ----------
+        spectrum_index_numbers : list
+            Index numbers of the spectra to select
+        spectrum_names : list
+            Exact names of the spectra to select
 
+        Returns
+        -------
+        list
+            Offsets in the same order as the request, with None for any spectrum not found
+        """
+
+        locations = self.get_locations(spectrum_index_numbers=spectrum_index_numbers, spectrum_names=spectrum_names)
+        return( [ location[0] for location in locations ] )
+
+
+    def get_locations(self, spectrum_index_numbers=None, spectrum_names=None):
+        """
+        get_locations - Get the offsets and lengths of many spectra with as few queries as possible
+
+        The identifiers are resolved with IN queries of up to
+        max_query_parameters identifiers each, rather than one query per spectrum.
+
+        Parameters
+        ----------
+        spectrum_index_numbers : list
+            Index numbers of the spectra to select
+        spectrum_names : list
+            Exact names of the spectra to select
+
+        Returns
+        -------
+        list
+            (offset, length) tuples in the same order as the request, with (None, None) for any spectrum not found
+        """
+
+        if spectrum_index_numbers is not None and self.offset_table is not None:
+            return( [ self.get_location(spectrum_index_number=identifier) for identifier in spectrum_index_numbers ] )
+
+        if spectrum_index_numbers is not None:
+            column = SpectrumLibraryIndexRecord.number
+            identifiers = [ int(identifier) for identifier in spectrum_index_numbers ]
+        elif spectrum_names is not None:
+            column = SpectrumLibraryIndexRecord.name
+            identifiers = list(spectrum_names)
+        else:
+            raise ValueError("ERROR: One of spectrum_index_numbers or spectrum_names must be supplied")
+
+        #### Look up each distinct identifier once. For duplicated names, the lowest index number wins
+        found_locations = {}
+        unique_identifiers = list(set(identifiers))
+        try:
+            for i_start in range(0, len(unique_identifiers), max_query_parameters):
+                chunk = unique_identifiers[i_start:i_start + max_query_parameters]
+                records = self.get_location_query(with_identifier=column).filter(column.in_(chunk)).order_by(
+                    SpectrumLibraryIndexRecord.number.desc()).all()
+                for record in records:
+                    found_locations[record[3]] = (record[1], record[2])
+        except:
+            self.session.rollback()
+            raise
+
+        return( [ found_locations.get(identifier, (None, None)) for identifier in identifiers ] )
+
+
+    def load_offset_table(self):
+        """
+        load_offset_table - Load the offsets and lengths of all spectra into a compact array
+
+        The table is an (n_spectra, 2) numpy int64 array indexed by spectrum index
+        number, holding the offset and length (-1 where unknown) at 16 bytes per
+        spectrum. It is saved in a sidecar file next to the index the first time
+        it is built and is memory-mapped from there afterwards. Once loaded,
+        get_location() and get_offset() by index number no longer query SQLite.
+
+        Returns
+        -------
+        numpy.ndarray
+            The offset table
+        """
 
-    def find_offsets(self):
+        filename = self.library_filename + '.splindex'
+        table_filename = filename + offset_table_suffix
+
+        #### Use the sidecar file if it is at least as new as the index
+        if os.path.exists(table_filename) and os.path.getmtime(table_filename) >= os.path.getmtime(filename):
+            self.offset_table = np.load(table_filename, mmap_mode='r')
+            return(self.offset_table)
+
+        if 'length' in self.get_record_columns():
+            sql = f"SELECT number, offset, length FROM {SpectrumLibraryIndexRecord.__tablename__}"
+        else:
+            sql = f"SELECT number, offset, NULL FROM {SpectrumLibraryIndexRecord.__tablename__}"
+        with self.engine.connect() as connection:
+            rows = connection.exec_driver_sql(sql).fetchall()
+
+        n_entries = max([ row[0] for row in rows ]) + 1 if len(rows) > 0 else 0
+        offset_table = np.full( (n_entries, 2), -1, dtype=np.int64 )
+        for number, offset, length in rows:
+            offset_table[number, 0] = offset
+            if length is not None:
+                offset_table[number, 1] = length
+
+        try:
+            with open(table_filename, 'wb') as outfile:
+                np.save(outfile, offset_table)
+        except OSError as error:
+            eprint(f"WARNING: Unable to write offset table {table_filename}: {error}")
+
+        self.offset_table = offset_table
+        return(self.offset_table)
+
+
+    def get_location_query(self, with_identifier=None):
+        """
+        get_location_query - Return a query for the number, offset and length of index records
+
+        Parameters
+        ----------
+        with_identifier : Column
+            If supplied, also select this column as a fourth value
+
+        Returns
+        -------
+        Query
+            SQLAlchemy query, to which the caller adds the filter
+        """
+
+        columns = [ SpectrumLibraryIndexRecord.number, SpectrumLibraryIndexRecord.offset ]
+        if 'length' in self.get_record_columns():
+            columns.append(SpectrumLibraryIndexRecord.length)
+        else:
+            columns.append(literal(None))
+        if with_identifier is not None:
+            columns.append(with_identifier)
+        return(self.session.query(*columns))
+
+
+    def get_record_columns(self):
+        """
+        get_record_columns - Return the names of the columns present in the index record table
+
+        Index files created by earlier versions lack some of the newer columns,
+        so callers check here before querying them.
+
+        Returns
+        -------
+        set
+            Set of the column names
+        """
+
+        if self.record_columns is None:
+            self.record_columns = set([ column['name'] for column in inspect(self.engine).get_columns(SpectrumLibraryIndexRecord.__tablename__) ])
+        return(self.record_columns)
+
+
+    def find_offsets(self, precursor_mz=None, tolerance=20, tolerance_units='ppm', charge=None, peptide_sequence=None):
         """
         find_offsets - Return an array of offsets of spectra that match the input parameters
 
-        Extended description of function.
+        Selects all spectra whose precursor m/z is within the tolerance of the
+        requested value, and/or that have the requested unmodified peptide sequence,
+        with an indexed query. For many precursors at once, use find_offsets_batch().
 
         Parameters
         ----------
+        precursor_mz : float
+            Precursor m/z to search for
+        tolerance : float
+            Half-width of the search window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        charge : integer
+            If supplied, only select spectra with this precursor charge
+        peptide_sequence : string
+            If supplied, only select spectra with this unmodified peptide sequence
 
         Returns
         -------
-        int
-            Description of return value
+        list
+            List of (number, offset, length) tuples of the matching spectra, ordered by precursor m/z
         """
 
-        #### Begin functionality here
+        if precursor_mz is None and peptide_sequence is None:
+            raise ValueError("ERROR: One of precursor_mz or peptide_sequence must be supplied")
+        if 'precursor_mz' not in self.get_record_columns():
+            raise Exception('This index does not have precursor m/z values. Please re-create the index')
+
+        query = self.session.query(SpectrumLibraryIndexRecord.number, SpectrumLibraryIndexRecord.offset, SpectrumLibraryIndexRecord.length)
+        if precursor_mz is not None:
+            delta = get_tolerance_delta(float(precursor_mz), tolerance, tolerance_units)
+            query = query.filter(SpectrumLibraryIndexRecord.precursor_mz.between(precursor_mz - delta, precursor_mz + delta))
+        if peptide_sequence is not None:
+            query = query.filter(SpectrumLibraryIndexRecord.peptide_sequence==peptide_sequence)
+        if charge is not None:
+            query = query.filter(SpectrumLibraryIndexRecord.charge==charge)
+        try:
+            records = query.order_by(SpectrumLibraryIndexRecord.precursor_mz, SpectrumLibraryIndexRecord.number).all()
+        except:
+            self.session.rollback()
+            raise
+        return( [ (record[0], record[1], record[2]) for record in records ] )
+
+
+    def find_offsets_batch(self, precursor_mzs=None, tolerance=20, tolerance_units='ppm', charges=None):
+        """
+        find_offsets_batch - Return the spectra that match each of many precursor m/z values
 
-        return()
+        All precursor m/z values of the library are loaded once into sorted
+        arrays (see get_precursor_table()), and the windows for all queries are
+        located at once with numpy searchsorted().
+
+        Parameters
+        ----------
+        precursor_mzs : list
+            List or array of the precursor m/z values to search for
+        tolerance : float
+            Half-width of the search window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        charges : list
+            If supplied, the precursor charge to require for each query, or None for any charge
+
+        Returns
+        -------
+        list
+            A numpy array of the matching spectrum index numbers, ordered by precursor m/z, for each query
+        """
+
+        if precursor_mzs is None:
+            raise ValueError("ERROR: Required parameter precursor_mzs is not supplied")
+        precursor_mzs = np.asarray(precursor_mzs, dtype=np.float64)
+        n_queries = len(precursor_mzs)
+        deltas = get_tolerance_delta(precursor_mzs, tolerance, tolerance_units)
+        lower_mzs = precursor_mzs - deltas
+        upper_mzs = precursor_mzs + deltas
+
+        #### Group the queries by the charge that they require, using 0 for any charge
+        if charges is None:
+            query_charges = np.zeros(n_queries, dtype=np.int64)
+        else:
+            if len(charges) != n_queries:
+                raise ValueError("ERROR: charges must have the same length as precursor_mzs")
+            query_charges = np.array([ 0 if charge is None else int(charge) for charge in charges ], dtype=np.int64)
+
+        results = [ None ] * n_queries
+        for charge in np.unique(query_charges):
+            table = self.get_precursor_table(charge=None if charge == 0 else int(charge))
+            query_indexes = np.nonzero(query_charges == charge)[0]
+            starts = np.searchsorted(table['precursor_mz'], lower_mzs[query_indexes], side='left')
+            ends = np.searchsorted(table['precursor_mz'], upper_mzs[query_indexes], side='right')
+            numbers = table['number']
+            for query_index, start, end in zip(query_indexes, starts, ends):
+                results[query_index] = numbers[start:end]
+        return(results)
+
+
+    def get_precursor_table(self, charge=None):
+        """
+        get_precursor_table - Return arrays of the spectra sorted by precursor m/z
+
+        The arrays are read from the index on first use and kept in memory.
+        Spectra without a precursor m/z are left out.
+
+        Parameters
+        ----------
+        charge : integer
+            If supplied, return the arrays for only the spectra with this charge
+
+        Returns
+        -------
+        dict
+            Dict of numpy arrays 'precursor_mz', 'charge' and 'number', all sorted by precursor m/z
+        """
+
+        if self.precursor_table is None:
+            if 'precursor_mz' not in self.get_record_columns():
+                raise Exception('This index does not have precursor m/z values. Please re-create the index')
+            table_name = SpectrumLibraryIndexRecord.__tablename__
+            with self.engine.connect() as connection:
+                rows = connection.exec_driver_sql(f"SELECT precursor_mz, charge, number FROM {table_name} " +
+                    "WHERE precursor_mz IS NOT NULL ORDER BY precursor_mz, number").fetchall()
+            self.precursor_table = { None: {
+                'precursor_mz': np.array([ row[0] for row in rows ], dtype=np.float64),
+                'charge': np.array([ row[1] if row[1] is not None else 0 for row in rows ], dtype=np.int64),
+                'number': np.array([ row[2] for row in rows ], dtype=np.int64),
+            } }
+
+        #### Subsets by charge stay sorted by precursor m/z and are cached as they are requested
+        if charge not in self.precursor_table:
+            full_table = self.precursor_table[None]
+            mask = full_table['charge'] == charge
+            self.precursor_table[charge] = { key: values[mask] for key, values in full_table.items() }
+        return(self.precursor_table[charge])
 
 
     def create_index(self):
@@ -294,7 +737,8 @@ class SpectrumLibraryIndex:
         return(True)
 
 
-    def add_spectrum(self, number=None, offset=None, name=None, peptide_sequence=None):
+    def add_spectrum(self, number=None, offset=None, name=None, peptide_sequence=None, length=None, charge=None, precursor_mz=None,
+            n_peaks=None, mods=None):
         """
         add_spectrum - Add a spectrum to the index
 
@@ -310,6 +754,16 @@ class SpectrumLibraryIndex:
             Name of the spectrum to add
         peptide_sequence : string
             Unmodified peptide sequence of the spectrum to add
+        length : integer
+            Length in bytes of the entry in the library file
+        charge : integer
+            Precursor charge state of the spectrum to add
+        precursor_mz : float
+            Precursor m/z of the spectrum to add
+        n_peaks : integer
+            Number of peaks in the spectrum to add
+        mods : string
+            Modification string of the spectrum to add, as written in the library
 
         Returns
         -------
@@ -317,10 +771,17 @@ class SpectrumLibraryIndex:
             Description of return value
         """
 
-        #### Begin functionality here
+        #### In bulk mode, just buffer the values and write them out in large batches
+        if self.bulk_mode:
+            self.bulk_buffer.append( (number, offset, name, peptide_sequence, length, charge, precursor_mz, n_peaks, mods) )
+            if len(self.bulk_buffer) >= bulk_insert_batch_size:
+                self.flush_bulk_buffer()
+            return()
+
         #if debug: eprint("INFO: Adding an index entry")
         session = self.session
-        index_record = SpectrumLibraryIndexRecord( number=number, offset=offset, name=name, peptide_sequence=peptide_sequence )
+        index_record = SpectrumLibraryIndexRecord( number=number, offset=offset, name=name, peptide_sequence=peptide_sequence, length=length,
+            charge=charge, precursor_mz=precursor_mz, n_peaks=n_peaks, mods=mods )
         session.add(index_record)
         self.uncommitted_transactions += 1
         if self.uncommitted_transactions >= 5000:
@@ -332,6 +793,225 @@ class SpectrumLibraryIndex:
         return()
 
 
+    def begin_bulk_load(self, start_number=0):
+        """
+        begin_bulk_load - Switch to the fast bulk ingestion mode for building a new index
+
+        Subsequent calls to add_spectrum() only append a tuple to a plain list.
+        The buffered tuples are written with executemany() inserts on a single
+        connection inside one transaction. When filling a freshly created index,
+        journaling and synchronous writes are turned off for the duration of the
+        build, since an interrupted build leaves nothing worth keeping. When
+        re-indexing the tail of a library that has been appended to, the existing
+        index is modified and journaling stays on, so that an interrupted update
+        rolls back to the previous index. The SQL indexes on the record table
+        are only created by end_bulk_load() after all rows are in.
+
+        Parameters
+        ----------
+        start_number : int
+            Keep the records numbered below this and delete the rest, so that
+            loading continues from this spectrum index number
+
+        Returns
+        -------
+        bool
+            True if bulk mode was entered
+        """
+
+        if self.bulk_mode:
+            return(True)
+
+        #### Make sure that nothing is left pending in the ORM session
+        self.commit()
+        self.session.close()
+
+        connection = self.engine.connect()
+        self.bulk_transaction = connection.begin()
+        if start_number == 0:
+            connection.exec_driver_sql("PRAGMA journal_mode=OFF")
+            connection.exec_driver_sql("PRAGMA synchronous=OFF")
+        connection.exec_driver_sql("PRAGMA cache_size=-200000")
+        if start_number > 0:
+            connection.exec_driver_sql(f"DELETE FROM {SpectrumLibraryIndexRecord.__tablename__} WHERE number >= ?", (start_number,) )
+        self.bulk_connection = connection
+        self.bulk_buffer = []
+        self.bulk_n_records = start_number
+        self.bulk_mode = True
+        self.status = 'bulk loading'
+        return(True)
+
+
+    def flush_bulk_buffer(self):
+        """
+        flush_bulk_buffer - Write all buffered records with a single executemany()
+
+        Returns
+        -------
+        int
+            Number of records written
+        """
+
+        if not self.bulk_mode or len(self.bulk_buffer) == 0:
+            return(0)
+
+        column_names = ", ".join([ f'"{column}"' for column in self.columns ])
+        placeholders = ", ".join([ '?' ] * len(self.columns))
+        sql = f"INSERT INTO {SpectrumLibraryIndexRecord.__tablename__} ({column_names}) VALUES ({placeholders})"
+        self.bulk_connection.exec_driver_sql(sql, self.bulk_buffer)
+        n_records = len(self.bulk_buffer)
+        self.bulk_n_records += n_records
+        self.bulk_buffer = []
+        return(n_records)
+
+
+    def end_bulk_load(self):
+        """
+        end_bulk_load - Write out any buffered records, finish the bulk load and create the table indexes
+
+        The size, modification time and partial checksum of the library file are
+        recorded as well if it exists, so that later changes to the library can be detected.
+
+        Returns
+        -------
+        int
+            Number of records in the index after the bulk load
+        """
+
+        if not self.bulk_mode:
+            return(0)
+
+        connection = self.bulk_connection
+        self.flush_bulk_buffer()
+        #### The state can only be recorded if the library file exists. Otherwise any previously recorded state is removed
+        if os.path.exists(self.library_filename):
+            library_state = get_library_state(self.library_filename)
+        else:
+            library_state = {}
+            for name in library_state_attributes:
+                connection.exec_driver_sql(f"DELETE FROM {SpectrumLibraryIndexAttribute.__tablename__} WHERE name = ?", (name,) )
+        library_state['n_spectra'] = self.bulk_n_records
+        for name, value in library_state.items():
+            connection.exec_driver_sql(f"DELETE FROM {SpectrumLibraryIndexAttribute.__tablename__} WHERE name = ?", (name,) )
+            connection.exec_driver_sql(f"INSERT INTO {SpectrumLibraryIndexAttribute.__tablename__} (name, value) VALUES (?, ?)",
+                (name, str(value)) )
+        self.create_table_indexes(connection=connection)
+        self.bulk_transaction.commit()
+
+        #### Put the pooled connection back into its normal durable state
+        connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+        connection.exec_driver_sql("PRAGMA synchronous=FULL")
+        connection.close()
+
+        self.n_spectra = self.bulk_n_records
+        self.precursor_table = None
+        self.offset_table = None
+        self.library_state = 'current'
+        self.bulk_connection = None
+        self.bulk_transaction = None
+        self.bulk_mode = False
+        self.status = 'OK'
+        return(self.bulk_n_records)
+
+
+    def check_library_state(self):
+        """
+        check_library_state - Compare the library file with the state recorded when it was indexed
+
+        The size and modification time are checked first. Only if they differ is
+        the partial checksum of the file computed, over the same byte range as was
+        recorded, to tell a library that was only appended to from one that changed.
+
+        Returns
+        -------
+        string
+            'current' if the index is up to date, 'appended' if entries were only
+            added at the end of the library, 'changed' if the index must be re-created,
+            'unknown' if the index did not record the library state, or
+            'missing' if the library file does not exist
+        """
+
+        if not os.path.exists(self.library_filename):
+            return('missing')
+
+        recorded_state = {}
+        try:
+            attributes = self.session.query(SpectrumLibraryIndexAttribute).filter(
+                SpectrumLibraryIndexAttribute.name.in_(library_state_attributes)).all()
+        except:
+            self.session.rollback()
+            raise
+        for attribute in attributes:
+            recorded_state[attribute.name] = attribute.value
+        if len(recorded_state) < len(library_state_attributes):
+            return('unknown')
+
+        recorded_size = int(recorded_state['library_size'])
+        stat = os.stat(self.library_filename)
+        if stat.st_size == recorded_size and str(stat.st_mtime) == recorded_state['library_mtime']:
+            return('current')
+        if stat.st_size < recorded_size:
+            return('changed')
+        if get_library_checksum(self.library_filename, recorded_size) != recorded_state['library_checksum']:
+            return('changed')
+        if stat.st_size == recorded_size:
+            return('current')
+        return('appended')
+
+
+    def get_last_record(self):
+        """
+        get_last_record - Return the number and offset of the last spectrum in the index
+
+        Returns
+        -------
+        tuple
+            (number, offset) of the spectrum with the highest index number, or (None, None) if the index is empty
+        """
+
+        try:
+            record = self.session.query(SpectrumLibraryIndexRecord.number, SpectrumLibraryIndexRecord.offset).order_by(
+                SpectrumLibraryIndexRecord.number.desc()).first()
+        except:
+            self.session.rollback()
+            raise
+        if record is None:
+            return( (None, None) )
+        return( (record[0], record[1]) )
+
+
+    def create_table_indexes(self, connection=None):
+        """
+        create_table_indexes - Create the SQL indexes on the index record table
+
+        Parameters
+        ----------
+        connection : sqlalchemy Connection
+            Connection to use. If not supplied, a new one is opened and committed
+
+        Returns
+        -------
+        bool
+            True when done
+        """
+
+        table_name = SpectrumLibraryIndexRecord.__tablename__
+        statements = []
+        for columns in indexed_columns:
+            index_name = f"idx_{table_name}_" + "_".join(columns)
+            column_list = ", ".join([ f'"{column}"' for column in columns ])
+            statements.append(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({column_list})")
+
+        if connection is not None:
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+        else:
+            with self.engine.begin() as connection:
+                for statement in statements:
+                    connection.exec_driver_sql(statement)
+        return(True)
+
+
 
 #### Example using this class
 def example():
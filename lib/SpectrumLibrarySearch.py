@@ -0,0 +1,684 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
+
+import os
+import timeit
+
+import numpy as np
+
+#### Use SciPy sparse matrices for scoring large batches of queries if it is installed
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+from LibrarySpectrum import LibrarySpectrum
+from SpectrumLibraryIndex import get_tolerance_delta
+
+debug = True
+
+#### Default width of the m/z bins, close to the spacing of peptide fragment mass clusters
+default_bin_width = 1.0005
+
+#### Suffix added to the index filename for the saved matrix of binned library spectra
+matrix_suffix = '.matrix.npz'
+
+#### Version of the saved matrix layout, to ignore files written by an incompatible version
+matrix_version = 1
+
+#### Queries whose precursor m/z values lie within this many m/z of each other are scored together with one matrix product
+default_block_width = 5.0
+
+#### Maximum number of queries without a precursor m/z to score against the whole library at a time
+full_library_chunk_size = 256
+
+#### Maximum number of scores in the dense block of a chunk of such queries against the whole library,
+#### so that fewer queries are scored at a time against large libraries
+max_dense_scores = 16 * 1024 * 1024
+
+#### With method='auto', batches of at least this many queries are scored with sparse matrix products
+matrix_min_queries = 64
+
+
+#### Scale the peak intensities before binning to reduce the dominance of the most intense peaks
+def scale_intensities(intensities, intensity_scaling='sqrt'):
+    intensities = np.asarray(intensities, dtype=np.float64)
+    if intensity_scaling == 'sqrt':
+        return(np.sqrt(np.maximum(intensities, 0)))
+    elif intensity_scaling is None or intensity_scaling == 'none':
+        return(intensities)
+    else:
+        raise ValueError(f"ERROR: Unrecognized intensity scaling '{intensity_scaling}'")
+
+
+#### Return a boolean array of the peaks that are among the top_k_peaks most intense of their spectrum
+#### Only the peaks of spectra with more than top_k_peaks peaks need to be ranked
+def get_top_peaks_mask(intensities, rows, peak_offsets, top_k_peaks):
+    keep = np.ones(len(rows), dtype=bool)
+    peaks = np.flatnonzero(np.diff(peak_offsets)[rows] > top_k_peaks)
+    if len(peaks) > 0:
+        order = peaks[np.lexsort( (-np.asarray(intensities)[peaks], rows[peaks]) )]
+        keep[order] = np.arange(len(order), dtype=np.int64) - np.searchsorted(rows[order], rows[order], side='left') < top_k_peaks
+    return(keep)
+
+
+def bin_spectra(mzs, intensities, peak_offsets, bin_width=default_bin_width, intensity_scaling='sqrt', top_k_peaks=None):
+    """
+    bin_spectra - Convert the concatenated peaks of many spectra into binned, unit-length vectors
+
+    The intensities of peaks of the same spectrum that fall into the same m/z
+    bin are summed, and each spectrum vector is then normalized to unit length,
+    so the dot product of two vectors is their cosine similarity. The result is
+    in compressed sparse row form with one row per spectrum.
+
+    Parameters
+    ----------
+    mzs : numpy.ndarray
+        m/z values of the peaks of all spectra
+    intensities : numpy.ndarray
+        Intensities of the peaks of all spectra
+    peak_offsets : numpy.ndarray
+        Offsets of the first peak of each spectrum, plus the total number of peaks
+    bin_width : float
+        Width of the m/z bins
+    intensity_scaling : string
+        'sqrt' to use the square root of the intensities, or 'none'
+    top_k_peaks : int
+        If supplied, only use this many most intense peaks of each spectrum
+
+    Returns
+    -------
+    tuple
+        bin_offsets (int64, one more than the number of spectra), bins (int32) and weights (float32)
+    """
+
+    peak_offsets = np.asarray(peak_offsets, dtype=np.int64)
+    n_spectra = len(peak_offsets) - 1
+    rows = np.repeat(np.arange(n_spectra, dtype=np.int64), np.diff(peak_offsets))
+    mzs = np.asarray(mzs, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+
+    if top_k_peaks is not None and len(mzs) > 0:
+        keep = get_top_peaks_mask(intensities, rows, peak_offsets, top_k_peaks)
+        rows = rows[keep]
+        mzs = mzs[keep]
+        intensities = intensities[keep]
+
+    bins = np.floor(mzs / bin_width).astype(np.int64)
+    weights = scale_intensities(intensities, intensity_scaling)
+
+    #### Peaks are normally sorted by m/z within each spectrum, so only sort if they are not
+    if len(bins) > 1 and not np.all( (bins[1:] >= bins[:-1]) | (rows[1:] != rows[:-1]) ):
+        order = np.lexsort( (bins, rows) )
+        rows = rows[order]
+        bins = bins[order]
+        weights = weights[order]
+
+    #### Sum the weights of the peaks that share a bin
+    if len(bins) > 0:
+        is_new_bin = np.ones(len(bins), dtype=bool)
+        is_new_bin[1:] = (bins[1:] != bins[:-1]) | (rows[1:] != rows[:-1])
+        starts = np.flatnonzero(is_new_bin)
+        weights = np.add.reduceat(weights, starts)
+        rows = rows[starts]
+        bins = bins[starts]
+
+    #### Normalize each spectrum to unit length
+    norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=n_spectra))
+    norms[norms == 0] = 1.0
+    weights = weights / norms[rows]
+
+    bin_offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_spectra), out=bin_offsets[1:])
+    return( (bin_offsets, bins.astype(np.int32), weights.astype(np.float32)) )
+
+
+class SpectrumLibrarySearch:
+    """
+    SpectrumLibrarySearch - Class for searching query spectra against a spectrum library by spectral similarity
+
+    The peaks of the whole library are taken from its columnar table (see
+    SpectrumLibrary.load_table()) and binned once into a sparse matrix with one
+    row per spectrum, with the rows sorted by precursor m/z. The matrix is saved
+    next to the index and reused until the library or index changes. Queries are
+    scored with the cosine of the binned vectors, either against the candidates
+    within the precursor m/z tolerance of each query, or for large batches with
+    sparse matrix products over blocks of the library.
+
+    Attributes
+    ----------
+    bin_width : float
+        Width of the m/z bins
+    intensity_scaling : string
+        Scaling of the intensities before binning, 'sqrt' or 'none'
+    top_k_peaks : int
+        If not None, only this many most intense peaks of each spectrum are used
+    row_numbers : numpy.ndarray
+        Spectrum index number of each row of the matrix
+    row_precursor_mzs : numpy.ndarray
+        Precursor m/z of each row of the matrix, in ascending order with unknown values (NaN) last
+    row_charges : numpy.ndarray
+        Precursor charge of each row of the matrix, 0 if unknown
+
+    Methods
+    -------
+    create_matrix - Bin the peaks of all library spectra into the rows of the matrix
+    save_matrix - Write the binned library to a file next to the index
+    load_matrix - Read the binned library written by save_matrix() if it is still current
+    get_matrix - Return the binned library as a SciPy sparse CSR matrix
+    get_query_vector - Bin and normalize the peaks of a query spectrum
+    score_candidates - Return the cosine similarity of a query vector with each of the candidate spectra
+    search - Return the best matching library spectra for one query
+    search_spectrum - Return the best matching library spectra for a LibrarySpectrum
+    search_batch - Return the best matching library spectra for each of many queries
+    search_batch_matrix - Score a batch of queries with sparse matrix products
+
+    """
+
+
+    #### Constructor
+    def __init__(self, spectrum_library=None, bin_width=default_bin_width, intensity_scaling='sqrt', top_k_peaks=None, use_saved_matrix=True):
+        """
+        __init__ - SpectrumLibrarySearch constructor
+
+        Parameters
+        ----------
+        spectrum_library : SpectrumLibrary
+            The library to search
+        bin_width : float
+            Width of the m/z bins
+        intensity_scaling : string
+            Scaling of the intensities before binning, 'sqrt' or 'none'
+        top_k_peaks : int
+            If supplied, only use this many most intense peaks of each spectrum
+        use_saved_matrix : bool
+            If set, load the saved matrix if it is current, and save a newly built one
+
+        """
+
+        if spectrum_library is None:
+            raise Exception('Spectrum library missing')
+        self.spectrum_library = spectrum_library
+        self.bin_width = bin_width
+        self.intensity_scaling = intensity_scaling
+        self.top_k_peaks = top_k_peaks
+        self.matrix = None
+
+        matrix_filename = spectrum_library.filename + '.splindex' + matrix_suffix
+        if not use_saved_matrix or not self.load_matrix(matrix_filename):
+            self.create_matrix()
+            if use_saved_matrix:
+                try:
+                    self.save_matrix(matrix_filename)
+                except OSError as error:
+                    eprint(f"WARNING: Unable to write matrix {matrix_filename}: {error}")
+
+
+    #### Number of spectra in the matrix
+    @property
+    def n_spectra(self):
+        return(len(self.row_numbers))
+
+
+    #### Return the parameters that the binned library depends on, to check that a saved matrix matches
+    def get_parameters(self):
+        return( { 'version': matrix_version, 'bin_width': float(self.bin_width), 'intensity_scaling': str(self.intensity_scaling),
+            'top_k_peaks': -1 if self.top_k_peaks is None else int(self.top_k_peaks) } )
+
+
+    #### Compute the lookup from spectrum index number to matrix row, -1 for spectra not in the matrix
+    def set_number_rows(self):
+        n_numbers = int(self.row_numbers.max()) + 1 if len(self.row_numbers) > 0 else 0
+        self.number_rows = np.full(n_numbers, -1, dtype=np.int64)
+        self.number_rows[self.row_numbers] = np.arange(len(self.row_numbers), dtype=np.int64)
+        self.matrix = None
+
+
+    #### Return the matrix row of each spectrum index number, -1 for spectra not in the matrix (such as spectra indexed after it was built)
+    def get_rows(self, numbers):
+        numbers = np.asarray(numbers, dtype=np.int64)
+        rows = np.full(len(numbers), -1, dtype=np.int64)
+        in_range = (numbers >= 0) & (numbers < len(self.number_rows))
+        rows[in_range] = self.number_rows[numbers[in_range]]
+        return(rows)
+
+
+    def create_matrix(self):
+        """
+        create_matrix - Bin the peaks of all library spectra into the rows of the matrix
+
+        Returns
+        -------
+        int
+            Number of spectra in the matrix
+        """
+
+        t0 = timeit.default_timer()
+        table = self.spectrum_library.load_table()
+
+        #### Sort the rows by precursor m/z so that each precursor window is a contiguous block of rows
+        order = np.argsort(table.precursor_mz, kind='stable')
+        table = table.subset(order)
+        self.row_numbers = table.number.astype(np.int64)
+        self.row_precursor_mzs = table.precursor_mz.astype(np.float64)
+        self.row_charges = table.charge.astype(np.int16)
+        self.bin_offsets, self.bins, self.weights = bin_spectra(table.mzs, table.intensities, table.peak_offsets,
+            bin_width=self.bin_width, intensity_scaling=self.intensity_scaling, top_k_peaks=self.top_k_peaks)
+        self.n_bins = int(self.bins.max()) + 1 if len(self.bins) > 0 else 0
+        self.set_number_rows()
+
+        t1 = timeit.default_timer()
+        if debug: eprint(f"INFO: Binned {self.n_spectra} library spectra for searching in {t1-t0:.3f} s")
+        return(self.n_spectra)
+
+
+    def save_matrix(self, filename):
+        """
+        save_matrix - Write the binned library to an uncompressed NumPy .npz file
+
+        Parameters
+        ----------
+        filename : string
+            Name of the file to write
+        """
+
+        parameters = self.get_parameters()
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, bin_offsets=self.bin_offsets, bins=self.bins, weights=self.weights, row_numbers=self.row_numbers,
+                row_precursor_mzs=self.row_precursor_mzs, row_charges=self.row_charges, n_bins=np.array(self.n_bins, dtype=np.int64),
+                library_size=np.array(os.path.getsize(self.spectrum_library.filename), dtype=np.int64),
+                **{ 'parameter_' + name: np.array(value) for name, value in parameters.items() })
+
+
+    def load_matrix(self, filename):
+        """
+        load_matrix - Read the binned library written by save_matrix() if it is still current
+
+        The file is only used if it is at least as new as both the library and
+        its index, was built from a library of the current size, and was binned
+        with the same parameters.
+
+        Parameters
+        ----------
+        filename : string
+            Name of the file to read
+
+        Returns
+        -------
+        bool
+            True if the matrix was loaded
+        """
+
+        library_filename = self.spectrum_library.filename
+        if not os.path.exists(filename):
+            return(False)
+        mtime = os.path.getmtime(filename)
+        if mtime < os.path.getmtime(library_filename):
+            return(False)
+        index_filename = library_filename + '.splindex'
+        if os.path.exists(index_filename) and mtime < os.path.getmtime(index_filename):
+            return(False)
+
+        with np.load(filename, allow_pickle=False) as arrays:
+            if 'library_size' not in arrays or int(arrays['library_size']) != os.path.getsize(library_filename):
+                return(False)
+            for name, value in self.get_parameters().items():
+                if 'parameter_' + name not in arrays or arrays['parameter_' + name].item() != value:
+                    if debug: eprint(f"INFO: Matrix {filename} was built with other parameters and is ignored")
+                    return(False)
+            self.bin_offsets = arrays['bin_offsets']
+            self.bins = arrays['bins']
+            self.weights = arrays['weights']
+            self.row_numbers = arrays['row_numbers']
+            self.row_precursor_mzs = arrays['row_precursor_mzs']
+            self.row_charges = arrays['row_charges']
+            self.n_bins = int(arrays['n_bins'])
+        self.set_number_rows()
+        return(True)
+
+
+    def get_matrix(self):
+        """
+        get_matrix - Return the binned library as a SciPy sparse CSR matrix
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            Matrix with one unit-length row per spectrum, in the order of row_numbers, and one column per m/z bin
+        """
+
+        if scipy is None:
+            raise Exception("ERROR: SciPy is required for scoring with sparse matrices but is not installed")
+        if self.matrix is None:
+            self.matrix = scipy.sparse.csr_matrix( (self.weights, self.bins, self.bin_offsets), shape=(self.n_spectra, self.n_bins) )
+        return(self.matrix)
+
+
+    def get_query_vector(self, mzs, intensities):
+        """
+        get_query_vector - Bin and normalize the peaks of a query spectrum
+
+        Parameters
+        ----------
+        mzs : array
+            m/z values of the query peaks
+        intensities : array
+            Intensities of the query peaks
+
+        Returns
+        -------
+        tuple
+            Sorted bins (int32) and unit-length weights (float32) of the query
+        """
+
+        bin_offsets, bins, weights = bin_spectra(mzs, intensities, [ 0, len(mzs) ], bin_width=self.bin_width,
+            intensity_scaling=self.intensity_scaling, top_k_peaks=self.top_k_peaks)
+        return( (bins, weights) )
+
+
+    def score_candidates(self, query_bins, query_weights, candidates):
+        """
+        score_candidates - Return the cosine similarity of a query vector with each of the candidate spectra
+
+        Parameters
+        ----------
+        query_bins : numpy.ndarray
+            Sorted bins of the query (see get_query_vector())
+        query_weights : numpy.ndarray
+            Unit-length weights of the query
+        candidates : numpy.ndarray
+            Spectrum index numbers of the library spectra to score
+
+        Returns
+        -------
+        numpy.ndarray
+            Cosine similarity for each candidate, 0 for candidates that are not in the matrix
+        """
+
+        candidates = np.asarray(candidates, dtype=np.int64)
+        if len(candidates) == 0 or len(query_bins) == 0:
+            return(np.zeros(len(candidates), dtype=np.float32))
+
+        #### Gather the binned peaks of all candidates without a Python loop over candidates
+        rows = self.get_rows(candidates)
+        known = rows >= 0
+        starts = np.zeros(len(candidates), dtype=np.int64)
+        counts = np.zeros(len(candidates), dtype=np.int64)
+        starts[known] = self.bin_offsets[rows[known]]
+        counts[known] = self.bin_offsets[rows[known] + 1] - starts[known]
+        ends = np.cumsum(counts)
+        positions = np.repeat(starts - (ends - counts), counts) + np.arange(ends[-1], dtype=np.int64)
+        library_bins = self.bins[positions]
+
+        #### Look up each library bin in the query and sum the products for each candidate
+        query_positions = np.searchsorted(query_bins, library_bins)
+        query_positions[query_positions == len(query_bins)] = 0
+        products = np.where(query_bins[query_positions] == library_bins, query_weights[query_positions] * self.weights[positions], 0)
+        labels = np.repeat(np.arange(len(candidates), dtype=np.int64), counts)
+        return(np.bincount(labels, weights=products, minlength=len(candidates)).astype(np.float32))
+
+
+    def search(self, mzs, intensities, precursor_mz=None, charge=None, tolerance=20, tolerance_units='ppm', top_n=10, candidates=None):
+        """
+        search - Return the best matching library spectra for one query
+
+        Parameters
+        ----------
+        mzs : array
+            m/z values of the query peaks
+        intensities : array
+            Intensities of the query peaks
+        precursor_mz : float
+            Precursor m/z of the query. If None, the whole library is scored
+        charge : int
+            If supplied, only score library spectra with this precursor charge
+        tolerance : float
+            Half-width of the precursor m/z window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        top_n : int
+            Maximum number of hits to return
+        candidates : numpy.ndarray
+            Spectrum index numbers to score instead of looking them up by precursor m/z
+
+        Returns
+        -------
+        list
+            (spectrum_index_number, score) tuples of the best hits, best first
+        """
+
+        if candidates is None:
+            if precursor_mz is not None:
+                candidates = self.spectrum_library.index.find_offsets_batch( [ precursor_mz ], tolerance=tolerance,
+                    tolerance_units=tolerance_units, charges=[ charge ])[0]
+            elif charge is not None:
+                candidates = self.row_numbers[self.row_charges == charge]
+            else:
+                candidates = self.row_numbers
+
+        #### Candidates that are not in the matrix cannot be scored, so they are not hits
+        candidates = np.asarray(candidates, dtype=np.int64)
+        unknown = self.get_rows(candidates) < 0
+        if unknown.any():
+            if debug: eprint(f"WARNING: Skipping {int(unknown.sum())} candidates that are not in the search matrix")
+            candidates = candidates[~unknown]
+        query_bins, query_weights = self.get_query_vector(mzs, intensities)
+        scores = self.score_candidates(query_bins, query_weights, candidates)
+        return(self.get_top_hits(candidates, scores, top_n))
+
+
+    #### Return the top_n candidates with the highest scores, best first
+    def get_top_hits(self, candidates, scores, top_n):
+        if len(scores) > top_n:
+            best = np.argpartition(-scores, top_n)[:top_n]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return( [ (int(candidates[i]), float(scores[i])) for i in best ] )
+
+
+    def search_spectrum(self, spectrum, tolerance=20, tolerance_units='ppm', top_n=10, use_charge=True):
+        """
+        search_spectrum - Return the best matching library spectra for a LibrarySpectrum
+
+        The precursor m/z and charge are taken from the attributes of the spectrum.
+
+        Parameters
+        ----------
+        spectrum : LibrarySpectrum
+            The query spectrum
+        tolerance : float
+            Half-width of the precursor m/z window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        top_n : int
+            Maximum number of hits to return
+        use_charge : bool
+            If set and the query has a charge, only score library spectra with the same charge
+
+        Returns
+        -------
+        list
+            (spectrum_index_number, score) tuples of the best hits, best first
+        """
+
+        charge = spectrum.get_charge() if use_charge else None
+        return(self.search(spectrum.mzs, spectrum.intensities, precursor_mz=spectrum.get_precursor_mz(), charge=charge,
+            tolerance=tolerance, tolerance_units=tolerance_units, top_n=top_n))
+
+
+    def search_batch(self, queries, tolerance=20, tolerance_units='ppm', top_n=10, use_charge=True, method='auto'):
+        """
+        search_batch - Return the best matching library spectra for each of many queries
+
+        Parameters
+        ----------
+        queries : list
+            LibrarySpectrum objects or (mzs, intensities, precursor_mz, charge) tuples
+        tolerance : float
+            Half-width of the precursor m/z window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        top_n : int
+            Maximum number of hits to return per query
+        use_charge : bool
+            If set, only score library spectra with the same charge as the query when it is known
+        method : string
+            'candidates' to look up the candidates of all queries in the index at once and score each query
+            against its candidates, 'matrix' to score the queries with sparse matrix products (see
+            search_batch_matrix()), or 'auto' to use 'matrix' for large batches if SciPy is installed
+
+        Returns
+        -------
+        list
+            A list of (spectrum_index_number, score) tuples, best first, for each query
+        """
+
+        #### Extract the peaks, precursor m/z and charge of each query
+        query_peaks = []
+        precursor_mzs = []
+        charges = []
+        for query in queries:
+            if isinstance(query, LibrarySpectrum):
+                query_peaks.append( (query.mzs, query.intensities) )
+                precursor_mzs.append(query.get_precursor_mz())
+                charges.append(query.get_charge() if use_charge else None)
+            else:
+                mzs, intensities, precursor_mz, charge = query
+                query_peaks.append( (mzs, intensities) )
+                precursor_mzs.append(precursor_mz)
+                charges.append(charge if use_charge else None)
+
+        if method == 'auto':
+            method = 'matrix' if scipy is not None and len(query_peaks) >= matrix_min_queries else 'candidates'
+        if method == 'matrix':
+            return(self.search_batch_matrix(query_peaks, precursor_mzs, charges, tolerance=tolerance, tolerance_units=tolerance_units,
+                top_n=top_n))
+        elif method != 'candidates':
+            raise ValueError(f"ERROR: Unrecognized search method '{method}'")
+
+        #### Find the candidates of all the queries with a precursor m/z at once
+        with_precursor = [ i for i in range(len(precursor_mzs)) if precursor_mzs[i] is not None ]
+        candidates = [ None ] * len(precursor_mzs)
+        if len(with_precursor) > 0:
+            results = self.spectrum_library.index.find_offsets_batch( [ precursor_mzs[i] for i in with_precursor ], tolerance=tolerance,
+                tolerance_units=tolerance_units, charges=[ charges[i] for i in with_precursor ])
+            for i, result in zip(with_precursor, results):
+                candidates[i] = result
+
+        hits = []
+        for (mzs, intensities), charge, query_candidates in zip(query_peaks, charges, candidates):
+            hits.append(self.search(mzs, intensities, charge=charge, top_n=top_n, candidates=query_candidates))
+        return(hits)
+
+
+    def search_batch_matrix(self, query_peaks, precursor_mzs, charges=None, tolerance=20, tolerance_units='ppm', top_n=10,
+            block_width=default_block_width):
+        """
+        search_batch_matrix - Score a batch of queries with sparse matrix products
+
+        The queries are binned into a sparse matrix of their own and sorted by
+        precursor m/z. Queries whose precursor m/z values lie within block_width
+        of each other form a block, and the block is scored with one product of
+        the library rows that cover all of its precursor windows and the query
+        columns. Each query then only keeps the rows within its own window.
+        Queries without a precursor m/z are scored against the whole library.
+
+        Parameters
+        ----------
+        query_peaks : list
+            (mzs, intensities) of each query
+        precursor_mzs : list
+            Precursor m/z of each query, or None to score the query against the whole library
+        charges : list
+            Precursor charge required of the library spectra for each query, or None for any charge
+        tolerance : float
+            Half-width of the precursor m/z window
+        tolerance_units : string
+            Units of the tolerance, either 'ppm' or 'Da'
+        top_n : int
+            Maximum number of hits to return per query
+        block_width : float
+            Maximum spread of the precursor m/z values of the queries in one block
+
+        Returns
+        -------
+        list
+            A list of (spectrum_index_number, score) tuples, best first, for each query
+        """
+
+        library_matrix = self.get_matrix()
+        n_queries = len(query_peaks)
+        if charges is None:
+            charges = [ None ] * n_queries
+
+        #### Bin all the queries at once and drop any bins beyond the highest library bin, which cannot match
+        peak_offsets = np.zeros(n_queries + 1, dtype=np.int64)
+        np.cumsum( [ len(mzs) for mzs, intensities in query_peaks ], out=peak_offsets[1:])
+        mzs = np.concatenate( [ np.asarray(mzs, dtype=np.float64) for mzs, intensities in query_peaks ] ) if n_queries > 0 else []
+        intensities = np.concatenate( [ np.asarray(intensities, dtype=np.float64) for mzs, intensities in query_peaks ] ) if n_queries > 0 else []
+        bin_offsets, bins, weights = bin_spectra(mzs, intensities, peak_offsets, bin_width=self.bin_width,
+            intensity_scaling=self.intensity_scaling, top_k_peaks=self.top_k_peaks)
+        query_rows = np.repeat(np.arange(n_queries, dtype=np.int64), np.diff(bin_offsets))
+        in_range = bins < self.n_bins
+        query_matrix = scipy.sparse.csr_matrix( (weights[in_range], (query_rows[in_range], bins[in_range])),
+            shape=(n_queries, self.n_bins) )
+
+        hits = [ [] for i in range(n_queries) ]
+        row_charges = self.row_charges
+
+        #### Score the queries without a precursor m/z against the whole library, a chunk of queries at a time,
+        #### with chunks small enough that the dense block of scores stays within max_dense_scores
+        without_precursor = np.array( [ i for i in range(n_queries) if precursor_mzs[i] is None ], dtype=np.int64)
+        chunk_size = max(1, min(full_library_chunk_size, max_dense_scores // max(self.n_spectra, 1)))
+        charge_rows = {}
+        for chunk_start in range(0, len(without_precursor), chunk_size):
+            chunk = without_precursor[chunk_start:chunk_start + chunk_size]
+            scores = (library_matrix @ query_matrix[chunk].T).toarray()
+            for column, query_index in enumerate(chunk):
+                query_scores = scores[:, column]
+                charge = charges[query_index]
+                if charge is None:
+                    hits[query_index] = self.get_top_hits(self.row_numbers, query_scores.astype(np.float32), top_n)
+                    continue
+                rows = charge_rows.get(charge)
+                if rows is None:
+                    rows = np.flatnonzero(row_charges == charge)
+                    charge_rows[charge] = rows
+                hits[query_index] = self.get_top_hits(self.row_numbers[rows], query_scores[rows].astype(np.float32), top_n)
+
+        #### Sort the queries with a precursor m/z and score them in blocks of nearby precursor m/z
+        with_precursor = np.array( [ i for i in range(n_queries) if precursor_mzs[i] is not None ], dtype=np.int64)
+        if len(with_precursor) == 0:
+            return(hits)
+        query_mzs = np.array( [ precursor_mzs[i] for i in with_precursor ], dtype=np.float64)
+        order = np.argsort(query_mzs, kind='stable')
+        with_precursor = with_precursor[order]
+        query_mzs = query_mzs[order]
+        deltas = get_tolerance_delta(query_mzs, tolerance, tolerance_units)
+        window_starts = np.searchsorted(self.row_precursor_mzs, query_mzs - deltas, side='left')
+        window_ends = np.searchsorted(self.row_precursor_mzs, query_mzs + deltas, side='right')
+
+        block_start = 0
+        while block_start < len(with_precursor):
+            block_end = int(np.searchsorted(query_mzs, query_mzs[block_start] + block_width, side='right'))
+            first_row = int(window_starts[block_start:block_end].min())
+            last_row = int(window_ends[block_start:block_end].max())
+            block_queries = with_precursor[block_start:block_end]
+            if last_row > first_row:
+                scores = (library_matrix[first_row:last_row] @ query_matrix[block_queries].T).toarray()
+            for column, query_index in enumerate(block_queries):
+                start = window_starts[block_start + column]
+                end = window_ends[block_start + column]
+                if end <= start:
+                    continue
+                rows = np.arange(start, end, dtype=np.int64)
+                query_scores = scores[start - first_row:end - first_row, column]
+                if charges[query_index] is not None:
+                    keep = row_charges[start:end] == charges[query_index]
+                    rows = rows[keep]
+                    query_scores = query_scores[keep]
+                hits[query_index] = self.get_top_hits(self.row_numbers[rows], query_scores.astype(np.float32), top_n)
+            block_start = block_end
+        return(hits)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+import sys
+def eprint(*args, **kwargs): print(*args, file=sys.stderr, flush=True, **kwargs)
+
+import os
+
+import numpy as np
+
+debug = True
+
+#### Suffix added to the library filename for the saved table
+table_suffix = '.sptable.npz'
+
+#### Names and types of the per-spectrum columns. Unknown numeric values are NaN or 0, unknown strings are empty.
+#### The str columns are stored as one UTF-8 buffer plus offsets rather than as fixed-width arrays padded to the longest value
+table_columns = {
+    'number': np.int64,
+    'offset': np.int64,
+    'length': np.int64,
+    'name': str,
+    'peptide_sequence': str,
+    'charge': np.int16,
+    'precursor_mz': np.float64,
+    'n_peaks': np.int32,
+    'mods': str,
+}
+
+
+#### Encode a list of strings into one UTF-8 buffer and the offsets of each string into it, plus the total length
+def encode_strings(values):
+    encoded_values = [ value.encode('utf-8') for value in values ]
+    offsets = np.zeros(len(encoded_values) + 1, dtype=np.int64)
+    np.cumsum([ len(value) for value in encoded_values ], out=offsets[1:])
+    return( (np.frombuffer(b''.join(encoded_values), dtype=np.uint8).copy(), offsets) )
+
+
+#### Return the indexes of the elements of the selected rows of a concatenated array, and the offsets of the rows in the result
+def gather_rows(offsets, rows):
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    indexes = np.repeat(starts - new_offsets[:-1], counts) + np.arange(new_offsets[-1], dtype=np.int64)
+    return( (indexes, new_offsets) )
+
+
+class SpectrumLibraryTable:
+    """
+    SpectrumLibraryTable - Class for a columnar in-memory table of the spectra in a library
+
+    Each numeric column is a NumPy array with one element per spectrum. The peaks of all
+    spectra are concatenated into shared m/z and intensity arrays, and the peaks of
+    the i-th spectrum are mzs[peak_offsets[i]:peak_offsets[i+1]]. The string columns
+    are stored the same way, as a UTF-8 byte buffer and offsets into it.
+
+    Attributes
+    ----------
+    columns : dict
+        NumPy array of each numeric column in table_columns, by column name
+    string_columns : dict
+        (uint8 UTF-8 buffer, int64 offsets) tuple of each str column in table_columns, by column name
+    mzs : numpy.ndarray
+        float64 m/z values of the peaks of all spectra
+    intensities : numpy.ndarray
+        float32 intensities of the peaks of all spectra
+    peak_offsets : numpy.ndarray
+        int64 offsets of the first peak of each spectrum into mzs and intensities, plus the total number of peaks
+
+    Methods
+    -------
+    get_column - Return the array of one column
+    get_string - Return the value of a str column in one row
+    get_peaks - Return the m/z values and intensities of the spectrum in one row
+    get_mask - Return a boolean array of the rows that match the input parameters
+    subset - Return a new table with only the selected rows
+    select - Return a new table with only the rows that match the input parameters
+    save - Write the table to a file
+    load - Read a table from a file
+
+    """
+
+
+    #### Constructor
+    def __init__(self, columns=None, mzs=None, intensities=None, peak_offsets=None, string_columns=None):
+        """
+        __init__ - SpectrumLibraryTable constructor
+
+        Parameters
+        ----------
+        columns : dict
+            Array or list of values of each column, by column name. Missing columns are left empty
+        string_columns : dict
+            Already encoded (UTF-8 buffer, offsets) tuple of str columns, by column name, instead of lists of strings in columns
+        mzs : array
+            m/z values of the peaks of all spectra
+        intensities : array
+            Intensities of the peaks of all spectra
+        peak_offsets : array
+            Offsets of the first peak of each spectrum, plus the total number of peaks
+
+        """
+
+        if columns is None:
+            columns = {}
+        if string_columns is None:
+            string_columns = {}
+        n_rows = 0
+        for values in columns.values():
+            n_rows = len(values)
+            break
+        else:
+            for buffer, offsets in string_columns.values():
+                n_rows = len(offsets) - 1
+                break
+
+        self.columns = {}
+        self.string_columns = {}
+        for column_name, column_type in table_columns.items():
+            if column_type is str:
+                if column_name in string_columns:
+                    buffer, offsets = string_columns[column_name]
+                    self.string_columns[column_name] = ( np.asarray(buffer, dtype=np.uint8), np.asarray(offsets, dtype=np.int64) )
+                elif column_name in columns:
+                    self.string_columns[column_name] = encode_strings(columns[column_name])
+                else:
+                    self.string_columns[column_name] = ( np.zeros(0, dtype=np.uint8), np.zeros(n_rows + 1, dtype=np.int64) )
+                n_column_rows = len(self.string_columns[column_name][1]) - 1
+            else:
+                if column_name in columns:
+                    self.columns[column_name] = np.asarray(columns[column_name], dtype=column_type)
+                else:
+                    self.columns[column_name] = np.zeros(n_rows, dtype=column_type)
+                n_column_rows = len(self.columns[column_name])
+            if n_column_rows != n_rows:
+                raise ValueError(f"ERROR: Column {column_name} has {n_column_rows} rows instead of {n_rows}")
+
+        self.mzs = np.asarray(mzs if mzs is not None else [], dtype=np.float64)
+        self.intensities = np.asarray(intensities if intensities is not None else [], dtype=np.float32)
+        if peak_offsets is None:
+            peak_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+        self.peak_offsets = np.asarray(peak_offsets, dtype=np.int64)
+        if len(self.peak_offsets) != n_rows + 1:
+            raise ValueError(f"ERROR: There are {len(self.peak_offsets)} peak offsets for {n_rows} rows")
+
+
+    #### Number of spectra in the table
+    def __len__(self):
+        return(len(self.peak_offsets) - 1)
+
+
+    #### Allow the columns to be accessed as attributes, e.g. table.precursor_mz
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns')
+        if columns is not None and name in columns:
+            return(columns[name])
+        string_columns = self.__dict__.get('string_columns')
+        if string_columns is not None and name in string_columns:
+            return(self.get_column(name))
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+
+    def get_column(self, column_name):
+        """
+        get_column - Return the array of one column
+
+        The values of a str column are decoded into a new object array on each call,
+        so use get_string() for single values.
+
+        Parameters
+        ----------
+        column_name : string
+            Name of the column, one of table_columns
+
+        Returns
+        -------
+        numpy.ndarray
+            Values of the column for all rows
+        """
+
+        if column_name in self.string_columns:
+            buffer, offsets = self.string_columns[column_name]
+            data = buffer.tobytes()
+            values = np.empty(len(offsets) - 1, dtype=object)
+            values[:] = [ data[offsets[row]:offsets[row + 1]].decode('utf-8') for row in range(len(offsets) - 1) ]
+            return(values)
+        if column_name not in self.columns:
+            raise ValueError(f"ERROR: Unrecognized column '{column_name}'")
+        return(self.columns[column_name])
+
+
+    def get_string(self, column_name, row):
+        """
+        get_string - Return the value of a str column in one row
+
+        Parameters
+        ----------
+        column_name : string
+            Name of the column, one of the str columns of table_columns
+        row : int
+            Row number in the table (not the spectrum index number)
+
+        Returns
+        -------
+        string
+            The decoded value
+        """
+
+        if column_name not in self.string_columns:
+            raise ValueError(f"ERROR: Unrecognized string column '{column_name}'")
+        buffer, offsets = self.string_columns[column_name]
+        return(buffer[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8'))
+
+
+    def get_peaks(self, row):
+        """
+        get_peaks - Return the m/z values and intensities of the spectrum in one row
+
+        Parameters
+        ----------
+        row : int
+            Row number in the table (not the spectrum index number)
+
+        Returns
+        -------
+        tuple
+            Views of the m/z and intensity arrays for the spectrum
+        """
+
+        start = self.peak_offsets[row]
+        end = self.peak_offsets[row + 1]
+        return( (self.mzs[start:end], self.intensities[start:end]) )
+
+
+    def get_mask(self, charge=None, min_precursor_mz=None, max_precursor_mz=None, peptide_sequence=None, min_n_peaks=None):
+        """
+        get_mask - Return a boolean array of the rows that match the input parameters
+
+        Parameters
+        ----------
+        charge : int
+            Precursor charge
+        min_precursor_mz : float
+            Lowest precursor m/z
+        max_precursor_mz : float
+            Highest precursor m/z
+        peptide_sequence : string
+            Unmodified peptide sequence
+        min_n_peaks : int
+            Minimum number of peaks
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array with True for each selected row
+        """
+
+        mask = np.ones(len(self), dtype=bool)
+        if charge is not None:
+            mask &= self.columns['charge'] == charge
+        if min_precursor_mz is not None:
+            mask &= self.columns['precursor_mz'] >= min_precursor_mz
+        if max_precursor_mz is not None:
+            mask &= self.columns['precursor_mz'] <= max_precursor_mz
+        if peptide_sequence is not None:
+            #### Compare the encoded bytes of only the rows with the right length, without decoding the column
+            value = np.frombuffer(peptide_sequence.encode('utf-8'), dtype=np.uint8)
+            buffer, offsets = self.string_columns['peptide_sequence']
+            matches = np.zeros(len(self), dtype=bool)
+            rows = np.flatnonzero(np.diff(offsets) == len(value))
+            if len(rows) > 0:
+                matches[rows] = np.all(buffer[offsets[rows, np.newaxis] + np.arange(len(value))] == value, axis=1)
+            mask &= matches
+        if min_n_peaks is not None:
+            mask &= self.columns['n_peaks'] >= min_n_peaks
+        return(mask)
+
+
+    def subset(self, rows):
+        """
+        subset - Return a new table with only the selected rows
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            Boolean mask or array of row numbers
+
+        Returns
+        -------
+        SpectrumLibraryTable
+            Table with the selected rows and their peaks
+        """
+
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        columns = { column_name: values[rows] for column_name, values in self.columns.items() }
+
+        #### Gather the strings and peaks of the selected rows without a Python loop over rows
+        string_columns = {}
+        for column_name, ( buffer, offsets ) in self.string_columns.items():
+            indexes, new_offsets = gather_rows(offsets, rows)
+            string_columns[column_name] = ( buffer[indexes], new_offsets )
+        peak_indexes, peak_offsets = gather_rows(self.peak_offsets, rows)
+
+        return(SpectrumLibraryTable(columns=columns, mzs=self.mzs[peak_indexes], intensities=self.intensities[peak_indexes],
+            peak_offsets=peak_offsets, string_columns=string_columns))
+
+
+    def select(self, charge=None, min_precursor_mz=None, max_precursor_mz=None, peptide_sequence=None, min_n_peaks=None):
+        """
+        select - Return a new table with only the rows that match the input parameters (see get_mask())
+
+        Returns
+        -------
+        SpectrumLibraryTable
+            Table with the selected rows and their peaks
+        """
+
+        return(self.subset(self.get_mask(charge=charge, min_precursor_mz=min_precursor_mz, max_precursor_mz=max_precursor_mz,
+            peptide_sequence=peptide_sequence, min_n_peaks=min_n_peaks)))
+
+
+    def save(self, filename, library_size=None):
+        """
+        save - Write the table to an uncompressed NumPy .npz file
+
+        Parameters
+        ----------
+        filename : string
+            Name of the file to write
+        library_size : int
+            Size of the library file the table was built from, stored so that a stale table can be recognized
+        """
+
+        arrays = { 'column_' + column_name: values for column_name, values in self.columns.items() }
+        for column_name, ( buffer, offsets ) in self.string_columns.items():
+            arrays['column_' + column_name] = buffer
+            arrays['column_' + column_name + '_offsets'] = offsets
+        if library_size is not None:
+            arrays['library_size'] = np.array(library_size, dtype=np.int64)
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, mzs=self.mzs, intensities=self.intensities, peak_offsets=self.peak_offsets, **arrays)
+
+
+    @staticmethod
+    def load(filename, library_filename=None):
+        """
+        load - Read a table from a file written by save()
+
+        Parameters
+        ----------
+        filename : string
+            Name of the file to read
+        library_filename : string
+            If supplied, only load the table if it is at least as new as this library and
+            its index, and was built from a library of the current size
+
+        Returns
+        -------
+        SpectrumLibraryTable
+            The table, or None if the file does not exist or is stale
+        """
+
+        if not os.path.exists(filename):
+            return(None)
+        if library_filename is not None:
+            mtime = os.path.getmtime(filename)
+            index_filename = library_filename + '.splindex'
+            if mtime < os.path.getmtime(library_filename) or ( os.path.exists(index_filename) and mtime < os.path.getmtime(index_filename) ):
+                if debug: eprint(f"INFO: Table {filename} is older than the library or its index and is ignored")
+                return(None)
+
+        with np.load(filename, allow_pickle=False) as arrays:
+            if library_filename is not None and ( 'library_size' not in arrays or int(arrays['library_size']) != os.path.getsize(library_filename) ):
+                if debug: eprint(f"INFO: Table {filename} does not match the library and is ignored")
+                return(None)
+            columns = {}
+            string_columns = {}
+            for column_name, column_type in table_columns.items():
+                if 'column_' + column_name not in arrays:
+                    continue
+                if column_type is not str:
+                    columns[column_name] = arrays['column_' + column_name]
+                elif 'column_' + column_name + '_offsets' in arrays:
+                    string_columns[column_name] = ( arrays['column_' + column_name], arrays['column_' + column_name + '_offsets'] )
+                else:
+                    if debug: eprint(f"INFO: Table {filename} was written in an older format and is ignored")
+                    return(None)
+            return(SpectrumLibraryTable(columns=columns, mzs=arrays['mzs'], intensities=arrays['intensities'],
+                peak_offsets=arrays['peak_offsets'], string_columns=string_columns))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../lib")
+import SpectrumLibrary as SpectrumLibraryModule
+import SpectrumLibraryIndex as SpectrumLibraryIndexModule
+import LibrarySpectrum as LibrarySpectrumModule
+
+
+#### Keep the test output readable
+SpectrumLibraryModule.debug = False
+SpectrumLibraryIndexModule.debug = False
+LibrarySpectrumModule.debug = False
+
+
+#### Write a synthetic MSP library that uses the simple keys, the options and all the specially converted attributes
+def write_msp_library(filename, n_spectra, seed=1, mode='w'):
+    random.seed(seed)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    energies = [ "HCD=30.0eV", "HCD=28%", "Collision_energy=35", "Inst=hcd" ]
+    peptide_types = [ "Pep=Tryptic", "Pep=N-Semitryptic", "Pep=Tryptic/miss_good_confirmed", "Pep=Tryptic/miss_bad_confirmed" ]
+    organisms = [ 'Organism="human"', "Organism=zebrafish", "Organism=chicken" ]
+    with open(filename, mode) as outfile:
+        for i_spectrum in range(n_spectra):
+            peptide = "".join(random.choice(residues) for i in range(random.randint(6,20))) + "K"
+            charge = random.randint(1,4)
+            precursor_mz = 300 + random.random() * 1500
+            n_peaks = random.randint(1,40)
+            items = [ random.choice( [ "Spec=Consensus", "Single" ] ), random.choice(peptide_types),
+                f"Fullname=R.{peptide}.A/{charge}", f"Mods={random.choice( [ '0', '1(2,C,Carbamidomethyl)' ] )}",
+                f"Parent={precursor_mz:.4f}", random.choice( [ "Inst=it", "Inst=QExactive" ] ), random.choice(energies),
+                random.choice( [ "Mz_diff=0.5ppm", "Mz_diff=-0.012", "Dev_ppm=1.5" ] ), f"Mz_exact={precursor_mz:.4f}",
+                f'Protein="sp|P{i_spectrum:06d}|PROT_HUMAN some protein"', random.choice(organisms),
+                random.choice( [ "Nreps=2/3", "Nreps=4", "Nrep=1/5" ] ), f"RT={random.choice( [ '45.2', '600.5' ] )}",
+                random.choice( [ "ms2IsolationWidth=2.0", "Purity=0.9" ] ), "Dotfull=0.8", "Unsure" ]
+            lines = [ f"Name: {peptide}/{charge}\n", f"MW: {precursor_mz*charge:.4f}\n", "Comment: " + " ".join(items) + "\n",
+                f"Num peaks: {n_peaks}\n" ]
+            for mz in sorted(random.uniform(100, 2000) for i in range(n_peaks)):
+                lines.append(f'{mz:.4f}\t{random.uniform(1,10000):.1f}\t"b{random.randint(1,9)}/0.{random.randint(0,9)}"\n')
+            lines.append("\n")
+            outfile.writelines(lines)
+
+
+#### A small synthetic library in a fresh directory
+@pytest.fixture
+def library_file(tmp_path):
+    filename = str(tmp_path / "library.msp")
+    write_msp_library(filename, 60)
+    return(filename)
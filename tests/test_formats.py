@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+import os
+import json
+import collections
+
+import numpy as np
+import pytest
+
+from SpectrumLibrary import SpectrumLibrary
+from LibrarySpectrum import LibrarySpectrum, parse_comment, attribute_keys
+from SpectrumLibraryBinary import BinarySpectrumLibrary, write_binary_library
+from SpectrumLibraryTable import SpectrumLibraryTable
+
+
+#### Return the attributes of a spectrum as a multiset, with each group as one item, since group identifiers and order may differ
+def get_attribute_multiset(spectrum):
+    attributes = []
+    groups = collections.defaultdict(list)
+    for attribute in spectrum.attributes:
+        if attribute[0] == 'ERROR':
+            continue
+        if len(attribute) == 3:
+            groups[attribute[2]].append( (attribute[0], str(attribute[1])) )
+        else:
+            attributes.append( (attribute[0], str(attribute[1])) )
+    attributes.extend(tuple(sorted(group)) for group in groups.values())
+    return(collections.Counter(attributes))
+
+
+#### Check that two spectra have the same peaks and interpretations
+def assert_same_peaks(spectrum, other_spectrum):
+    assert np.allclose(spectrum.mzs, other_spectrum.mzs)
+    assert np.allclose(spectrum.intensities, other_spectrum.intensities)
+    assert spectrum.get_interpretations() == other_spectrum.get_interpretations()
+
+
+#### Read and parse all spectra of an MSP library
+def read_spectra(filename):
+    spectrum_library = SpectrumLibrary(filename=filename)
+    spectrum_library.create_index()
+    return(spectrum_library, [ spectrum for number, spectrum in spectrum_library.iter_spectra() ])
+
+
+def test_binary_round_trip(library_file, tmp_path):
+    spectrum_library, spectra = read_spectra(library_file)
+    binary_file = str(tmp_path / "library.splbin")
+    assert spectrum_library.write(binary_file, format='binary') == len(spectra)
+
+    binary_library = BinarySpectrumLibrary(binary_file)
+    assert len(binary_library) == len(spectra)
+    for number, spectrum in enumerate(spectra):
+        binary_spectrum = binary_library.get_spectrum(number)
+        assert binary_spectrum.attributes == spectrum.attributes
+        assert_same_peaks(binary_spectrum, spectrum)
+        assert binary_spectrum.write(format='text') == spectrum.write(format='text')
+    binary_library.close()
+
+
+def test_lazy_parsing_equals_eager_parsing(library_file):
+    spectrum_library, spectra = read_spectra(library_file)
+    for number, lines in spectrum_library.iter_spectra(parse=False):
+        lazy_spectrum = LibrarySpectrum()
+        lazy_spectrum.parse(lines, spectrum_index=number, lazy=True)
+        assert lazy_spectrum.attributes == spectra[number].attributes
+        assert_same_peaks(lazy_spectrum, spectra[number])
+
+    #### A lazily parsed spectrum writes the same output whichever access converts its attributes
+    lazy_spectra = [ spectrum for number, spectrum in spectrum_library.iter_spectra(lazy_attributes=True) ]
+    assert [ spectrum.write(format='json') for spectrum in lazy_spectra ] == [ spectrum.write(format='json') for spectrum in spectra ]
+
+
+@pytest.mark.parametrize("workers", [ None, 2 ])
+def test_json_output_is_an_array(library_file, tmp_path, workers):
+    spectrum_library, spectra = read_spectra(library_file)
+    expected = [ spectrum.get_json_object() for spectrum in spectra ]
+
+    json_file = str(tmp_path / "library.json")
+    assert spectrum_library.write(json_file, format='json') == len(spectra)
+    with open(json_file) as infile:
+        assert json.load(infile) == expected
+
+    converted_file = str(tmp_path / "converted.json")
+    assert spectrum_library.convert(converted_file, format='json', workers=workers, batch_size=7) == len(spectra)
+    with open(converted_file) as infile:
+        assert json.load(infile) == expected
+
+
+def test_jsonl_output_has_one_object_per_line(library_file, tmp_path):
+    spectrum_library, spectra = read_spectra(library_file)
+    jsonl_file = str(tmp_path / "library.jsonl")
+    spectrum_library.write(jsonl_file, format='jsonl')
+    with open(jsonl_file) as infile:
+        lines = infile.read().splitlines()
+    assert [ json.loads(line) for line in lines ] == [ spectrum.get_json_object() for spectrum in spectra ]
+
+
+def test_msp_round_trip(library_file, tmp_path):
+    spectrum_library, spectra = read_spectra(library_file)
+    msp_file = str(tmp_path / "written.msp")
+    spectrum_library.write(msp_file, format='msp')
+
+    written_library, written_spectra = read_spectra(msp_file)
+    assert len(written_spectra) == len(spectra)
+    for spectrum, written_spectrum in zip(spectra, written_spectra):
+        assert get_attribute_multiset(written_spectrum) == get_attribute_multiset(spectrum)
+        assert_same_peaks(written_spectrum, spectrum)
+
+    #### Writing the written library again gives the same file
+    rewritten_file = str(tmp_path / "rewritten.msp")
+    written_library.write(rewritten_file, format='msp')
+    with open(msp_file) as infile, open(rewritten_file) as rewritten_infile:
+        assert rewritten_infile.read() == infile.read()
+
+
+def test_converting_twice_changes_nothing(library_file):
+    spectrum_library, spectra = read_spectra(library_file)
+    for lazy in [ False, True ]:
+        spectrum = LibrarySpectrum()
+        spectrum.parse(spectrum_library.get_spectrum(spectrum_index_number=3), spectrum_index=3, lazy=lazy)
+        spectrum.convert_foreign_attributes()
+        spectrum.convert_foreign_attributes()
+        assert spectrum.attributes == spectra[3].attributes
+
+
+def test_table_select_and_subset(library_file):
+    spectrum_library, spectra = read_spectra(library_file)
+    table = spectrum_library.create_table()
+    assert len(table) == len(spectra)
+    names = [ name for offset, length, name in spectrum_library.scan_entries() ]
+    assert list(table.name) == names
+    for row in [ 0, 17, 59 ]:
+        assert table.get_string('name', row) == names[row]
+        mzs, intensities = table.get_peaks(row)
+        assert np.allclose(mzs, spectra[row].mzs)
+
+    peptide_sequence = table.get_string('peptide_sequence', 17)
+    selected = table.select(charge=int(table.charge[17]), min_precursor_mz=table.precursor_mz[17] - 1, peptide_sequence=peptide_sequence)
+    assert list(selected.number) == [ 17 ]
+    assert selected.get_string('mods', 0) == table.get_string('mods', 17)
+    assert np.allclose(selected.get_peaks(0)[0], spectra[17].mzs)
+
+    rows = np.array( [ 40, 3, 3, 12 ] )
+    subset = table.subset(rows)
+    assert list(subset.number) == list(rows)
+    assert list(subset.peptide_sequence) == [ table.get_string('peptide_sequence', row) for row in rows ]
+    for subset_row, row in enumerate(rows):
+        assert np.allclose(subset.get_peaks(subset_row)[1], table.get_peaks(row)[1])
+
+
+def test_stale_table_is_not_loaded(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    table = spectrum_library.create_table()
+    table_file = library_file + '.sptable.npz'
+    loaded_table = spectrum_library.load_table(create=False)
+    assert list(loaded_table.name) == list(table.name)
+    assert np.array_equal(loaded_table.mzs, table.mzs)
+
+    #### A library rewritten with the same size must not be served the table of the old contents
+    with open(library_file) as infile:
+        contents = infile.read()
+    with open(library_file, 'w') as outfile:
+        outfile.write(contents.replace("/", "|", 1))
+    mtime = os.path.getmtime(table_file)
+    os.utime(library_file, (mtime + 10, mtime + 10))
+    assert SpectrumLibraryTable.load(table_file, library_filename=library_file) is None
+    assert spectrum_library.load_table(create=True).get_string('name', 0) == table.get_string('name', 0).replace("/", "|", 1)
+
+    #### An index rebuilt after the table was saved also makes it stale
+    spectrum_library.create_index()
+    os.utime(library_file + '.splindex', (os.path.getmtime(table_file) + 10, os.path.getmtime(table_file) + 10))
+    assert SpectrumLibraryTable.load(table_file, library_filename=library_file) is None
+
+
+def test_iter_spectra_filters(library_file):
+    spectrum_library, spectra = read_spectra(library_file)
+    charges = [ spectrum.get_charge() for spectrum in spectra ]
+    precursor_mzs = [ spectrum.get_precursor_mz() for spectrum in spectra ]
+
+    def get_numbers(**filters):
+        return( [ number for number, spectrum in spectrum_library.iter_spectra(**filters) ] )
+
+    assert get_numbers(charge=2) == [ number for number in range(60) if charges[number] == 2 ]
+    assert get_numbers(min_precursor_mz=800, max_precursor_mz=1200) == [ number for number in range(60)
+        if 800 <= precursor_mzs[number] <= 1200 ]
+    assert get_numbers(start=10, stop=25) == list(range(10, 25))
+    assert get_numbers(start=10, stop=25, charge=3, min_precursor_mz=600) == [ number for number in range(10, 25)
+        if charges[number] == 3 and precursor_mzs[number] >= 600 ]
+    assert get_numbers(filter_function=lambda spectrum: len(spectrum.mzs) > 20) == [ number for number in range(60)
+        if len(spectra[number].mzs) > 20 ]
+    assert get_numbers(start=55, parse=False, filter_function=lambda lines: lines[0].endswith("/2")) == [ number
+        for number in range(55, 60) if charges[number] == 2 ]
+
+    for number, lines in spectrum_library.iter_spectra(start=58, parse=False):
+        assert lines == spectrum_library.get_spectrum(spectrum_index_number=number)
+
+
+#### Entries that use each specially converted attribute, with the attributes that the original line-by-line conversion gave them
+converted_entries = [
+    ( [ "Name: AAGCK/2", "MW: 1000.5", 'Comment: Spec=Consensus Pep=Tryptic/miss_good_confirmed Fullname=R.AAGCK.A/2 ' +
+        'Mods=1(3,C,Carbamidomethyl) Parent=500.2500 Inst=it HCD=30.0eV Mz_diff=0.5ppm Mz_exact=500.2500 ' +
+        'Protein="sp|P01|X some protein" Organism="human" Nreps=2/3 RT=45.2 ms2IsolationWidth=2.0 Dotfull=0.8 Unsure',
+        "Num peaks: 2", '100.5\t10.0\t"b1/0.1"', '200.5\t20.0\t"y2/0.2"' ], [
+        ['MS:1008014|spectrum index', 7],
+        ['MS:1008013|spectrum name', 'AAGCK/2'],
+        ['MS:1008010|molecular mass', '1000.5'],
+        ['MS:1008015|spectrum aggregation type', 'MS:1008017|consensus spectrum'],
+        ['MS:1008030|number of enzymatic termini', 2, '1'],
+        ['MS:1008034|number of missed cleavages', '0', '1'],
+        ['MS:1001045|cleavage agent name', 'MS:1001251|Trypsin', '1'],
+        ['MS:1000888|unmodified peptide sequence', 'AAGCK'],
+        ['MS:1001112|n-terminal flanking residue', 'R'],
+        ['MS:1001113|c-terminal flanking residue', 'A'],
+        ['MS:1000041|charge state', '2'],
+        ['MS:1001471|peptide modification details', '1(3,C,Carbamidomethyl)'],
+        ['MS:1000744|selected ion m/z', '500.2500'],
+        ['MS:1000044|dissociation method', 'MS:1002472|trap-type collision-induced dissociation'],
+        ['MS:1000044|dissociation method', 'MS:1000422|beam-type collision-induced dissociation'],
+        ['MS:1000045|collision energy', '30.0', '2'],
+        ['UO:0000000|unit', 'UO:0000266|electronvolt', '2'],
+        ['MS:1001975|delta m/z', '0.5', '3'],
+        ['UO:0000000|unit', 'UO:0000169|parts per million', '3'],
+        ['MS:1008032|theoretical monoisotopic m/z', '500.2500'],
+        ['MS:1000885|protein accession', '"sp|P01|X some protein"'],
+        ['MS:1001467|taxonomy: NCBI TaxID', 'NCBITaxon:9606|Homo sapiens', '4'],
+        ['MS:1001469|taxonomy: scientific name', 'Homo sapiens', '4'],
+        ['MS:1001468|taxonomy: common name', 'human', '4'],
+        ['MS:1009020|number of replicate spectra used', '2'],
+        ['MS:1009021|number of replicate spectra available', '3'],
+        ['MS:1000894|retention time', '45.2', '5'],
+        ['UO:0000000|unit', 'UO:0000031|minute', '5'],
+        ['MS:1000828|isolation window lower offset', '1.0', '6'],
+        ['UO:0000000|unit', 'MS:1000040|m/z', '6'],
+        ['MS:1000829|isolation window upper offset', '1.0', '7'],
+        ['UO:0000000|unit', 'MS:1000040|m/z', '7'],
+        ['MS:1008040|number of peaks', '2'],
+        ['MS:1009900|other attribute name', 'Dotfull', '8'],
+        ['MS:1009902|other attribute value', '0.8', '8'],
+        ['MS:1009900|other attribute name', 'Unsure'] ] ),
+    ( [ "Name: PEPTIDEK/3", 'Comment: Single Pep=N-Semitryptic Fullname=-.PEPTIDEK.-/3 Mods=0 Parent=310.1500 Inst=QExactive ' +
+        'HCD=28% Collision_energy=35 Mz_diff=-0.012 Dev_ppm=1.5 Organism=zebrafish Nrep=1/5 RT=600.5 Purity=0.9',
+        "Num peaks: 1", '100.5\t10.0' ], [
+        ['MS:1008014|spectrum index', 7],
+        ['MS:1008013|spectrum name', 'PEPTIDEK/3'],
+        ['MS:1008015|spectrum aggregation type', 'MS:1008016|singleton spectrum'],
+        ['MS:1008030|number of enzymatic termini', 1, '1'],
+        ['MS:1001045|cleavage agent name', 'MS:1001251|Trypsin', '1'],
+        ['MS:1000888|unmodified peptide sequence', 'PEPTIDEK'],
+        ['MS:1001112|n-terminal flanking residue', '-'],
+        ['MS:1001113|c-terminal flanking residue', '-'],
+        ['MS:1000041|charge state', '3'],
+        ['MS:1001471|peptide modification details', '0'],
+        ['MS:1000744|selected ion m/z', '310.1500'],
+        ['MS:1000031|instrument model', 'MS:1001911|Q Exactive'],
+        ['MS:1000044|dissociation method', 'MS:1000422|beam-type collision-induced dissociation'],
+        ['MS:1000045|collision energy', '28', '2'],
+        ['UO:0000000|unit', 'UO:0000187|percent', '2'],
+        ['MS:1000045|collision energy', '35', '3'],
+        ['UO:0000000|unit', 'UO:0000266|electronvolt', '3'],
+        ['MS:1001975|delta m/z', '-0.012', '4'],
+        ['UO:0000000|unit', 'MS:1000040|m/z', '4'],
+        ['MS:1001975|delta m/z', '1.5', '5'],
+        ['UO:0000000|unit', 'UO:0000169|parts per million', '5'],
+        ['MS:1001467|taxonomy: NCBI TaxID', 'NCBITaxon:7955|Danio rerio', '6'],
+        ['MS:1001469|taxonomy: scientific name', 'Danio rerio', '6'],
+        ['MS:1001468|taxonomy: common name', 'zebra fish', '6'],
+        ['MS:1009020|number of replicate spectra used', '1'],
+        ['MS:1009021|number of replicate spectra available', '5'],
+        ['MS:1000894|retention time', '600.5', '7'],
+        ['UO:0000000|unit', 'UO:0000010|second', '7'],
+        ['MS:1009013|isolation window precursor purity', '0.9'],
+        ['MS:1008040|number of peaks', '1'] ] ),
+]
+
+
+@pytest.mark.parametrize("lines,expected_attributes", converted_entries)
+def test_conversion_rules_give_the_original_attributes(lines, expected_attributes):
+    for lazy in [ False, True ]:
+        spectrum = LibrarySpectrum()
+        spectrum.parse(list(lines), spectrum_index=7, lazy=lazy)
+        assert spectrum.attributes == expected_attributes
+
+
+@pytest.mark.parametrize("comment,expected_items", [
+    ( 'Single Protein="sp|P01|X some protein" Organism="human" Nreps=2/3',
+        { 'Single': None, 'Protein': '"sp|P01|X some protein"', 'Organism': '"human"', 'Nreps': '2/3' } ),
+    ( 'Note="a=b  c" Mods=1(0,A,x=y)  Unsure', { 'Note': '"a=b  c"', 'Mods': '1(0,A,x=y)', 'Unsure': None } ),
+    ( 'Pep=Tryptic Protein="never closed X=1', { 'Pep': 'Tryptic', 'Protein': '"never closed X=1' } ),
+    ( '', {} ),
+])
+def test_parse_comment(comment, expected_items):
+    assert parse_comment(comment) == expected_items
+    foreign_attributes = { 'Name': 'AAGCK/2' }
+    assert parse_comment(comment, foreign_attributes) is foreign_attributes
+    assert foreign_attributes == dict( { 'Name': 'AAGCK/2' }, **expected_items)
+
+
+def test_attribute_storage(library_file):
+    spectrum_library, spectra = read_spectra(library_file)
+    spectrum = LibrarySpectrum()
+    with pytest.raises(AttributeError):
+        spectrum.unknown_attribute = 1
+    assert not hasattr(spectrum, '__dict__')
+
+    #### Attributes set as a list come back unchanged, with each key stored once as a shared code
+    attributes = [ [ 'MS:1000041|charge state', '2' ], [ 'MS:1000045|collision energy', '30', '2' ],
+        [ 'UO:0000000|unit', 'UO:0000266|electronvolt', '2' ], [ 'MS:1000041|charge state', '3' ], [ 'New key', 4 ] ]
+    spectrum.attributes = attributes
+    assert spectrum.attributes == attributes
+    assert [ attribute_keys[code] for code in spectrum.attribute_codes ] == [ attribute[0] for attribute in attributes ]
+    assert list(spectrum.attribute_codes)[0] == list(spectrum.attribute_codes)[3]
+    assert spectrum.attribute_dict['MS:1000041|charge state'] == { 'indexes': [ 0, 3 ], 'groups': [] }
+    assert spectrum.attribute_dict['UO:0000000|unit'] == { 'indexes': [ 2 ], 'groups': [ '2' ] }
+    assert spectrum.group_dict == { '2': [ 1, 2 ] }
+    assert spectrum.get_attribute_values('MS:1000041|charge state') == [ '2', '3' ]
+    assert spectrum.get_attribute_values('Never used key') == []
+    assert spectrum.get_charge() == 2
+
+    #### Spectra parsed from a library share the codes of the keys they have in common
+    name_codes = set(other_spectrum.attribute_codes[1] for other_spectrum in spectra)
+    assert len(name_codes) == 1
+    assert attribute_keys[name_codes.pop()] == 'MS:1008013|spectrum name'
+    spectrum.clear_attributes()
+    assert spectrum.attributes == []
+    assert spectrum.get_next_group_identifier() == '1'
+
+
+def test_binary_peaks_and_iteration(library_file, tmp_path):
+    spectrum_library, spectra = read_spectra(library_file)
+    binary_file = str(tmp_path / "charge2.splbin")
+    selected = [ (number, spectrum) for number, spectrum in enumerate(spectra) if spectrum.get_charge() == 2 ]
+    assert write_binary_library(binary_file, iter(selected)) == len(selected)
+
+    binary_library = BinarySpectrumLibrary(binary_file)
+    assert len(binary_library) == len(selected)
+    assert [ int(number) for number in binary_library.records['number'] ] == [ number for number, spectrum in selected ]
+    for position, (number, spectrum) in enumerate(selected):
+        mzs, intensities = binary_library.get_peaks(position)
+        assert np.array_equal(mzs, spectrum.mzs)
+        assert np.array_equal(intensities, spectrum.intensities)
+        assert not mzs.flags.writeable
+        assert binary_library.records['charge'][position] == 2
+        assert binary_library.records['precursor_mz'][position] == pytest.approx(spectrum.get_precursor_mz())
+
+    iterated = list(binary_library.iter_spectra(start=1, stop=4))
+    assert [ number for number, spectrum in iterated ] == [ number for number, spectrum in selected[1:4] ]
+    for (binary_number, binary_spectrum), (number, spectrum) in zip(iterated, selected[1:4]):
+        assert binary_spectrum.attributes == spectrum.attributes
+    assert len(list(binary_library.iter_spectra(start=2, stop=100000))) == len(selected) - 2
+    binary_library.close()
+
+    with pytest.raises(ValueError, match="not a binary spectrum library"):
+        BinarySpectrumLibrary(library_file)
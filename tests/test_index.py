@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+import os
+import shutil
+
+import numpy as np
+import pytest
+import sqlalchemy
+
+import SpectrumLibrary as SpectrumLibraryModule
+import SpectrumLibraryIndex as SpectrumLibraryIndexModule
+from SpectrumLibrary import SpectrumLibrary
+from SpectrumLibraryIndex import SpectrumLibraryIndex
+from SpectrumLibraryCache import SpectrumLibraryCache
+from conftest import write_msp_library
+
+
+#### Return all records of the index of a library in number order
+def get_index_records(spectrum_library):
+    return(spectrum_library.index.session.execute(sqlalchemy.text("SELECT number, offset, length, name, peptide_sequence, " +
+        "charge, precursor_mz, n_peaks, mods FROM spectrum_library_index_record ORDER BY number")).fetchall())
+
+
+#### Scan in several processes even for a small library on a machine with one CPU
+def force_parallel_scan(monkeypatch):
+    monkeypatch.setattr(SpectrumLibraryModule, 'parallel_scan_min_size', 0)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+
+
+def test_parallel_scan_equals_serial_scan(library_file, monkeypatch):
+    force_parallel_scan(monkeypatch)
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    for parse_headers in [ False, True ]:
+        entries = list(spectrum_library.scan_entries(parse_headers=parse_headers))
+        assert len(entries) == 60
+        assert list(spectrum_library.scan_entries_parallel(workers=3, parse_headers=parse_headers)) == entries
+        start = entries[25][0]
+        assert list(spectrum_library.scan_entries_parallel(workers=3, parse_headers=parse_headers, start=start)) == entries[25:]
+
+
+def test_parallel_index_equals_serial_index(library_file, tmp_path, monkeypatch):
+    force_parallel_scan(monkeypatch)
+    parallel_file = str(tmp_path / "parallel.msp")
+    shutil.copy(library_file, parallel_file)
+
+    serial_library = SpectrumLibrary(filename=library_file)
+    assert serial_library.create_index() == 60
+    parallel_library = SpectrumLibrary(filename=parallel_file)
+    assert parallel_library.create_index(workers=3) == 60
+    assert get_index_records(parallel_library) == get_index_records(serial_library)
+
+
+def test_appended_update_equals_rebuild(library_file, tmp_path):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    write_msp_library(library_file, 25, seed=2, mode='a')
+    assert spectrum_library.index.check_library_state() == 'appended'
+    assert spectrum_library.update_index() == 85
+    assert spectrum_library.index.check_library_state() == 'current'
+
+    rebuilt_file = str(tmp_path / "rebuilt.msp")
+    shutil.copy(library_file, rebuilt_file)
+    rebuilt_library = SpectrumLibrary(filename=rebuilt_file)
+    assert rebuilt_library.create_index() == 85
+    assert get_index_records(spectrum_library) == get_index_records(rebuilt_library)
+    assert spectrum_library.index.n_spectra == rebuilt_library.index.n_spectra == 85
+
+
+def test_stale_index_is_updated_before_reading(library_file, monkeypatch):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    first_name = spectrum_library.get_spectrum(spectrum_index_number=0)[0]
+    write_msp_library(library_file, 10, seed=3)
+    assert spectrum_library.get_spectrum(spectrum_index_number=0)[0] != first_name
+    assert spectrum_library.index.n_spectra == 10
+
+    monkeypatch.setattr(SpectrumLibraryModule, 'update_stale_index', False)
+    write_msp_library(library_file, 5, seed=4, mode='a')
+    with pytest.raises(Exception, match="out of date"):
+        spectrum_library.get_spectra( [ 0 ] )
+
+
+def test_bulk_load_equals_record_by_record_load(library_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(SpectrumLibraryIndexModule, 'bulk_insert_batch_size', 7)
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    assert spectrum_library.create_index() == 60
+    assert spectrum_library.index.bulk_mode is False
+    assert spectrum_library.index.check_library_state() == 'current'
+
+    #### Add the same entries one at a time through the ORM session to a copy of the library
+    other_file = str(tmp_path / "other.msp")
+    shutil.copy(library_file, other_file)
+    other_library = SpectrumLibrary(filename=other_file)
+    other_library.index.create_index()
+    for number, (offset, length, name, metadata) in enumerate(other_library.scan_entries(parse_headers=True)):
+        other_library.index.add_spectrum(number=number, offset=offset, name=name, length=length, **metadata)
+    other_library.index.commit()
+    assert get_index_records(other_library) == get_index_records(spectrum_library)
+
+    #### Re-creating the index in bulk mode replaces the previous records rather than adding to them
+    assert spectrum_library.create_index() == 60
+    assert get_index_records(other_library) == get_index_records(spectrum_library)
+    assert SpectrumLibraryIndex(library_filename=library_file).n_spectra == 60
+
+
+#### Return the offset and name of each entry by reading the library line by line
+def get_entries_by_line(filename):
+    entries = []
+    offset = 0
+    with open(filename, 'rb') as infile:
+        for line in infile:
+            if line.startswith(b'Name: '):
+                entries.append( (offset, line[6:].decode('utf-8').strip()) )
+            offset += len(line)
+    return(entries, offset)
+
+
+@pytest.mark.parametrize("line_ending", [ b"\n", b"\r\n" ])
+def test_scan_entries_finds_every_entry(library_file, tmp_path, line_ending):
+    scanned_file = str(tmp_path / "scanned.msp")
+    with open(library_file, 'rb') as infile:
+        contents = infile.read()
+    #### A Name: that does not begin a line is not an entry
+    contents = contents.replace(b"Unsure", b"Unsure Name: x", 1)
+    with open(scanned_file, 'wb') as outfile:
+        outfile.write(b"\n" + contents.replace(b"\n", line_ending))
+
+    expected_entries, file_size = get_entries_by_line(scanned_file)
+    spectrum_library = SpectrumLibrary(filename=scanned_file)
+    entries = list(spectrum_library.scan_entries())
+    assert [ (offset, name) for offset, length, name in entries ] == expected_entries
+    assert [ offset + length for offset, length, name in entries ] == [ offset for offset, name in expected_entries[1:] ] + [ file_size ]
+    assert list(spectrum_library.scan_entries(start=entries[30][0], end=entries[40][0])) == entries[30:40]
+    assert spectrum_library.read() == 60
+
+
+def test_read_spectrum_from_the_memory_map(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    with open(library_file) as infile:
+        entries = [ [ line.rstrip() for line in entry.splitlines() if line.strip() ] for entry in infile.read().split("\n\n") if entry.strip() ]
+    assert len(entries) == 60
+
+    buffer = spectrum_library.get_buffer()
+    for number in [ 0, 1, 30, 59 ]:
+        offset, length = spectrum_library.index.get_location(spectrum_index_number=number)
+        assert spectrum_library.read_spectrum(offset=offset, length=length) == entries[number]
+        #### Without the length, the end of the entry is found by searching for the next one
+        assert spectrum_library.read_spectrum(offset=offset) == entries[number]
+        assert spectrum_library.get_spectrum(spectrum_index_number=number) == entries[number]
+    assert spectrum_library.get_buffer() is buffer
+
+    spectrum_library.close()
+    assert buffer.closed
+    assert SpectrumLibrary(filename=library_file).get_spectrum(spectrum_index_number=59) == entries[59]
+
+
+def test_index_records_hold_the_entry_metadata(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    records = get_index_records(spectrum_library)
+    assert len(records) == 60
+    for record, (number, spectrum) in zip(records, spectrum_library.iter_spectra()):
+        assert record.number == number
+        lines = spectrum_library.read_spectrum(offset=record.offset, length=record.length)
+        assert lines[0] == "Name: " + record.name
+        comment = dict(item.split("=", 1) for item in lines[2][len("Comment: "):].split() if "=" in item)
+        assert record.peptide_sequence == comment['Fullname'].split(".")[1]
+        assert record.mods == comment['Mods']
+        assert record.charge == spectrum.get_charge() == int(record.name.split("/")[1])
+        assert record.precursor_mz == pytest.approx(spectrum.get_precursor_mz())
+        assert record.n_peaks == len(spectrum.mzs)
+
+
+@pytest.mark.parametrize("tolerance,tolerance_units", [ (20, 'ppm'), (50, 'Da') ])
+def test_find_offsets_matches_a_linear_scan(library_file, tolerance, tolerance_units):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    records = get_index_records(spectrum_library)
+    precursor_mzs = [ record.precursor_mz for record in records[0:60:5] ] + [ 100.0, 1000.0 ]
+    charges = [ None, 2, 3 ] * 4 + [ None, 1 ]
+
+    batch_results = spectrum_library.index.find_offsets_batch(precursor_mzs, tolerance=tolerance, tolerance_units=tolerance_units, charges=charges)
+    for precursor_mz, charge, batch_numbers in zip(precursor_mzs, charges, batch_results):
+        delta = tolerance if tolerance_units == 'Da' else precursor_mz * tolerance / 1e6
+        expected = sorted( (record.precursor_mz, record.number, record.offset, record.length) for record in records
+            if abs(record.precursor_mz - precursor_mz) <= delta and ( charge is None or record.charge == charge ) )
+        found = spectrum_library.index.find_offsets(precursor_mz=precursor_mz, tolerance=tolerance, tolerance_units=tolerance_units, charge=charge)
+        assert found == [ (number, offset, length) for precursor, number, offset, length in expected ]
+        assert list(batch_numbers) == [ number for number, offset, length in found ]
+        assert [ number for number, lines in spectrum_library.find_spectra(precursor_mz=precursor_mz, tolerance=tolerance,
+            tolerance_units=tolerance_units, charge=charge) ] == list(batch_numbers)
+
+    peptide_sequence = records[7].peptide_sequence
+    assert [ number for number, offset, length in spectrum_library.index.find_offsets(peptide_sequence=peptide_sequence) ] == [ 7 ]
+    with pytest.raises(ValueError):
+        spectrum_library.index.find_offsets()
+
+
+def test_lookup_by_name_and_peptide_sequence(library_file):
+    #### Append the first five entries again, so that their names and sequences occur twice
+    write_msp_library(library_file, 5, seed=1, mode='a')
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    assert spectrum_library.create_index() == 65
+    records = get_index_records(spectrum_library)
+    index = spectrum_library.index
+
+    for record in records[0:60:6] + records[62:63]:
+        first_record = [ other for other in records if other.name == record.name ][0]
+        assert index.get_offset(spectrum_name=record.name) == first_record.offset
+        assert index.get_location(peptide_sequence=record.peptide_sequence) == (first_record.offset, first_record.length)
+        assert spectrum_library.get_spectrum(spectrum_name=record.name)[0] == "Name: " + record.name
+    assert index.get_location(spectrum_name="NOSUCHPEPTIDE/2") == (None, None)
+
+    names = [ records[3].name, "NOSUCHPEPTIDE/2", records[40].name, records[3].name ]
+    assert index.get_offsets(spectrum_names=names) == [ records[3].offset, None, records[40].offset, records[3].offset ]
+    assert index.get_offsets(spectrum_index_numbers=[ 64, 3, 1000 ]) == [ records[64].offset, records[3].offset, None ]
+
+
+def test_offset_table_sidecar(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    records = get_index_records(spectrum_library)
+    table_file = library_file + '.splindex.offsets.npy'
+    assert not os.path.exists(table_file)
+
+    offset_table = spectrum_library.index.load_offset_table()
+    assert os.path.exists(table_file)
+    assert [ tuple(row) for row in offset_table ] == [ (record.offset, record.length) for record in records ]
+
+    #### A new index object memory-maps the sidecar and answers lookups by number from it
+    index = SpectrumLibraryIndex(library_filename=library_file, load_offset_table=True)
+    assert isinstance(index.offset_table, np.memmap)
+    assert index.get_location(spectrum_index_number=42) == (records[42].offset, records[42].length)
+    assert index.get_location(spectrum_index_number=60) == (None, None)
+    assert index.get_locations(spectrum_index_numbers=[ 5, -1, 59 ]) == [ (records[5].offset, records[5].length), (None, None),
+        (records[59].offset, records[59].length) ]
+    index.disconnect()
+
+    #### The sidecar is rebuilt once the index is newer than it
+    write_msp_library(library_file, 10, seed=2, mode='a')
+    spectrum_library.update_index()
+    offset_table = spectrum_library.index.load_offset_table()
+    assert [ tuple(row) for row in offset_table ] == [ (record.offset, record.length) for record in get_index_records(spectrum_library) ]
+    assert len(offset_table) == 70
+
+
+def test_spectrum_cache_hits_misses_and_evictions(library_file):
+    cache = SpectrumLibraryCache(max_entries=3, max_bytes=1000, state_check_interval=0)
+    for number in range(3):
+        assert cache.put(library_file, number, f"spectrum {number}", size=100)
+    assert cache.get(library_file, 0) == "spectrum 0"
+    assert cache.get(library_file, 5) is None
+
+    #### Spectrum 1 is now the least recently used, so it goes first
+    cache.put(library_file, 3, "spectrum 3", size=100)
+    assert cache.get(library_file, 1) is None
+    assert [ cache.get(library_file, number) for number in [ 0, 2, 3 ] ] == [ "spectrum 0", "spectrum 2", "spectrum 3" ]
+    #### A large spectrum evicts enough others to stay within max_bytes, and one larger than the cache is not added
+    cache.put(library_file, 4, "spectrum 4", size=850)
+    assert len(cache) == 2 and cache.n_bytes == 950
+    assert not cache.put(library_file, 5, "spectrum 5", size=1001)
+    assert cache.get_statistics() == { 'n_entries': 2, 'n_bytes': 950, 'hits': 4, 'misses': 2, 'hit_rate': 4 / 6, 'evictions': 3,
+        'invalidations': 0 }
+
+    #### Changing the library file drops its cached spectra
+    write_msp_library(library_file, 10, seed=3)
+    assert cache.get(library_file, 4) is None
+    assert len(cache) == 0 and cache.invalidations == 2
+
+
+def test_get_spectrum_uses_the_cache(library_file, monkeypatch):
+    monkeypatch.setattr(SpectrumLibraryModule, 'spectrum_cache', SpectrumLibraryCache(max_entries=10, state_check_interval=0))
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    cache = spectrum_library.spectrum_cache
+    spectrum = spectrum_library.get_spectrum(spectrum_index_number=7, parse=True)
+    assert spectrum_library.get_spectrum(spectrum_index_number=7, parse=True) is spectrum
+    assert (cache.hits, cache.misses) == (1, 1)
+    #### Lines and lookups by name are not cached
+    spectrum_library.get_spectrum(spectrum_index_number=8)
+    spectrum_library.get_spectrum(spectrum_name=spectrum.get_attribute_values('MS:1008013|spectrum name')[0], parse=True)
+    assert len(cache) == 1
+
+    #### A rewritten library is re-indexed, and the spectra of the old file are not returned
+    write_msp_library(library_file, 10, seed=3)
+    new_spectrum = spectrum_library.get_spectrum(spectrum_index_number=7, parse=True)
+    assert new_spectrum is not spectrum
+    uncached_library = SpectrumLibrary(filename=library_file)
+    uncached_library.spectrum_cache = None
+    assert new_spectrum.attributes == uncached_library.get_spectrum(spectrum_index_number=7, parse=True).attributes
+    assert new_spectrum.attributes != spectrum.attributes
+
+
+@pytest.mark.parametrize("max_read_gap", [ 0, 65536 ])
+def test_get_spectra_equals_get_spectrum(library_file, monkeypatch, max_read_gap):
+    monkeypatch.setattr(SpectrumLibraryModule, 'max_read_gap', max_read_gap)
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    spectrum_library.spectrum_cache = None
+    numbers = [ 42, 3, 4, 5, 59, 3, 0, 17, 42 ]
+    identifiers = numbers + [ 60, -1, None, "x", 2.5, 7.0 ]
+    expected = [ spectrum_library.get_spectrum(spectrum_index_number=number) for number in numbers ] + [ None ] * 5 + \
+        [ spectrum_library.get_spectrum(spectrum_index_number=7) ]
+    assert spectrum_library.get_spectra(identifiers) == expected
+
+    spectra = spectrum_library.get_spectra(identifiers, parse=True)
+    assert [ spectrum is None for spectrum in spectra ] == [ lines is None for lines in expected ]
+    for spectrum, number in zip(spectra, numbers):
+        assert spectrum.attributes == spectrum_library.get_spectrum(spectrum_index_number=number, parse=True).attributes
+    assert spectra[0] is spectra[8]
+
+    spectrum_library.index.load_offset_table()
+    assert spectrum_library.get_spectra(identifiers) == expected
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import collections
+
+import numpy as np
+import pytest
+
+from SpectrumLibrary import SpectrumLibrary
+from SpectrumLibrarySearch import SpectrumLibrarySearch, default_bin_width
+from SpectrumLibraryFragmentIndex import SpectrumLibraryFragmentIndex
+from conftest import write_msp_library
+
+
+#### Return the queries for library spectra by index number, as (mzs, intensities, precursor m/z, charge) tuples
+def get_queries(spectrum_library, numbers):
+    queries = []
+    for spectrum in spectrum_library.get_spectra(numbers, parse=True):
+        queries.append( (spectrum.mzs, spectrum.intensities, spectrum.get_precursor_mz(), spectrum.get_charge()) )
+    return(queries)
+
+
+@pytest.mark.parametrize("method", [ 'candidates', 'matrix' ])
+def test_search_after_append(library_file, method):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    hits = spectrum_library.search_spectra(get_queries(spectrum_library, [ 10 ]), method=method)
+    assert hits[0][0][0] == 10
+
+    write_msp_library(library_file, 60, seed=2, mode='a')
+    hits = spectrum_library.search_spectra(get_queries(spectrum_library, [ 100 ]), method=method)
+    assert hits[0][0][0] == 100
+    assert hits[0][0][1] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_search_open_after_append(library_file, tmp_path):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    queries = [ query[0:2] for query in get_queries(spectrum_library, [ 10 ]) ]
+    assert spectrum_library.search_open(queries, min_shared_peaks=1)[0][0][0] == 10
+
+    #### Take the query from a separate copy of the appended spectra, so that only search_open() sees the change
+    appended_file = str(tmp_path / "appended.msp")
+    write_msp_library(appended_file, 60, seed=2)
+    appended_library = SpectrumLibrary(filename=appended_file)
+    appended_library.create_index()
+    queries = [ query[0:2] for query in get_queries(appended_library, [ 40 ]) ]
+    with open(appended_file) as infile, open(library_file, 'a') as outfile:
+        outfile.write(infile.read())
+    hits = spectrum_library.search_open(queries, min_shared_peaks=1)
+    assert hits[0][0][0] == 100
+    assert hits[0][0][1] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_search_open_uses_its_own_parameters(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    queries = [ query[0:2] for query in get_queries(spectrum_library, range(0, 60, 7)) ]
+    expected = spectrum_library.search_open(queries, min_shared_peaks=1)
+
+    spectrum_library.search_spectra(get_queries(spectrum_library, [ 0 ]), top_k_peaks=3)
+    assert spectrum_library.search_engine.top_k_peaks == 3
+    assert spectrum_library.search_open(queries, min_shared_peaks=1) == expected
+    assert spectrum_library.search_engine.top_k_peaks is None
+
+    spectrum_library.search_open(queries, min_shared_peaks=1, fragment_bin_width=0.1, fragment_top_k_peaks=None)
+    assert spectrum_library.fragment_index.bin_width == 0.1
+    assert spectrum_library.fragment_index.top_k_peaks is None
+
+
+#### Return the hits of each query with a score above zero, since the order of spectra with no shared peaks is arbitrary
+def get_scored_hits(hits):
+    return( [ [ (number, score) for number, score in query_hits if score > 1e-6 ] for query_hits in hits ] )
+
+
+def test_candidates_and_matrix_methods_agree(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    queries = get_queries(spectrum_library, range(60))
+    queries.extend( (mzs, intensities, None, None) for mzs, intensities, precursor_mz, charge in queries[0:60:6] )
+    queries.extend( (mzs, intensities, None, charge) for mzs, intensities, precursor_mz, charge in queries[3:60:6] )
+
+    candidate_hits = get_scored_hits(spectrum_library.search_spectra(queries, tolerance=50, tolerance_units='Da', method='candidates'))
+    matrix_hits = get_scored_hits(spectrum_library.search_spectra(queries, tolerance=50, tolerance_units='Da', method='matrix'))
+    assert sum(len(query_hits) for query_hits in candidate_hits) > len(queries)
+    for query_candidate_hits, query_matrix_hits in zip(candidate_hits, matrix_hits):
+        assert [ number for number, score in query_matrix_hits ] == [ number for number, score in query_candidate_hits ]
+        assert [ score for number, score in query_matrix_hits ] == pytest.approx( [ score for number, score in query_candidate_hits ], abs=1e-5)
+    for number, query_hits in enumerate(candidate_hits[0:60]):
+        assert query_hits[0][0] == number
+
+
+def test_candidates_not_in_the_matrix_are_skipped(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    mzs, intensities, precursor_mz, charge = get_queries(spectrum_library, [ 5 ])[0]
+    search_engine = SpectrumLibrarySearch(spectrum_library=spectrum_library)
+    query_bins, query_weights = search_engine.get_query_vector(mzs, intensities)
+
+    scores = search_engine.score_candidates(query_bins, query_weights, [ 5, 60, -1, 1000 ])
+    assert scores[0] == pytest.approx(1.0, abs=1e-5)
+    assert list(scores[1:]) == [ 0, 0, 0 ]
+    hits = search_engine.search(mzs, intensities, candidates=[ 1000, 5, 60 ])
+    assert [ number for number, score in hits ] == [ 5 ]
+
+
+#### Return the cosine similarity of two spectra binned with the search defaults, computed one peak at a time
+def get_reference_score(mzs, intensities, other_mzs, other_intensities):
+    vectors = []
+    for spectrum_mzs, spectrum_intensities in [ (mzs, intensities), (other_mzs, other_intensities) ]:
+        vector = collections.defaultdict(float)
+        for mz, intensity in zip(spectrum_mzs, spectrum_intensities):
+            vector[int(np.floor(mz / default_bin_width))] += np.sqrt(intensity)
+        vectors.append(vector)
+    dot_product = sum(weight * vectors[1].get(bin, 0.0) for bin, weight in vectors[0].items())
+    norms = [ np.sqrt(sum(weight * weight for weight in vector.values())) for vector in vectors ]
+    return(dot_product / norms[0] / norms[1])
+
+
+def test_search_scores_are_cosine_similarities(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    library_queries = get_queries(spectrum_library, range(60))
+    mzs, intensities, precursor_mz, charge = library_queries[10]
+    #### Shift some peaks into other bins and change the intensities, so that the query matches nothing exactly
+    mzs = np.array(mzs)
+    mzs[::3] += 5 * default_bin_width
+    intensities = np.array(intensities) * np.linspace(0.5, 2.0, len(intensities))
+
+    expected = [ (number, get_reference_score(mzs, intensities, *library_queries[number][0:2])) for number in range(60)
+        if abs(library_queries[number][2] - precursor_mz) <= 100 ]
+    expected.sort(key=lambda hit: -hit[1])
+    assert len(expected) > 3
+
+    hits = spectrum_library.search_spectra( [ (mzs, intensities, precursor_mz, None) ], tolerance=100, tolerance_units='Da',
+        top_n=3, method='candidates')[0]
+    assert [ number for number, score in hits ] == [ number for number, score in expected[0:3] ]
+    assert [ score for number, score in hits ] == pytest.approx( [ score for number, score in expected[0:3] ], abs=1e-5)
+    assert hits[0][0] == 10 and hits[0][1] < 0.999
+
+    #### With a charge, only candidates of that charge are scored
+    hits = spectrum_library.search_spectra( [ (mzs, intensities, precursor_mz, charge) ], tolerance=100, tolerance_units='Da', top_n=100)[0]
+    expected = [ (number, score) for number, score in expected if library_queries[number][3] == charge ]
+    assert sorted(number for number, score in hits) == sorted(number for number, score in expected)
+    hits, expected = get_scored_hits( [ hits, expected ] )
+    assert [ number for number, score in hits ] == [ number for number, score in expected ]
+    assert [ score for number, score in hits ] == pytest.approx( [ score for number, score in expected ], abs=1e-5)
+
+
+def test_saved_sparse_matrix(library_file, monkeypatch):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    search_engine = SpectrumLibrarySearch(spectrum_library=spectrum_library)
+    assert list(np.diff(search_engine.row_precursor_mzs) >= 0) == [ True ] * 59
+    matrix = search_engine.get_matrix()
+    assert matrix.shape == (60, search_engine.n_bins)
+    assert np.allclose(np.sqrt(matrix.multiply(matrix).sum(axis=1)), 1.0)
+
+    #### The product of the matrix with a query vector gives the same scores as scoring the candidates one by one
+    mzs, intensities, precursor_mz, charge = get_queries(spectrum_library, [ 33 ])[0]
+    query_bins, query_weights = search_engine.get_query_vector(mzs, intensities)
+    query_bins, query_weights = query_bins[query_bins < search_engine.n_bins], query_weights[query_bins < search_engine.n_bins]
+    query_vector = np.zeros(search_engine.n_bins, dtype=np.float32)
+    query_vector[query_bins] = query_weights
+    assert matrix.dot(query_vector) == pytest.approx(search_engine.score_candidates(query_bins, query_weights, search_engine.row_numbers), abs=1e-5)
+
+    #### A new engine loads the saved matrix instead of binning the library again, unless its parameters differ
+    def fail_create_matrix(self):
+        raise AssertionError("The saved matrix was not used")
+    monkeypatch.setattr(SpectrumLibrarySearch, 'create_matrix', fail_create_matrix)
+    loaded_engine = SpectrumLibrarySearch(spectrum_library=spectrum_library)
+    for name in [ 'bin_offsets', 'bins', 'weights', 'row_numbers', 'row_precursor_mzs', 'row_charges' ]:
+        assert np.array_equal(getattr(loaded_engine, name), getattr(search_engine, name))
+    with pytest.raises(AssertionError):
+        SpectrumLibrarySearch(spectrum_library=spectrum_library, top_k_peaks=5)
+
+    #### Nor is it used once the library has been appended to
+    write_msp_library(library_file, 5, seed=2, mode='a')
+    spectrum_library.update_index()
+    with pytest.raises(AssertionError):
+        SpectrumLibrarySearch(spectrum_library=spectrum_library)
+    monkeypatch.undo()
+    assert SpectrumLibrarySearch(spectrum_library=spectrum_library).n_spectra == 65
+
+
+def test_fragment_index_candidates_match_a_linear_scan(library_file):
+    spectrum_library = SpectrumLibrary(filename=library_file)
+    spectrum_library.create_index()
+    library_queries = get_queries(spectrum_library, range(60))
+    fragment_index = SpectrumLibraryFragmentIndex(spectrum_library=spectrum_library, bin_width=0.05, top_k_peaks=None)
+
+    #### A query made of the peaks of one spectrum, shifted within the tolerance, and a few peaks of another
+    mzs = np.concatenate( (np.array(library_queries[10][0]) + 0.015, library_queries[20][0][0:4]) )
+    tolerance = 0.02
+    query_bins = set()
+    for mz in mzs:
+        query_bins.update(range(int(np.floor( (mz - tolerance) / 0.05)), int(np.floor( (mz + tolerance) / 0.05)) + 1))
+    expected_counts = [ len(set(int(np.floor(mz / 0.05)) for mz in library_mzs) & query_bins) for library_mzs, intensities,
+        precursor_mz, charge in library_queries ]
+    assert list(fragment_index.get_shared_peak_counts(mzs, tolerance=tolerance)) == expected_counts
+
+    expected = sorted( (number for number in range(60) if expected_counts[number] >= 2), key=lambda number: -expected_counts[number])
+    assert expected[0] == 10 and 20 in expected
+    assert list(fragment_index.find_candidates(mzs, tolerance=tolerance, min_shared_peaks=2)) == expected
+    candidates = fragment_index.find_candidates(mzs, tolerance=tolerance, min_shared_peaks=1, max_candidates=2)
+    assert sorted(expected_counts[number] for number in candidates) == sorted(expected_counts, reverse=True)[0:2][::-1]
+    assert len(fragment_index.find_candidates( [ 5000.0 ], tolerance=tolerance, min_shared_peaks=1)) == 0